@@ -1,19 +1,16 @@
 import copy
-from utils.my_utils import load_json, dump_json, get_state_detail, get_state_three_segment
-import requests
-import json
-import time
+from utils.my_utils import load_json, get_state_three_segment
+from utils.log_writer import JsonlLogWriter, to_jsonl_file
+from utils.llm import get_client_pool
+from utils.action_decoding import guided_decoding_body, SIGNAL_TEMPLATE
 import re
 import csv
 import io
 import pandas as pd
 import numpy as np
 
-url = "https://api.openai.com/v1/chat/completions"
-headers = {
-    "Content-Type": "application/json",
-    "Authorization": "sk-xxxxxx"  # Replace with your actual API key
-}
+api_base_url = "https://api.openai.com/v1"
+api_key = "sk-xxxxxx"  # Replace with your actual API key
 
 four_phase_list = {'ETWT': 0, 'NTST': 1, 'ELWL': 2, 'NLSL': 3}
 eight_phase_list = {'ETWT': 0, 'NTST': 1, 'ELWL': 2, 'NLSL': 3, 'WTWL': 4, 'ETEL': 5, 'STSL': 6, 'NTNL': 7}
@@ -44,7 +41,8 @@ incoming_lane_2_outgoing_road = {
 }
 
 class ChatGPTTLCS_Wait_Time_Forecast(object):
-    def __init__(self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset):
+    def __init__(self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset, decision_cache=None,
+                 early_stop=False, decoding_mode="free"):
         # init road length
         roads = copy.deepcopy(intersection["roads"])
         self.inter_name = inter_name
@@ -60,22 +58,28 @@ class ChatGPTTLCS_Wait_Time_Forecast(object):
         self.system_prompt = load_json("./prompts/prompt_domain_knowledge.json")["system_prompt"]
         self.state_action_prompt_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_state_action_prompt_domain_knowledge.json"
         self.error_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_error_prompts_domain_knowledge.json"
-        self.state_action_prompt = []
-        self.errors = []
+        self.state_action_logger = JsonlLogWriter(to_jsonl_file(self.state_action_prompt_file),
+                                                  legacy_file=self.state_action_prompt_file)
+        self.error_logger = JsonlLogWriter(to_jsonl_file(self.error_file), legacy_file=self.error_file)
+        # utils.decision_cache.DecisionCache shared by the agents, None to always query the model
+        self.decision_cache = decision_cache
+        # stream the response and stop reading once the signal tag is closed
+        self.early_stop = early_stop
+        # restricts the signal answer to the phases on vLLM servers, see utils.action_decoding
+        self.guided_body = guided_decoding_body(decoding_mode, self.phases, SIGNAL_TEMPLATE)
 
         self.temp_action_logger = ""
 
     def choose_action(self, env):
         self.temp_action_logger = ""
-        state, state_incoming, avg_speed = get_state_detail(roads=self.roads, env=env)
+        state, state_incoming, avg_speed = env.get_state_detail(self.inter_name)
         flow_num = 0
         for road in state:
             flow_num += state[road]["queue_len"] + sum(state[road]["cells"])
 
         if flow_num == 0:
             action_code = self.action2code("ETWT")
-            self.state_action_prompt.append({"state": state, "prompt": [], "action": "ETWT"})
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
+            self.state_action_logger.append({"state": state, "prompt": [], "action": "ETWT"})
             self.temp_action_logger = action_code
 
             return
@@ -89,29 +93,39 @@ class ChatGPTTLCS_Wait_Time_Forecast(object):
                 if retry_counter > 10:
                     signal_text = "ETWT"
                     break
+                # counted before the request, the client raises once its own retries are used up
+                retry_counter += 1
                 state_txt, max_queue_len = self.state2table(state)
                 prompt = self.getPrompt(state_txt, avg_speed)
+                sampling_kwargs = {"max_tokens": 2048, "temperature": 0.0}
+                if self.guided_body is not None:
+                    sampling_kwargs["extra_body"] = self.guided_body
                 data = {
                     "model": self.gpt_version,
                     "messages": prompt,
-                    "max_tokens": 2048,
-                    "temperature": 0.0
+                    **sampling_kwargs
                 }
-                response = requests.post(url, headers=headers, data=json.dumps(data)).json()
-                analysis = response['choices'][0]['message']['content']
-                retry_counter += 1
+                analysis = None
+                if self.decision_cache is not None:
+                    cache_key = self.decision_cache.make_key(prompt, self.gpt_version, sampling_kwargs)
+                    analysis = self.decision_cache.get(cache_key)
+                cached = analysis is not None
+                if not cached and self.early_stop:
+                    analysis = get_client_pool(api_base_url, api_key).stream_until(r'</signal>', **data)
+                elif not cached:
+                    response = get_client_pool(api_base_url, api_key).create(**data)
+                    analysis = response.choices[0].message.content
                 signal_answer_pattern = r'<signal>(.*?)</signal>'
                 signal_text = re.findall(signal_answer_pattern, analysis)[-1]
+                if self.decision_cache is not None and not cached and signal_text in self.phases:
+                    self.decision_cache.put(cache_key, analysis)
 
             except Exception as e:
-                self.errors.append({"error": str(e), "prompt": prompt})
-                dump_json(self.errors, self.error_file)
-                time.sleep(5)
+                self.error_logger.append({"error": str(e), "prompt": prompt})
 
         prompt.append({"role": "assistant", "content": analysis})
         action_code = self.action2code(signal_text)
-        self.state_action_prompt.append({"state": state, "state_incoming": state_incoming, "prompt": prompt, "action": signal_text})
-        dump_json(self.state_action_prompt, self.state_action_prompt_file)
+        self.state_action_logger.append({"state": state, "state_incoming": state_incoming, "prompt": prompt, "action": signal_text})
 
         self.temp_action_logger = action_code
         self.last_action = signal_text
@@ -184,13 +198,18 @@ class ChatGPTTLCS_Wait_Time_Forecast(object):
 
         return prompt
 
+    def close(self):
+        self.state_action_logger.close()
+        self.error_logger.close()
+
     def action2code(self, action):
         code = self.phases[action]
 
         return code
 
 class ChatGPTTLCS_Commonsense(object):
-    def __init__(self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset):
+    def __init__(self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset, decision_cache=None,
+                 early_stop=False, decoding_mode="free"):
         # init road length
         roads = copy.deepcopy(intersection["roads"])
         self.inter_name = inter_name
@@ -206,22 +225,28 @@ class ChatGPTTLCS_Commonsense(object):
         self.system_prompt = load_json("./prompts/prompt_commonsense.json")["system_prompt"]
         self.state_action_prompt_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_state_action_prompt_commonsense_no_calculation.json"
         self.error_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_error_prompts_commonsense_no_calculation.json"
-        self.state_action_prompt = []
-        self.errors = []
+        self.state_action_logger = JsonlLogWriter(to_jsonl_file(self.state_action_prompt_file),
+                                                  legacy_file=self.state_action_prompt_file)
+        self.error_logger = JsonlLogWriter(to_jsonl_file(self.error_file), legacy_file=self.error_file)
+        # utils.decision_cache.DecisionCache shared by the agents, None to always query the model
+        self.decision_cache = decision_cache
+        # stream the response and stop reading once the signal tag is closed
+        self.early_stop = early_stop
+        # restricts the signal answer to the phases on vLLM servers, see utils.action_decoding
+        self.guided_body = guided_decoding_body(decoding_mode, self.phases, SIGNAL_TEMPLATE)
 
         self.temp_action_logger = ""
 
     def choose_action(self, env):
         self.temp_action_logger = ""
-        state, state_incoming, avg_speed = get_state_detail(roads=self.roads, env=env)
+        state, state_incoming, avg_speed = env.get_state_detail(self.inter_name)
         flow_num = 0
         for road in state:
             flow_num += state[road]["queue_len"] + sum(state[road]["cells"])
 
         if flow_num == 0:
             action_code = self.action2code("ETWT")
-            self.state_action_prompt.append({"state": state, "prompt": [], "action": "ETWT"})
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
+            self.state_action_logger.append({"state": state, "prompt": [], "action": "ETWT"})
             self.temp_action_logger = action_code
 
             return
@@ -234,32 +259,44 @@ class ChatGPTTLCS_Commonsense(object):
             if retry_counter > 10:
                 signal_text = "ETWT"
                 break
+            # counted before the request, the client raises once its own retries are used up
+            retry_counter += 1
             try:
                 state_txt = self.state2table(state)
                 prompt = self.getPrompt(state_txt)
+                sampling_kwargs = {"max_tokens": 2048, "temperature": 0.0}
+                if self.guided_body is not None:
+                    sampling_kwargs["extra_body"] = self.guided_body
                 data = {
                     "model": self.gpt_version,
                     "messages": prompt,
-                    "max_tokens": 2048,
-                    "temperature": 0.0
+                    **sampling_kwargs
                 }
-                response = requests.post(url, headers=headers, data=json.dumps(data)).json()
-                analysis = response['choices'][0]['message']['content']
-                retry_counter += 1
+                analysis = None
+                if self.decision_cache is not None:
+                    cache_key = self.decision_cache.make_key(prompt, self.gpt_version, sampling_kwargs)
+                    analysis = self.decision_cache.get(cache_key)
+                cached = analysis is not None
+                if not cached and self.early_stop:
+                    analysis = get_client_pool(api_base_url, api_key).stream_until(r'</signal>', **data)
+                elif not cached:
+                    response = get_client_pool(api_base_url, api_key).create(**data)
+                    analysis = response.choices[0].message.content
                 signal_answer_pattern = r'<signal>(.*?)</signal>'
                 signal_text = re.findall(signal_answer_pattern, analysis)[-1]
+                if self.decision_cache is not None and not cached and signal_text in self.phases:
+                    self.decision_cache.put(cache_key, analysis)
 
             except Exception as e:
                 if "response" not in locals():
                     response = "No response"
-                self.errors.append({"error": str(e), "prompt": prompt, "response": response})
-                dump_json(self.errors, self.error_file)
-                time.sleep(3)
+                if not isinstance(response, str):
+                    response = response.model_dump()
+                self.error_logger.append({"error": str(e), "prompt": prompt, "response": response})
 
         prompt.append({"role": "assistant", "content": analysis})
         action_code = self.action2code(signal_text)
-        self.state_action_prompt.append({"state": state, "state_incoming": state_incoming, "prompt": prompt, "action": signal_text})
-        dump_json(self.state_action_prompt, self.state_action_prompt_file)
+        self.state_action_logger.append({"state": state, "state_incoming": state_incoming, "prompt": prompt, "action": signal_text})
 
         self.temp_action_logger = action_code
         self.last_action = signal_text
@@ -336,6 +373,10 @@ class ChatGPTTLCS_Commonsense(object):
 
         return prompt
 
+    def close(self):
+        self.state_action_logger.close()
+        self.error_logger.close()
+
     def action2code(self, action):
         code = self.phases[action]
 
@@ -1,6 +1,5 @@
 import os
 import copy
-import requests
 import json
 import time
 import re
@@ -12,12 +11,12 @@ import numpy as np
 
 from utils.my_utils import (
     load_json,
-    dump_json,
-    get_state_detail,
     get_state_three_segment,
 )
 from utils.cityflow_env import CityFlowEnv
-from utils.llm import create_chat_completion
+from utils.llm import create_chat_completion, stream_chat_completion
+from utils.action_decoding import guided_decoding_body, BOXED_TEMPLATE
+from utils.log_writer import JsonlLogWriter, to_jsonl_file
 
 # url = "http://127.0.0.1:8000/v1/chat/completions"
 url = os.getenv("LLM_API_URL", "http://127.0.0.1:8000/v1/chat/completions")
@@ -73,7 +72,16 @@ incoming_lane_2_outgoing_road = {
 
 class TrafficR1_Agent:
     def __init__(
-        self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset
+        self,
+        GPT_version,
+        intersection,
+        inter_name,
+        phase_num,
+        log_dir,
+        dataset,
+        decision_cache=None,
+        early_stop=False,
+        decoding_mode="free",
     ):
         # init road length
         roads = copy.deepcopy(intersection["roads"])
@@ -94,11 +102,22 @@ class TrafficR1_Agent:
 
         self.state_action_prompt_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_state_action_prompt_trafficr1.json"
         self.error_file = f"{log_dir}/{dataset}-{self.inter_name}-{self.gpt_version}-{phase_num}_error_prompts_trafficr1.json"
-        self.state_action_prompt = []
-        self.errors = []
+        self.state_action_logger = JsonlLogWriter(
+            to_jsonl_file(self.state_action_prompt_file),
+            legacy_file=self.state_action_prompt_file,
+        )
+        self.error_logger = JsonlLogWriter(
+            to_jsonl_file(self.error_file), legacy_file=self.error_file
+        )
+        # utils.decision_cache.DecisionCache shared by the agents, None to always query the model
+        self.decision_cache = decision_cache
+        # stream the response and stop reading once the boxed answer is closed
+        self.early_stop = early_stop
+        # restricts the boxed answer to the phases on vLLM servers, see utils.action_decoding
+        self.guided_body = guided_decoding_body(decoding_mode, self.phases, BOXED_TEMPLATE)
 
     def choose_action(self, env: CityFlowEnv):
-        state, state_incoming, avg_speed = get_state_detail(roads=self.roads, env=env)
+        state, state_incoming, avg_speed = env.get_state_detail(self.inter_name)
 
         # 默认流量为0时使用ETWT
         flow_num = 0
@@ -106,10 +125,9 @@ class TrafficR1_Agent:
             flow_num += state[road]["queue_len"] + sum(state[road]["cells"])
         if flow_num == 0:
             action_code = self.action2code("ETWT")
-            self.state_action_prompt.append(
+            self.state_action_logger.append(
                 {"state": state, "prompt": [], "action": "ETWT"}
             )
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
             return action_code
 
         signal_text = ""
@@ -120,42 +138,77 @@ class TrafficR1_Agent:
             if retry_counter > 3:
                 signal_text = "ETWT"
                 break
+            # counted before the request, the client raises once its own retries are used up
+            retry_counter += 1
             try:
                 prompt = self.create_prompt(state)
                 messages = [
                     {"role": "system", "content": self.prompt["system_prompt"]},
                     {"role": "user", "content": prompt},
                 ]
-                llm_res = create_chat_completion(
-                    model=self.gpt_version,
-                    messages=messages,
-                    max_tokens=512 * 6,
-                )
-                llm_signal_text = llm_res.choices[0].message.content
-                retry_counter += 1
+                sampling_kwargs = {"temperature": 0.7, "max_tokens": 512 * 6}
+                if self.guided_body is not None:
+                    sampling_kwargs["extra_body"] = self.guided_body
                 signal_answer_pattern = r"\\boxed{([^}]*)}"
+                llm_res, llm_signal_text = None, None
+                if self.decision_cache is not None:
+                    cache_key = self.decision_cache.make_key(
+                        messages, self.gpt_version, sampling_kwargs
+                    )
+                    llm_signal_text = self.decision_cache.get(cache_key)
+                cached = llm_signal_text is not None
+                if not cached and self.early_stop:
+                    llm_signal_text = stream_chat_completion(
+                        model=self.gpt_version,
+                        messages=messages,
+                        stop_pattern=signal_answer_pattern,
+                        **sampling_kwargs,
+                    )
+                elif not cached:
+                    llm_res = create_chat_completion(
+                        model=self.gpt_version,
+                        messages=messages,
+                        **sampling_kwargs,
+                    )
+                    llm_signal_text = llm_res.choices[0].message.content
                 signal_text = re.findall(signal_answer_pattern, llm_signal_text)[-1]
                 for s in self.phases.keys():
                     if s in signal_text.strip().upper():
                         signal_text = s
                         break
+                if (
+                    self.decision_cache is not None
+                    and not cached
+                    and signal_text in self.phases
+                ):
+                    self.decision_cache.put(cache_key, llm_signal_text)
 
             except Exception as e:
                 if "llm_res" not in locals():
                     llm_res = "No response"
-                self.errors.append(
+                self.error_logger.append(
                     {
                         "error": str(e),
                         "prompt": prompt,
-                        "response": llm_res.model_dump(),
+                        "response": (
+                            llm_res.model_dump()
+                            if hasattr(llm_res, "model_dump")
+                            else llm_res
+                        ),
                     }
                 )
-                dump_json(self.errors, self.error_file)
                 # time.sleep(3)
 
-        messages.append({"role": "assistant", "content": llm_res.model_dump()})
+        messages.append(
+            {
+                "role": "assistant",
+                "content": (
+                    llm_res.model_dump() if llm_res is not None else llm_signal_text
+                ),
+            }
+        )
         action_code = self.action2code(signal_text)
-        self.state_action_prompt.append(
+        self.state_action_logger.append(
             {
                 "state": state,
                 "state_incoming": state_incoming,
@@ -163,12 +216,15 @@ class TrafficR1_Agent:
                 "action": signal_text,
             }
         )
-        dump_json(self.state_action_prompt, self.state_action_prompt_file)
 
         self.temp_action_logger = action_code
         self.last_action = signal_text
         return action_code
 
+    def close(self):
+        self.state_action_logger.close()
+        self.error_logger.close()
+
     def action2code(self, action: str) -> int:
         code = self.phases[action]
 
@@ -229,7 +285,16 @@ You can only choose one of the signals listed above: NTST, NLSL, ETWT, ELWL. You
 
 class Rule_Agent:
     def __init__(
-        self, GPT_version, intersection, inter_name, phase_num, log_dir, dataset
+        self,
+        GPT_version,
+        intersection,
+        inter_name,
+        phase_num,
+        log_dir,
+        dataset,
+        decision_cache=None,
+        early_stop=False,
+        decoding_mode="free",
     ):
         # init road length
         roads = copy.deepcopy(intersection["roads"])
@@ -248,11 +313,16 @@ class Rule_Agent:
         self.error_file = (
             f"{log_dir}/{dataset}-{self.inter_name}-rulebased-{phase_num}_error.json"
         )
-        self.state_action_prompt = []
-        self.errors = []
+        self.state_action_logger = JsonlLogWriter(
+            to_jsonl_file(self.state_action_prompt_file),
+            legacy_file=self.state_action_prompt_file,
+        )
+        self.error_logger = JsonlLogWriter(
+            to_jsonl_file(self.error_file), legacy_file=self.error_file
+        )
 
     def choose_action(self, env: CityFlowEnv):
-        state, state_incoming, avg_speed = get_state_detail(roads=self.roads, env=env)
+        state, state_incoming, avg_speed = env.get_state_detail(self.inter_name)
 
         # 默认流量为0时使用ETWT
         flow_num = 0
@@ -260,10 +330,9 @@ class Rule_Agent:
             flow_num += state[road]["queue_len"] + sum(state[road]["cells"])
         if flow_num == 0:
             action_code = self.action2code("ETWT")
-            self.state_action_prompt.append(
+            self.state_action_logger.append(
                 {"state": state, "action_reason": "Zero flow", "action": "ETWT"}
             )
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
             return action_code
 
         # 计算各个相位的车流量
@@ -285,14 +354,13 @@ class Rule_Agent:
                 break
         if is_max_flow_phase:
             action_code = self.action2code(max_flow_phase)
-            self.state_action_prompt.append(
+            self.state_action_logger.append(
                 {
                     "state": state,
                     "action_reason": "Max flow phase",
                     "action": max_flow_phase,
                 }
             )
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
             return action_code
 
         # 判断是否选择最大排队长度相位
@@ -316,14 +384,13 @@ class Rule_Agent:
         ]
         if len(max_queue_phases) == 1:
             action_code = self.action2code(max_queue_phases[0])
-            self.state_action_prompt.append(
+            self.state_action_logger.append(
                 {
                     "state": state,
                     "action_reason": "Max queue phase",
                     "action": max_queue_phases[0],
                 }
             )
-            dump_json(self.state_action_prompt, self.state_action_prompt_file)
             return action_code
 
         # 选择等待时间最长的相位
@@ -339,16 +406,19 @@ class Rule_Agent:
         ]
         # 默认选择第一个相位
         action_code = self.action2code(max_waiting_time_phases[0])
-        self.state_action_prompt.append(
+        self.state_action_logger.append(
             {
                 "state": state,
                 "action_reason": "Max waiting time phase",
                 "action": max_waiting_time_phases[0],
             }
         )
-        dump_json(self.state_action_prompt, self.state_action_prompt_file)
         return action_code
 
+    def close(self):
+        self.state_action_logger.close()
+        self.error_logger.close()
+
     def action2code(self, action: str) -> int:
         code = self.phases[action]
 
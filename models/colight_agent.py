@@ -6,6 +6,7 @@ reward: -queue_length
 import numpy as np
 import os
 from .agent import Agent
+from utils.replay_store import SampleBatch
 import random
 from tensorflow.keras import backend as K
 from tensorflow.keras.optimizers import Adam
@@ -15,13 +16,16 @@ from tensorflow.keras.layers import Dense, Lambda, Layer, Reshape
 from tensorflow.keras.models import model_from_json, load_model
 from tensorflow.keras.utils import to_categorical
 from tensorflow.keras.callbacks import EarlyStopping
-import torch
 
 
 def build_memory():
     return []
 
 
+# [agent, neighbors, agent] one-hot adjacency by (num_agents, shape, adjacency index bytes)
+_adjacency_one_hot = {}
+
+
 class CoLightAgent(Agent):
     def __init__(self, dic_agent_conf=None, dic_traffic_env_conf=None, dic_path=None, cnt_round=None,
                  intersection_id="0"):
@@ -30,6 +34,9 @@ class CoLightAgent(Agent):
         self.CNN_layers = dic_agent_conf['CNN_layers']
         self.num_agents = dic_traffic_env_conf['NUM_INTERSECTIONS']
         self.num_neighbors = min(dic_traffic_env_conf['TOP_K_ADJACENCY'], self.num_agents)
+        self.attention = dic_traffic_env_conf.get("COLIGHT_ATTENTION", "dense")
+        if self.attention not in ["dense", "gather"]:
+            raise ValueError(f"unknown COLIGHT_ATTENTION {self.attention}, use dense or gather")
 
         self.num_actions = len(self.dic_traffic_env_conf["PHASE"])
         self.len_feature = self._cal_len_feature()
@@ -97,7 +104,7 @@ class CoLightAgent(Agent):
     def MultiHeadsAttModel(self, in_feats, in_nei, d_in=128, h_dim=16, dout=128, head=8, suffix=-1):
         """
         input: [batch, agent, dim] feature
-               [batch, agent, nei, agent] adjacency
+               [batch, agent, nei, agent] one-hot adjacency, [batch, agent, nei] neighbor indexes in gather mode
         input:[bacth,agent,128]
         output:
               [batch, agent, dim]
@@ -105,11 +112,15 @@ class CoLightAgent(Agent):
         # [batch,agent,dim]->[batch,agent,1,dim]
         agent_repr = Reshape((self.num_agents, 1, d_in))(in_feats)
 
-        # [batch,agent,dim]->(reshape)[batch,1,agent,dim]->(tile)[batch,agent,agent,dim]
-        neighbor_repr = RepeatVector3D(self.num_agents)(in_feats)
+        if self.attention == "gather":
+            # [batch,agent,dim] gathered at [batch,agent,neighbor]->[batch,agent,neighbor,dim]
+            neighbor_repr = Lambda(lambda x: tf.gather(x[0], x[1], batch_dims=1))([in_feats, in_nei])
+        else:
+            # [batch,agent,dim]->(reshape)[batch,1,agent,dim]->(tile)[batch,agent,agent,dim]
+            neighbor_repr = RepeatVector3D(self.num_agents)(in_feats)
 
-        # [batch,agent,neighbor,agent]x[batch,agent,agent,dim]->[batch,agent,neighbor,dim]
-        neighbor_repr = Lambda(lambda x: tf.matmul(x[0], x[1]))([in_nei, neighbor_repr])
+            # [batch,agent,neighbor,agent]x[batch,agent,agent,dim]->[batch,agent,neighbor,dim]
+            neighbor_repr = Lambda(lambda x: tf.matmul(x[0], x[1]))([in_nei, neighbor_repr])
 
         # attention computation
         # [batch, agent, 1, dim]->[batch, agent, 1, h_dim*head]
@@ -146,11 +157,32 @@ class CoLightAgent(Agent):
         return out, att_record
 
     def adjacency_index2matrix(self, adjacency_index):
-        # [batch,agents,neighbors]
+        """
+        [batch, agents, neighbors] indexes -> [batch, agents, neighbors, agents] one-hot
+        adjacency_row is static per roadnet, so the one-hot of a batch of one adjacency is computed once per
+        process and broadcast over the batch as a read-only view
+        """
+        adjacency_index = np.asarray(adjacency_index, dtype=np.int64)
+        if len(adjacency_index) > 0 and (adjacency_index == adjacency_index[:1]).all():
+            key = (self.num_agents, adjacency_index.shape[1:], adjacency_index[0].tobytes())
+            if key not in _adjacency_one_hot:
+                _adjacency_one_hot[key] = to_categorical(np.sort(adjacency_index[0], axis=-1),
+                                                         num_classes=self.num_agents)
+            one_hot = _adjacency_one_hot[key]
+            return np.broadcast_to(one_hot, (len(adjacency_index),) + one_hot.shape)
         adjacency_index_new = np.sort(adjacency_index, axis=-1)
         lab = to_categorical(adjacency_index_new, num_classes=self.num_agents)
         return lab
 
+    def adjacency_input(self, adjacency_index):
+        """
+        [batch, agents, neighbors] indexes -> the adjacency input of the network, the one-hot of
+        adjacency_index2matrix or the sorted indexes in gather mode, in the same neighbor order
+        """
+        if self.attention == "gather":
+            return np.sort(np.asarray(adjacency_index, dtype=np.int32), axis=-1)
+        return self.adjacency_index2matrix(adjacency_index)
+
     def convert_state_to_input(self, s):
         """
         s: [state1, state2, ..., staten]
@@ -175,8 +207,8 @@ class CoLightAgent(Agent):
         # [1, agent, dim]
         # feats = np.concatenate([np.array([feat1]), np.array([feat2])], axis=-1)
         feats = np.array([feats0])
-        # [1, agent, nei, agent]
-        adj = self.adjacency_index2matrix(np.array([adj]))
+        # [1, agent, nei, agent], [1, agent, nei] in gather mode
+        adj = self.adjacency_input(np.array([adj]))
         return [feats, adj]
 
     def choose_action(self, count, states):
@@ -209,60 +241,62 @@ class CoLightAgent(Agent):
         else:
             action = np.argmax(q_values[0], axis=1)
 
+        import torch
+
         norm_values = torch.softmax(torch.tensor(np.array(q_values[0])) / 0.05, dim=1)
         norm_values = (norm_values - torch.min(norm_values, dim=1)[0].unsqueeze(1)) / (torch.max(norm_values, dim=1)[0].unsqueeze(1) - torch.min(norm_values, dim=1)[0].unsqueeze(1))
         norm_values = norm_values.numpy()
 
         return action, norm_values
 
-    @staticmethod
-    def _concat_list(ls):
-        tmp = []
-        for i in range(len(ls)):
-            tmp += ls[i]
-        return [tmp]
+    def _memory_arrays(self, memory):
+        """
+        memory: [samples of agent1, ..., samples of agentn], lists of sample rows or SampleBatch aligned by index
+        return: state and next state [batch, agent, dim], adjacency index [batch, agent, nei],
+                action and reward [batch, agent]
+        """
+        used_feature = self.dic_traffic_env_conf["LIST_STATE_FEATURE"][:-1]
+        if all(isinstance(samples, SampleBatch) for samples in memory):
+            # the columns of the replay store are stacked as they are
+            _state = np.stack([np.concatenate([samples.state[feature] for feature in used_feature], axis=-1)
+                               for samples in memory], axis=1)
+            _next_state = np.stack([np.concatenate([samples.next_state[feature] for feature in used_feature], axis=-1)
+                                    for samples in memory], axis=1)
+            _adj = np.stack([samples.state["adjacency_matrix"] for samples in memory], axis=1).astype(np.int64)
+            _action = np.stack([samples.action for samples in memory], axis=1)
+            _reward = np.stack([samples.reward_average for samples in memory], axis=1)
+            return _state, _next_state, _adj, _action, _reward
+
+        slice_size = len(memory[0])
+        memory = [samples[:slice_size] for samples in memory]
+        # [agent, batch, dim] -> [batch, agent, dim]
+        _state = np.stack([np.array([[value for feature in used_feature for value in sample[0][feature]]
+                                     for sample in samples]) for samples in memory], axis=1)
+        _next_state = np.stack([np.array([[value for feature in used_feature for value in sample[2][feature]]
+                                          for sample in samples]) for samples in memory], axis=1)
+        _adj = np.stack([np.array([sample[0]["adjacency_matrix"] for sample in samples]) for samples in memory],
+                        axis=1)
+        _action = np.array([[sample[1] for sample in samples] for samples in memory]).T
+        _reward = np.array([[sample[3] for sample in samples] for samples in memory], dtype=np.float64).T
+        return _state, _next_state, _adj, _action, _reward
 
     def prepare_Xs_Y(self, memory):
         """
         memory: [slice_data, slice_data, ..., slice_data]
         prepare memory for training
         """
-        slice_size = len(memory[0])
-        _adjs = []
-        # state : [feat1, feat2]
-        # feati : [agent1, agent2, ..., agentn]
-        _state = [[] for _ in range(self.num_agents)]
-        _next_state = [[] for _ in range(self.num_agents)]
-        _action = [[] for _ in range(self.num_agents)]
-        _reward = [[] for _ in range(self.num_agents)]
-
-        used_feature = self.dic_traffic_env_conf["LIST_STATE_FEATURE"][:-1]
+        _state2, _next_state2, _adj, _action, _reward = self._memory_arrays(memory)
+        # [batch, agent, nei, agent], [batch, agent, nei] in gather mode
+        _adjs2 = self.adjacency_input(_adj)
 
-        for i in range(slice_size):
-            _adj = []
-            for j in range(self.num_agents):
-                state, action, next_state, reward, _, _, _ = memory[j][i]
-                _action[j].append(action)
-                _reward[j].append(reward)
-                _adj.append(state["adjacency_matrix"])
-                # TODO
-                _state[j].append(self._concat_list([state[used_feature[i]] for i in range(len(used_feature))]))
-                _next_state[j].append(self._concat_list([next_state[used_feature[i]] for i in range(len(used_feature))]))
-            _adjs.append(_adj)
-        # [batch, agent, nei, agent]
-        _adjs2 = self.adjacency_index2matrix(np.array(_adjs))
-
-        # [batch, 1, dim] -> [batch, agent, dim]
-        _state2 = np.concatenate([np.array(ss) for ss in _state], axis=1)
-        _next_state2 = np.concatenate([np.array(ss) for ss in _next_state], axis=1)
         target = self.q_network([_state2, _adjs2])
-        next_state_qvalues = self.q_network_bar([_next_state2, _adjs2])
+        next_state_qvalues = np.asarray(self.q_network_bar([_next_state2, _adjs2]))
         # [batch, agent, num_actions]
-        final_target = np.copy(target)
-        for i in range(slice_size):
-            for j in range(self.num_agents):
-                final_target[i, j, _action[j][i]] = _reward[j][i] / self.dic_agent_conf["NORMAL_FACTOR"] + \
-                                                    self.dic_agent_conf["GAMMA"] * np.max(next_state_qvalues[i, j])
+        final_target = np.array(target)
+        batch_index, agent_index = np.meshgrid(np.arange(_action.shape[0]), np.arange(_action.shape[1]),
+                                               indexing="ij")
+        final_target[batch_index, agent_index, _action] = _reward / self.dic_agent_conf["NORMAL_FACTOR"] + \
+            self.dic_agent_conf["GAMMA"] * np.max(next_state_qvalues, axis=-1)
 
         self.Xs = [_state2, _adjs2]
         self.Y = final_target
@@ -272,9 +306,12 @@ class CoLightAgent(Agent):
         CNN_heads = [5] * len(CNN_layers)
         In = list()
         # In: [batch,agent,dim]
-        # In: [batch,agent,neighbors,agents]
+        # In: [batch,agent,neighbors,agents], [batch,agent,neighbors] in gather mode
         In.append(Input(shape=(self.num_agents, self.len_feature), name="feature"))
-        In.append(Input(shape=(self.num_agents, self.num_neighbors, self.num_agents), name="adjacency_matrix"))
+        if self.attention == "gather":
+            In.append(Input(shape=(self.num_agents, self.num_neighbors), dtype="int32", name="adjacency_matrix"))
+        else:
+            In.append(Input(shape=(self.num_agents, self.num_neighbors, self.num_agents), name="adjacency_matrix"))
 
         feature = self.MLP(In[0], MLP_layers)
 
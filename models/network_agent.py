@@ -7,6 +7,7 @@ from tensorflow.keras import backend as K
 import random
 import os
 from .agent import Agent
+from utils.replay_store import SampleBatch
 import traceback
 
 
@@ -99,8 +100,12 @@ class NetworkAgent(Agent):
                         loss=self.dic_agent_conf["LOSS_FUNCTION"])
         return network
 
-    def prepare_Xs_Y(self, memory):
-
+    def sample_memory(self, memory, used_feature):
+        """
+        forget all but the last MAX_MEMORY_LEN samples of memory and sample SAMPLE_SIZE of them
+        memory: list of [state, action, next_state, reward, instant_reward, time, tag] or a SampleBatch
+        return: [batch, feature_dim] states of used_feature, actions [batch], next states, rewards [batch]
+        """
         ind_end = len(memory)
         print("memory size before forget: {0}".format(ind_end))
         # use all the samples to pretrain, i.e., without forgetting
@@ -110,40 +115,42 @@ class NetworkAgent(Agent):
 
         # sample the memory
         sample_size = min(self.dic_agent_conf["SAMPLE_SIZE"], len(memory_after_forget))
-        sample_slice = random.sample(memory_after_forget, sample_size)
+        sample_indexes = random.sample(range(len(memory_after_forget)), sample_size)
         print("memory samples number:", sample_size)
 
-        dic_state_feature_arrays = {}
-        for feature_name in self.dic_traffic_env_conf["LIST_STATE_FEATURE"]:
-            dic_state_feature_arrays[feature_name] = []
-        Y = []
-
-        for i in range(len(sample_slice)):
-            state, action, next_state, reward, instant_reward, _, _ = sample_slice[i]
-            for feature_name in self.dic_traffic_env_conf["LIST_STATE_FEATURE"]:
-                dic_state_feature_arrays[feature_name].append(state[feature_name])
-            _state = []
-            _next_state = []
-            for feature_name in self.dic_traffic_env_conf["LIST_STATE_FEATURE"]:
-                _state.append(np.array([state[feature_name]]))
-                _next_state.append(np.array([next_state[feature_name]]))
-
-            target = self.q_network.predict(_state)
-
-            next_state_qvalues = self.q_network_bar.predict(_next_state)
-
-            if self.dic_agent_conf["LOSS_FUNCTION"] == "mean_squared_error":
-                final_target = np.copy(target[0])
-                final_target[action] = reward / self.dic_agent_conf["NORMAL_FACTOR"] + self.dic_agent_conf["GAMMA"] * \
-                                       np.max(next_state_qvalues[0])
-            elif self.dic_agent_conf["LOSS_FUNCTION"] == "categorical_crossentropy":
-                raise NotImplementedError
-
-            Y.append(final_target)
-
-        self.Xs = [np.array(dic_state_feature_arrays[feature_name]) for feature_name in
-                   self.dic_traffic_env_conf["LIST_STATE_FEATURE"]]
-        self.Y = np.array(Y)
+        if isinstance(memory_after_forget, SampleBatch):
+            # the replay store already keeps the feature arrays
+            batch = memory_after_forget.take(sample_indexes)
+            return ([batch.state[feature_name] for feature_name in used_feature], batch.action,
+                    [batch.next_state[feature_name] for feature_name in used_feature], batch.reward_average)
+
+        sample_slice = [memory_after_forget[k] for k in sample_indexes]
+        _state = [np.array([sample[0][feature_name] for sample in sample_slice]) for feature_name in used_feature]
+        _next_state = [np.array([sample[2][feature_name] for sample in sample_slice])
+                       for feature_name in used_feature]
+        _action = np.array([sample[1] for sample in sample_slice], dtype=np.int64)
+        _reward = np.array([sample[3] for sample in sample_slice], dtype=np.float64)
+        return _state, _action, _next_state, _reward
+
+    def bellman_targets(self, cur_qvalues, actions, rewards, next_qvalues):
+        """cur_qvalues [batch, num_actions] with the q value of the taken actions replaced by their target"""
+        target = np.copy(cur_qvalues)
+        target[np.arange(len(actions)), actions] = rewards / self.dic_agent_conf["NORMAL_FACTOR"] + \
+            self.dic_agent_conf["GAMMA"] * np.max(next_qvalues, axis=1)
+        return target
+
+    def prepare_Xs_Y(self, memory):
+        if self.dic_agent_conf["LOSS_FUNCTION"] == "categorical_crossentropy":
+            raise NotImplementedError
+        _state, _action, _next_state, _reward = self.sample_memory(memory,
+                                                                   self.dic_traffic_env_conf["LIST_STATE_FEATURE"])
+
+        # one batched forward pass of each network for the whole sample
+        target = self.q_network.predict(_state)
+        next_state_qvalues = self.q_network_bar.predict(_next_state)
+
+        self.Xs = _state
+        self.Y = self.bellman_targets(target, _action, _reward, next_state_qvalues)
 
     def convert_state_to_input(self, s):
         if self.dic_traffic_env_conf["BINARY_PHASE_EXPANSION"]:
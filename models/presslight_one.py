@@ -72,46 +72,15 @@ class PressLightAgentOne(NetworkAgent):
         """
         designed for update simple dqn models
         """
-        ind_end = len(memory)
-        print("memory size before forget: {0}".format(ind_end))
-        # use all the samples to pretrain, i.e., without forgetting
-
-        ind_sta = max(0, ind_end - self.dic_agent_conf["MAX_MEMORY_LEN"])
-        memory_after_forget = memory[ind_sta: ind_end]
-        print("memory size after forget:", len(memory_after_forget))
-
-        # sample the memory
-        sample_size = min(self.dic_agent_conf["SAMPLE_SIZE"], len(memory_after_forget))
-        sample_slice = random.sample(memory_after_forget, sample_size)
-        print("memory samples number:", sample_size)
-
         # used_feature = ["phase_2", "phase_num_vehicle"]
         used_feature = self.dic_traffic_env_conf["LIST_STATE_FEATURE"]
-        _state = [[] for _ in range(len(used_feature))]
-        _next_state = [[] for _ in range(len(used_feature))]
-        _action = []
-        _reward = []
-        for i in range(len(sample_slice)):
-            state, action, next_state, reward, _, _, _ = sample_slice[i]
-            for feat_idx, feat_name in enumerate(used_feature):
-                _state[feat_idx].append(state[feat_name])
-                _next_state[feat_idx].append(next_state[feat_name])
-            _action.append(action)
-            _reward.append(reward)
-        # well prepared states
-        _state2 = [np.array(ss) for ss in _state]
-        _next_state2 = [np.array(ss) for ss in _next_state]
+        _state2, _action, _next_state2, _reward = self.sample_memory(memory, used_feature)
 
         cur_qvalues = self.q_network.predict(_state2)
         next_qvalues = self.q_network_bar.predict(_next_state2)
         # [batch, 4]
-        target = np.copy(cur_qvalues)
-
-        for i in range(len(sample_slice)):
-            target[i, _action[i]] = _reward[i] / self.dic_agent_conf["NORMAL_FACTOR"] + self.dic_agent_conf["GAMMA"] * \
-                                    np.max(next_qvalues[i, :])
         self.Xs = _state2
-        self.Y = target
+        self.Y = self.bellman_targets(cur_qvalues, _action, _reward, next_qvalues)
 
     def choose_action(self, count, states):
         """
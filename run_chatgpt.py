@@ -20,6 +20,10 @@ def parse_args():
     parser.add_argument("--gpt_version", type=str, default="gpt-4")
     parser.add_argument("--dataset", type=str, default="jinan")
     parser.add_argument("--traffic_file", type=str, default="anon_3_4_jinan_real.json")
+    parser.add_argument("--decision_cache", type=str, default=None)
+    parser.add_argument("--pipeline_lookahead", type=int, default=0)
+    parser.add_argument("--early_stop", action="store_true", default=False)
+    parser.add_argument("--decoding_mode", type=str, default="free", choices=["free", "constrained", "logprob"])
 
     return parser.parse_args()
 
@@ -74,6 +78,10 @@ def main(in_args):
     dic_agent_conf_extra = {
         "GPT_VERSION": in_args.gpt_version,
         "LOG_DIR": log_dir,
+        "DECISION_CACHE": in_args.decision_cache,
+        "PIPELINE_LOOKAHEAD": in_args.pipeline_lookahead,
+        "EARLY_STOP": in_args.early_stop,
+        "DECODING_MODE": in_args.decoding_mode,
     }
 
     dic_traffic_env_conf_extra = {
@@ -19,6 +19,11 @@ def parse_args():
     parser.add_argument("--workers", type=int, default=1)
     parser.add_argument("--dataset", type=str, default="template")
     parser.add_argument("--traffic_file", type=str, default="flow_main_stream.json")
+    parser.add_argument("--disable_prefix_caching", action="store_true", default=False)
+    parser.add_argument("--decision_cache", type=str, default=None)
+    parser.add_argument("--pipeline_lookahead", type=int, default=0)
+    parser.add_argument("--early_stop", action="store_true", default=False)
+    parser.add_argument("--decoding_mode", type=str, default="free", choices=["free", "constrained", "logprob"])
 
     return parser.parse_args()
 
@@ -70,7 +75,12 @@ def main(in_args):
         "LLM_PATH": in_args.llm_path,
         "LLM_MODEL": in_args.llm_model,
         "LOG_DIR": f"./{in_args.llm_model}_logs",
-        "NEW_MAX_TOKENS": in_args.new_max_tokens
+        "NEW_MAX_TOKENS": in_args.new_max_tokens,
+        "PREFIX_CACHING": not in_args.disable_prefix_caching,
+        "DECISION_CACHE": in_args.decision_cache,
+        "PIPELINE_LOOKAHEAD": in_args.pipeline_lookahead,
+        "EARLY_STOP": in_args.early_stop,
+        "DECODING_MODE": in_args.decoding_mode
     }
 
     dic_traffic_env_conf_extra = {
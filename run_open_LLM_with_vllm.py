@@ -20,6 +20,15 @@ def parse_args():
     parser.add_argument("--workers", type=int, default=1)
     parser.add_argument("--dataset", type=str, default="template")
     parser.add_argument("--traffic_file", type=str, default="flow_main_stream.json")
+    parser.add_argument("--disable_prefix_caching", action="store_true", default=False)
+    parser.add_argument("--decision_server", action="store_true", default=False)
+    parser.add_argument("--max_batch_tokens", type=int, default=None)
+    parser.add_argument("--llm_backend", type=str, default="vllm", choices=["vllm", "local"])
+    parser.add_argument("--decision_cache", type=str, default=None)
+    parser.add_argument("--pipeline_lookahead", type=int, default=0)
+    parser.add_argument("--early_stop", action="store_true", default=False)
+    parser.add_argument("--decoding_mode", type=str, default="free", choices=["free", "constrained", "logprob"])
+    parser.add_argument("--num_envs", type=int, default=1)
 
     return parser.parse_args()
 
@@ -72,7 +81,15 @@ def main(in_args):
         "LLM_PATH": in_args.llm_path,
         "LLM_MODEL": in_args.llm_model,
         "LOG_DIR": f"./{in_args.llm_model}_logs",
-        "NEW_MAX_TOKENS": in_args.new_max_tokens
+        "NEW_MAX_TOKENS": in_args.new_max_tokens,
+        "PREFIX_CACHING": not in_args.disable_prefix_caching,
+        "DECISION_SERVER": in_args.decision_server,
+        "MAX_BATCH_TOKENS": in_args.max_batch_tokens,
+        "LLM_BACKEND": in_args.llm_backend,
+        "DECISION_CACHE": in_args.decision_cache,
+        "PIPELINE_LOOKAHEAD": in_args.pipeline_lookahead,
+        "EARLY_STOP": in_args.early_stop,
+        "DECODING_MODE": in_args.decoding_mode
     }
 
     dic_traffic_env_conf_extra = {
@@ -83,6 +100,7 @@ def main(in_args):
         "PROJECT_NAME": in_args.proj_name,
         "RUN_COUNTS": count,
         "NUM_ROUNDS": in_args.num_rounds,
+        "NUM_ENVS": in_args.num_envs,
         "NUM_ROW": NUM_ROW,
         "NUM_COL": NUM_COL,
 
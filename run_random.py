@@ -89,6 +89,7 @@ def main(in_args):
         "DIC_REWARD_INFO": {
             "pressure": 0
         },
+        "LAZY_FEATURE": True,
     }
     if in_args.eightphase:
         dic_traffic_env_conf_extra["PHASE"] = {
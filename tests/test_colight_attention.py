@@ -0,0 +1,123 @@
+"""
+COLIGHT_ATTENTION "gather" against the dense one-hot attention of CoLight on the Jinan 3x4 roadnet:
+with the same weights both networks give the same q values, and the weights of one mode load into the other.
+"""
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+pytest.importorskip("tensorflow")
+
+from utils.roadnet import adjacency_extraction
+from models.colight_agent import CoLightAgent
+
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "Jinan", "3_4")
+NUM_ROW, NUM_COL = 3, 4
+# the q values of the untrained networks are around 1e-4, compare relative to them
+RTOL, ATOL = 1e-5, 1e-9
+
+# the keys of utils.config read by CoLightAgent, utils.config itself imports every agent and the engine
+AGENT_CONF = {"CNN_layers": [[32, 32]], "LEARNING_RATE": 0.001, "EPSILON": 0.8, "EPSILON_DECAY": 0.95,
+              "MIN_EPSILON": 0.2, "LOSS_FUNCTION": "mean_squared_error"}
+TRAFFIC_ENV_CONF = {
+    "NUM_INTERSECTIONS": NUM_ROW * NUM_COL,
+    "TOP_K_ADJACENCY": 5,
+    "ROADNET_FILE": "roadnet_3_4.json",
+    "LIST_STATE_FEATURE": ["cur_phase", "lane_num_vehicle", "adjacency_matrix"],
+    "BINARY_PHASE_EXPANSION": True,
+    "PHASE": {
+        1: [0, 1, 0, 1, 0, 0, 0, 0],
+        2: [0, 0, 0, 0, 0, 1, 0, 1],
+        3: [1, 0, 1, 0, 0, 0, 0, 0],
+        4: [0, 0, 0, 0, 1, 0, 1, 0]
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def traffic_env_conf():
+    return TRAFFIC_ENV_CONF
+
+
+@pytest.fixture(scope="module")
+def adjacency(traffic_env_conf):
+    """adjacency_row of every intersection, in the order of CityFlowEnv.list_intersection"""
+    traffic_light_node_dict = adjacency_extraction(os.path.join(DATA_DIR, traffic_env_conf["ROADNET_FILE"]),
+                                                   traffic_env_conf["TOP_K_ADJACENCY"])
+    return np.array([traffic_light_node_dict["intersection_{0}_{1}".format(i + 1, j + 1)]["adjacency_row"]
+                     for i in range(NUM_COL) for j in range(NUM_ROW)])
+
+
+def build_agent(traffic_env_conf, attention, path_to_model):
+    os.makedirs(path_to_model, exist_ok=True)
+    return CoLightAgent(dic_agent_conf=dict(AGENT_CONF),
+                        dic_traffic_env_conf=dict(traffic_env_conf, COLIGHT_ATTENTION=attention),
+                        dic_path={"PATH_TO_MODEL": str(path_to_model)}, cnt_round=0)
+
+
+@pytest.fixture(scope="module")
+def agents(traffic_env_conf, tmp_path_factory):
+    dense = build_agent(traffic_env_conf, "dense", tmp_path_factory.mktemp("dense"))
+    gather = build_agent(traffic_env_conf, "gather", tmp_path_factory.mktemp("gather"))
+    gather.q_network.set_weights(dense.q_network.get_weights())
+    return dense, gather
+
+
+def random_batch(agent, adjacency, batch_size=32, seed=0):
+    """random features, the neighbors of every sample in a random order"""
+    rng = np.random.default_rng(seed)
+    feats = rng.normal(size=(batch_size, len(adjacency), agent.len_feature)).astype(np.float32)
+    adj = rng.permuted(np.broadcast_to(adjacency, (batch_size,) + adjacency.shape), axis=-1)
+    return feats, adj
+
+
+def q_values(agent, feats, adj):
+    return np.asarray(agent.q_network([feats, agent.adjacency_input(adj)]))
+
+
+def test_adjacency_input(agents, adjacency):
+    dense, gather = agents
+    _, adj = random_batch(dense, adjacency)
+    one_hot = dense.adjacency_input(adj)
+    indexes = gather.adjacency_input(adj)
+    assert one_hot.shape == adj.shape + (len(adjacency),)
+    assert indexes.shape == adj.shape
+    np.testing.assert_array_equal(one_hot.argmax(axis=-1), indexes)
+
+
+def test_batch_equivalence(agents, adjacency):
+    dense, gather = agents
+    feats, adj = random_batch(dense, adjacency)
+    np.testing.assert_allclose(q_values(gather, feats, adj), q_values(dense, feats, adj), rtol=RTOL, atol=ATOL)
+
+
+def test_state_equivalence(agents, adjacency, traffic_env_conf):
+    dense, gather = agents
+    rng = np.random.default_rng(1)
+    phases = list(traffic_env_conf["PHASE"].keys())
+    state = [{"cur_phase": [int(rng.choice(phases))],
+              "lane_num_vehicle": rng.integers(0, 20, size=12).tolist(),
+              "adjacency_matrix": adjacency[i].tolist()} for i in range(len(adjacency))]
+    np.testing.assert_allclose(np.asarray(gather.q_network(gather.convert_state_to_input(state))),
+                               np.asarray(dense.q_network(dense.convert_state_to_input(state))),
+                               rtol=RTOL, atol=ATOL)
+
+
+def test_load_weights_across_modes(agents, adjacency, traffic_env_conf, tmp_path):
+    dense, _ = agents
+    dense.q_network.save(os.path.join(tmp_path, "round_0_inter_0.h5"))
+    # the round 0 agent loads the weights of the model directory by name
+    gather = build_agent(traffic_env_conf, "gather", tmp_path)
+    feats, adj = random_batch(dense, adjacency, seed=2)
+    np.testing.assert_allclose(q_values(gather, feats, adj), q_values(dense, feats, adj), rtol=RTOL, atol=ATOL)
+
+
+def test_gather_model_save_load(agents, adjacency):
+    _, gather = agents
+    feats, adj = random_batch(gather, adjacency, seed=3)
+    expected = q_values(gather, feats, adj)
+    gather.save_network("round_1_inter_0")
+    gather.load_network("round_1_inter_0")
+    np.testing.assert_allclose(q_values(gather, feats, adj), expected, rtol=RTOL, atol=ATOL)
@@ -3,7 +3,7 @@ import copy
 from .config import DIC_AGENTS
 from copy import deepcopy
 from .cityflow_env import CityFlowEnv
-from .my_utils import get_state_detail, dump_json, load_json
+from .my_utils import dump_json, load_json
 import os
 import time
 import shutil
@@ -94,10 +94,8 @@ def test_transfer(data_dir, dic_traffic_env_conf, dic_agent_conf):
         queue_length_episode.append(sum(queue_length_inter))
 
         # waiting time
-        waiting_times = []
-        for veh in env.waiting_vehicle_list:
-            waiting_times.append(env.waiting_vehicle_list[veh]['time'])
-        waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+        waiting_time_episode.append(env.get_mean_waiting_time())
+    env.end_cityflow()
 
     # wandb logger
     vehicle_travel_times = {}
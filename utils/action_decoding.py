@@ -0,0 +1,97 @@
+import re
+
+# DECODING_MODE free: parse the generated text, constrained: reason freely then pick the answer among the
+# phases, logprob: pick the answer among the phases right after the prompt, without reasoning
+SIGNAL_TEMPLATE = "<signal>{}</signal>"
+BOXED_TEMPLATE = "\\boxed{{{}}}"
+
+
+def answer_regex(phases, answer_template=SIGNAL_TEMPLATE):
+    """regex of the answers allowed by answer_template, one per phase"""
+    head, tail = answer_template.split("{}")
+    head, tail = head.replace("{{", "{").replace("}}", "}"), tail.replace("{{", "{").replace("}}", "}")
+    return re.escape(head) + "(" + "|".join(re.escape(phase) for phase in phases) + ")" + re.escape(tail)
+
+
+def guided_decoding_body(decoding_mode, phases, answer_template=SIGNAL_TEMPLATE):
+    """
+    extra_body of a request to an OpenAI compatible vLLM server that restricts the answer to phases,
+    None in free mode. Other OpenAI compatible servers may reject the guided_regex field.
+    """
+    if decoding_mode == "free":
+        return None
+    answer = answer_regex(phases, answer_template)
+    return {"guided_regex": answer if decoding_mode == "logprob" else r"[\s\S]*" + answer}
+
+
+class HFAnswerScorer:
+    """
+    Sum of the log-probabilities of the last tokens of token id sequences under an HF causal LM.
+    The sequences are left padded, so only the logits of the answer positions are computed.
+    """
+    def __init__(self, llm_model, pad_token_id):
+        self.llm_model = llm_model
+        self.pad_token_id = pad_token_id
+
+    def __call__(self, list_ids, starts):
+        import torch
+
+        max_len = max(len(ids) for ids in list_ids)
+        num_scored = max(len(ids) - start for ids, start in zip(list_ids, starts))
+        input_ids = [[self.pad_token_id] * (max_len - len(ids)) + ids for ids in list_ids]
+        attention_mask = [[0] * (max_len - len(ids)) + [1] * len(ids) for ids in list_ids]
+        input_ids = torch.tensor(input_ids, device=self.llm_model.device)
+        attention_mask = torch.tensor(attention_mask, device=self.llm_model.device)
+        with torch.no_grad():
+            logits = self.llm_model(input_ids=input_ids, attention_mask=attention_mask,
+                                    num_logits_to_keep=num_scored + 1).logits
+        # logits[:, j] predicts the token at max_len - num_scored + j
+        logprobs = torch.log_softmax(logits[:, :-1].float(), dim=-1)
+        targets = input_ids[:, -num_scored:]
+        token_logprobs = logprobs.gather(-1, targets.unsqueeze(-1)).squeeze(-1)
+        num_answer = torch.tensor([len(ids) - start for ids, start in zip(list_ids, starts)],
+                                  device=token_logprobs.device)
+        positions = torch.arange(num_scored, device=token_logprobs.device)
+        scored = positions[None, :] >= num_scored - num_answer[:, None]
+        return (token_logprobs * scored).sum(dim=-1).tolist()
+
+
+class PhaseScorer:
+    """
+    Picks the answer of each text among the phases by the log-probability of answer_template.format(phase)
+    after it, all candidates of a batch are scored with one score_fn(list_ids, starts) call.
+    Only the tokens after the common prefix of the candidates are scored.
+    """
+    def __init__(self, tokenizer, phases, score_fn, answer_template=SIGNAL_TEMPLATE):
+        self.tokenizer = tokenizer
+        self.phases = list(phases)
+        self.score_fn = score_fn
+        self.answer_template = answer_template
+
+    def _candidates(self, text):
+        list_ids = [self.tokenizer(text + self.answer_template.format(phase))["input_ids"] for phase in self.phases]
+        start = 0
+        while all(len(ids) > start for ids in list_ids) and len({ids[start] for ids in list_ids}) == 1:
+            start += 1
+        return list_ids, start
+
+    def pick(self, texts):
+        """return: the picked phase of every text"""
+        list_ids, starts = [], []
+        for text in texts:
+            candidates, start = self._candidates(text)
+            list_ids += candidates
+            starts += [start] * len(candidates)
+        if len(list_ids) == 0:
+            return []
+        scores = self.score_fn(list_ids, starts)
+        num_phases = len(self.phases)
+        picked = []
+        for i in range(len(texts)):
+            phase_scores = scores[i * num_phases: (i + 1) * num_phases]
+            picked.append(self.phases[phase_scores.index(max(phase_scores))])
+        return picked
+
+    def answers(self, texts):
+        """return: the picked answer of every text, formatted with answer_template"""
+        return [self.answer_template.format(phase) for phase in self.pick(texts)]
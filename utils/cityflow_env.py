@@ -6,8 +6,16 @@ import pandas as pd
 import os
 import cityflow as engine
 import time
+import threading
 from multiprocessing import Process
 from .my_utils import load_json, calculate_road_length
+from .vehicle_state import VehicleSnapshot, WaitingTimeTracker
+from .feature_engine import FeatureEngine, LazyFeatureDict
+from .log_writer import SignalLogWriter
+from .state_extractor import StateExtractor
+from .lane_topology import LaneTopology
+from .roadnet import adjacency_extraction
+from .engine_tuner import tune_thread_num
 from functools import reduce
 
 location_dict = {"North": "N", "South": "S", "East": "E", "West": "W"}
@@ -15,10 +23,11 @@ location_dict_reverse = {"N": "North", "S": "South", "E": "East", "W": "West"}
 direction_dict = {"go_straight": "T", "turn_left": "L", "turn_right": "R"}
 
 class Intersection:
-    def __init__(self, inter_id, dic_traffic_env_conf, eng, light_id_dict, path_to_log, lanes_length_dict):
+    def __init__(self, inter_id, dic_traffic_env_conf, eng, light_id_dict, signal_log_writer, lanes_length_dict):
         self.inter_id = inter_id
         self.inter_name = "intersection_{0}_{1}".format(inter_id[0], inter_id[1])
         self.eng = eng
+        self.signal_log_writer = signal_log_writer
         self.dic_traffic_env_conf = dic_traffic_env_conf
         self.lane_length = lanes_length_dict
         self.obs_length = dic_traffic_env_conf["OBS_LENGTH"]
@@ -50,6 +59,10 @@ class Intersection:
         self.adjacency_row = light_id_dict["adjacency_row"]
         self.neighbor_ENWS = light_id_dict["neighbor_ENWS"]
 
+        self.reset()
+
+    def reset(self):
+        """measurements and signal of the start of an episode, the lanes and the roadnet are kept"""
         # ========== record previous & current feats ==========
         self.dic_lane_vehicle_previous_step = {}
         self.dic_lane_vehicle_previous_step_in = {}
@@ -80,11 +93,7 @@ class Intersection:
         self.current_phase_index = 1
         self.previous_phase_index = 1
         self.eng.set_tl_phase(self.inter_name, self.current_phase_index)
-        path_to_log_file = os.path.join(path_to_log, "signal_inter_{0}.txt".format(self.inter_name))
-        df = [self.get_current_time(), self.current_phase_index]
-        df = pd.DataFrame(df)
-        df = df.transpose()
-        df.to_csv(path_to_log_file, mode="a", header=False, index=False)
+        self.signal_log_writer.log(self.inter_name, self.get_current_time(), self.current_phase_index)
 
         self.next_phase_to_set_index = None
         self.current_phase_duration = -1
@@ -92,18 +101,14 @@ class Intersection:
         self.all_yellow_flag = False
         self.flicker = 0
 
-    def set_signal(self, action, action_pattern, yellow_time, path_to_log):
+    def set_signal(self, action, action_pattern, yellow_time):
         if self.all_yellow_flag:
             # in yellow phase
             self.flicker = 0
             if self.current_phase_duration >= yellow_time:  # yellow time reached
                 self.current_phase_index = self.next_phase_to_set_index
                 self.eng.set_tl_phase(self.inter_name, self.current_phase_index)  # if multi_phase, need more adjustment
-                path_to_log_file = os.path.join(path_to_log, "signal_inter_{0}.txt".format(self.inter_name))
-                df = [self.get_current_time(), self.current_phase_index]
-                df = pd.DataFrame(df)
-                df = df.transpose()
-                df.to_csv(path_to_log_file, mode="a", header=False, index=False)
+                self.signal_log_writer.log(self.inter_name, self.get_current_time(), self.current_phase_index)
                 self.all_yellow_flag = False
         else:
             # determine phase
@@ -126,11 +131,7 @@ class Intersection:
             else:  # the light phase needs to change
                 # change to yellow first, and activate the counter and flag
                 self.eng.set_tl_phase(self.inter_name, 0)  # !!! yellow, tmp
-                path_to_log_file = os.path.join(path_to_log, "signal_inter_{0}.txt".format(self.inter_name))
-                df = [self.get_current_time(), self.current_phase_index]
-                df = pd.DataFrame(df)
-                df = df.transpose()
-                df.to_csv(path_to_log_file, mode="a", header=False, index=False)
+                self.signal_log_writer.log(self.inter_name, self.get_current_time(), self.current_phase_index)
                 self.current_phase_index = self.all_yellow_phase_index
                 self.all_yellow_flag = True
                 self.flicker = 1
@@ -144,7 +145,7 @@ class Intersection:
         self.dic_vehicle_speed_previous_step = self.dic_vehicle_speed_current_step
         self.dic_vehicle_distance_previous_step = self.dic_vehicle_distance_current_step
 
-    def update_current_measurements(self, simulator_state):
+    def update_current_measurements(self, simulator_state, update_feature=True):
         def _change_lane_vehicle_dic_to_list(dic_lane_vehicle):
             list_lane_vehicle = []
             for value in dic_lane_vehicle.values():
@@ -185,7 +186,8 @@ class Intersection:
         self._update_arrive_time(list_vehicle_new_arrive)
         self._update_left_time(list_vehicle_new_left)
         # update feature
-        self._update_feature()
+        if update_feature:
+            self._update_feature()
 
     def _update_leave_entering_approach_vehicle(self):
         list_entering_lane_vehicle_left = []
@@ -454,6 +456,8 @@ class Intersection:
         return self.dic_vehicle_arrive_leave_time
 
     def get_feature(self):
+        if isinstance(self.dic_feature, LazyFeatureDict):
+            return self.dic_feature.materialize()
         return self.dic_feature
 
     def get_state(self, list_state_features):
@@ -465,14 +469,15 @@ class Intersection:
         return self.adjacency_row
 
     def get_reward(self, dic_reward_info):
-        dic_reward = dict()
-        # dic_reward["sum_lane_queue_length"] = None
-        dic_reward["pressure"] = np.absolute(np.sum(self.dic_feature["pressure"]))
-        dic_reward["queue_length"] = np.absolute(np.sum(self.dic_feature["lane_num_waiting_vehicle_in"]))
+        # only the weighted components are evaluated, so lazy features stay untouched otherwise
+        dic_reward_func = {
+            "pressure": lambda: np.absolute(np.sum(self.dic_feature["pressure"])),
+            "queue_length": lambda: np.absolute(np.sum(self.dic_feature["lane_num_waiting_vehicle_in"]))
+        }
         reward = 0
         for r in dic_reward_info:
             if dic_reward_info[r] != 0:
-                reward += dic_reward_info[r] * dic_reward[r]
+                reward += dic_reward_info[r] * dic_reward_func[r]()
         return reward
 
 
@@ -493,8 +498,18 @@ class CityFlowEnv:
         self.list_inter_log = None
         self.list_lanes = None
         self.system_states = None
+        self.vehicle_snapshot = None
+        self.feature_engine = None
+        self.list_required_feature = None
         self.lane_length = None
-        self.waiting_vehicle_list = {}
+        self.waiting_tracker = None
+        self.state_extractor = None
+        self.state_detail_cache = None
+        self.state_detail_lock = threading.Lock()
+        self.initial_archive = None
+        self.replay_log_file = None
+        self.signal_log_writer = SignalLogWriter(self.path_to_log,
+                                                 self.dic_traffic_env_conf.get("SIGNAL_LOG_FLUSH_INTERVAL", 300))
 
         # check min action time
         if self.dic_traffic_env_conf["MIN_ACTION_TIME"] <= self.dic_traffic_env_conf["YELLOW_TIME"]:
@@ -509,6 +524,8 @@ class CityFlowEnv:
             f.close()
 
     def reset(self):
+        if self.initial_archive is not None:
+            return self._fast_reset()
         print(" ============= self.eng.reset() to be implemented ==========")
         cityflow_config = {
             "interval": self.dic_traffic_env_conf["INTERVAL"],
@@ -526,7 +543,12 @@ class CityFlowEnv:
         with open(os.path.join(self.path_to_work_directory, "cityflow.config"), "w") as json_file:
             json.dump(cityflow_config, json_file)
 
-        self.eng = engine.Engine(os.path.join(self.path_to_work_directory, "cityflow.config"), thread_num=1)
+        self.eng = engine.Engine(os.path.join(self.path_to_work_directory, "cityflow.config"),
+                                 thread_num=self._engine_thread_num(cityflow_config))
+        if self.dic_traffic_env_conf.get("FAST_RESET", False):
+            # the next resets restore this snapshot instead of building the engine and the roadnet again
+            self.initial_archive = self.eng.snapshot()
+            self.replay_log_file = cityflow_config["replayLogFile"]
 
         # get adjacency
         self.traffic_light_node_dict = self._adjacency_extraction()
@@ -535,9 +557,10 @@ class CityFlowEnv:
         _, self.lane_length = self.get_lane_length()
 
         # initialize intersections (grid)
+        self.signal_log_writer.reset()
         self.list_intersection = [Intersection((i+1, j+1), self.dic_traffic_env_conf, self.eng,
                                                self.traffic_light_node_dict["intersection_{0}_{1}".format(i+1, j+1)],
-                                               self.path_to_log,
+                                               self.signal_log_writer,
                                                self.lane_length)
                                   for i in range(self.dic_traffic_env_conf["NUM_COL"])
                                   for j in range(self.dic_traffic_env_conf["NUM_ROW"])]
@@ -557,22 +580,74 @@ class CityFlowEnv:
         self.list_lanes = np.unique(self.list_lanes).tolist()
 
         # get new measurements
-        self.system_states = {"get_lane_vehicles": self.eng.get_lane_vehicles(),
-                              "get_lane_waiting_vehicle_count": self.eng.get_lane_waiting_vehicle_count(),
-                              "get_vehicle_speed": self.eng.get_vehicle_speed(),
-                              "get_vehicle_distance": self.eng.get_vehicle_distance(),
-                              }
-
-        for inter in self.list_intersection:
-            inter.update_current_measurements(self.system_states)
+        self.vehicle_snapshot = VehicleSnapshot(self.eng)
+        self.vehicle_snapshot.update()
+        self.waiting_tracker = WaitingTimeTracker(self.dic_traffic_env_conf["INTERVAL"])
+        self.system_states = self.vehicle_snapshot.system_states
+        if self.dic_traffic_env_conf.get("VECTORIZED_FEATURE", True):
+            self.feature_engine = FeatureEngine(self.list_intersection, self.vehicle_snapshot.lane_index,
+                                                self.lane_length, self.dic_traffic_env_conf)
+            # the state features and the ones ConstructSample needs for rewards
+            self.list_required_feature = list(dict.fromkeys(
+                self.dic_traffic_env_conf["LIST_STATE_FEATURE"] + ["lane_num_waiting_vehicle_in", "pressure"]))
+
+        self._update_current_measurements()
         state, done = self.get_state()
 
         # create roadnet dict
         if self.intersection_dict is None:
             self.create_intersection_dict()
+        self.state_extractor = StateExtractor(self.list_intersection, self.intersection_dict,
+                                              self.vehicle_snapshot, self.waiting_tracker)
+        self.state_detail_cache = None
+
+        return state
+
+
+    def _fast_reset(self):
+        """
+        restore the engine snapshot of the first reset, keep the parsed roadnet, the lane lengths and the
+        intersections, only their measurements and signals go back to the start of the episode
+        """
+        self.eng.load(self.initial_archive)
+        # a new engine seed per episode, as the first reset draws it
+        self.eng.set_random_seed(int(np.random.randint(0, 100)))
+        self.eng.set_replay_file(self.replay_log_file)
+
+        self.signal_log_writer.reset()
+        for inter in self.list_intersection:
+            inter.reset()
+        self.list_inter_log = [[] for _ in range(len(self.list_intersection))]
+
+        self.vehicle_snapshot.update()
+        self.waiting_tracker = WaitingTimeTracker(self.dic_traffic_env_conf["INTERVAL"])
+        self.state_extractor.waiting_tracker = self.waiting_tracker
+        self.system_states = self.vehicle_snapshot.system_states
 
+        self._update_current_measurements()
+        state, done = self.get_state()
+        self.state_detail_cache = None
         return state
 
+    def _engine_thread_num(self, cityflow_config):
+        """
+        ENGINE_THREAD_NUM, "auto" benchmarks the thread counts on this roadnet and traffic once and
+        records the best one in the config of the run
+        """
+        thread_num = self.dic_traffic_env_conf.get("ENGINE_THREAD_NUM", 1)
+        if thread_num != "auto":
+            return int(thread_num)
+        thread_num = tune_thread_num(self.path_to_work_directory, cityflow_config,
+                                     max_thread_num=self.dic_traffic_env_conf.get("ENGINE_MAX_THREAD_NUM", None))
+        self.dic_traffic_env_conf["ENGINE_THREAD_NUM"] = thread_num
+        path_to_conf = os.path.join(self.path_to_work_directory, "traffic_env.conf")
+        if os.path.exists(path_to_conf):
+            with open(path_to_conf) as f:
+                dic_conf = json.load(f)
+            dic_conf["ENGINE_THREAD_NUM"] = thread_num
+            with open(path_to_conf, "w") as f:
+                json.dump(dic_conf, f, indent=4)
+        return thread_num
 
     def create_intersection_dict(self):
         roadnet = load_json(f'./{self.dic_path["PATH_TO_DATA"]}/{self.dic_traffic_env_conf["ROADNET_FILE"]}')
@@ -686,6 +761,7 @@ class CityFlowEnv:
                                     roads[r]["lanes"]["turn_right"].append(lane_id)
 
                 agent_intersections[inter_id]["roads"] = roads
+                agent_intersections[inter_id]["topology"] = LaneTopology(roads)
 
         self.intersection_dict = agent_intersections
 
@@ -726,6 +802,7 @@ class CityFlowEnv:
             self.log(cur_time=instant_time, before_action_feature=before_action_feature, action=action_in_sec_display)
             next_state, done = self.get_state()
 
+        self.signal_log_writer.maybe_flush(self.get_current_time())
         print("Step time: ", time.time() - step_start_time)
         return next_state, reward, done, average_reward_action_list
 
@@ -739,46 +816,31 @@ class CityFlowEnv:
             inter.set_signal(
                 action=action[inter_ind],
                 action_pattern=self.dic_traffic_env_conf["ACTION_PATTERN"],
-                yellow_time=self.dic_traffic_env_conf["YELLOW_TIME"],
-                path_to_log=self.path_to_log
+                yellow_time=self.dic_traffic_env_conf["YELLOW_TIME"]
             )
 
         # run one step
         for i in range(int(1/self.dic_traffic_env_conf["INTERVAL"])):
             self.eng.next_step()
 
-            # update queuing vehicle info
-            vehicle_ids = self.eng.get_vehicles(include_waiting=False)
-            for v_id in vehicle_ids:
-                v_info = self.eng.get_vehicle_info(v_id)
-                speed = float(v_info["speed"])
-                if speed < 0.1:
-                    if v_id not in self.waiting_vehicle_list:
-                        self.waiting_vehicle_list[v_id] = {"time": None, "link": None}
-                        self.waiting_vehicle_list[v_id]["time"] = self.dic_traffic_env_conf["INTERVAL"]
-                        self.waiting_vehicle_list[v_id]["link"] = v_info['drivable']
-                    else:
-                        if self.waiting_vehicle_list[v_id]["link"] != v_info['drivable']:
-                            self.waiting_vehicle_list[v_id] = {"time": None, "link": None}
-                            self.waiting_vehicle_list[v_id]["time"] = self.dic_traffic_env_conf["INTERVAL"]
-                            self.waiting_vehicle_list[v_id]["link"] = v_info['drivable']
-                        else:
-                            self.waiting_vehicle_list[v_id]["time"] += self.dic_traffic_env_conf["INTERVAL"]
-                else:
-                    if v_id in self.waiting_vehicle_list:
-                        self.waiting_vehicle_list.pop(v_id)
+            self.vehicle_snapshot.update()
+            self.waiting_tracker.update(self.vehicle_snapshot)
 
-                if v_id in self.waiting_vehicle_list and self.waiting_vehicle_list[v_id]["link"] != v_info['drivable']:
-                    self.waiting_vehicle_list.pop(v_id)
-
-        self.system_states = {"get_lane_vehicles": self.eng.get_lane_vehicles(),
-                              "get_lane_waiting_vehicle_count": self.eng.get_lane_waiting_vehicle_count(),
-                              "get_vehicle_speed": self.eng.get_vehicle_speed(),
-                              "get_vehicle_distance": self.eng.get_vehicle_distance()
-                              }
+        self.system_states = self.vehicle_snapshot.system_states
+        self._update_current_measurements()
 
+    def _update_current_measurements(self):
         for inter in self.list_intersection:
-            inter.update_current_measurements(self.system_states)
+            inter.update_current_measurements(self.system_states, update_feature=self.feature_engine is None)
+        if self.feature_engine is None:
+            return
+        self.feature_engine.update(self.vehicle_snapshot)
+        if self.dic_traffic_env_conf.get("LAZY_FEATURE", False):
+            for inter_ind, inter in enumerate(self.list_intersection):
+                inter.dic_feature = LazyFeatureDict(self.feature_engine, inter_ind, self.list_required_feature)
+        else:
+            for inter, dic_feature in zip(self.list_intersection, self.feature_engine.compute()):
+                inter.dic_feature = dic_feature
 
     def get_feature(self):
         list_feature = [inter.get_feature() for inter in self.list_intersection]
@@ -800,6 +862,23 @@ class CityFlowEnv:
     def get_current_time(self):
         return self.eng.get_current_time()
 
+    def get_state_detail(self, inter_name=None):
+        """
+        (statistic_state, statistic_state_incoming, mean_speed) of all intersections, or of inter_name,
+        extracted once per simulation time and shared by every consumer of the same tick
+        """
+        current_time = self.get_current_time()
+        with self.state_detail_lock:
+            if self.state_detail_cache is None or self.state_detail_cache[0] != current_time:
+                self.state_detail_cache = (current_time, self.state_extractor.extract())
+            list_state_detail = self.state_detail_cache[1]
+        if inter_name is None:
+            return list_state_detail
+        return list_state_detail[self.id_to_index[inter_name]]
+
+    def get_mean_waiting_time(self):
+        return self.waiting_tracker.mean_waiting_time()
+
     def log(self, cur_time, before_action_feature, action):
 
         for inter_ind in range(len(self.list_intersection)):
@@ -811,6 +890,7 @@ class CityFlowEnv:
         """
         Used for model test, only log the vehicle_inter_.csv
         """
+        self.signal_log_writer.flush()
         for inter_ind in range(self.dic_traffic_env_conf["NUM_INTERSECTIONS"]):
             # changed from origin
             if int(inter_ind) % 100 == 0:
@@ -837,6 +917,7 @@ class CityFlowEnv:
 
     def bulk_log_multi_process(self, batch_size=100):
         assert len(self.list_intersection) == len(self.list_inter_log)
+        self.signal_log_writer.flush()
         if batch_size > len(self.list_intersection):
             batch_size_run = len(self.list_intersection)
         else:
@@ -857,73 +938,11 @@ class CityFlowEnv:
         print("end join")
 
     def _adjacency_extraction(self):
-        traffic_light_node_dict = {}
         file = os.path.join(self.path_to_work_directory, self.dic_traffic_env_conf["ROADNET_FILE"])
-        with open("{0}".format(file)) as json_data:
-            net = json.load(json_data)
-            for inter in net["intersections"]:
-                if not inter["virtual"]:
-                    traffic_light_node_dict[inter["id"]] = {"location": {"x": float(inter["point"]["x"]),
-                                                                         "y": float(inter["point"]["y"])},
-                                                            "total_inter_num": None, "adjacency_row": None,
-                                                            "inter_id_to_index": None,
-                                                            "neighbor_ENWS": None}
-
-            top_k = self.dic_traffic_env_conf["TOP_K_ADJACENCY"]
-            total_inter_num = len(traffic_light_node_dict.keys())
-            inter_id_to_index = {}
-
-            edge_id_dict = {}
-            for road in net["roads"]:
-                if road["id"] not in edge_id_dict.keys():
-                    edge_id_dict[road["id"]] = {}
-                edge_id_dict[road["id"]]["from"] = road["startIntersection"]
-                edge_id_dict[road["id"]]["to"] = road["endIntersection"]
-
-            index = 0
-            for i in traffic_light_node_dict.keys():
-                inter_id_to_index[i] = index
-                index += 1
-
-            for i in traffic_light_node_dict.keys():
-                location_1 = traffic_light_node_dict[i]["location"]
-
-                row = np.array([0]*total_inter_num)
-                # row = np.zeros((self.dic_traffic_env_conf["NUM_ROW"],self.dic_traffic_env_conf["NUM_col"]))
-                for j in traffic_light_node_dict.keys():
-                    location_2 = traffic_light_node_dict[j]["location"]
-                    dist = self._cal_distance(location_1, location_2)
-                    row[inter_id_to_index[j]] = dist
-                if len(row) == top_k:
-                    adjacency_row_unsorted = np.argpartition(row, -1)[:top_k].tolist()
-                elif len(row) > top_k:
-                    adjacency_row_unsorted = np.argpartition(row, top_k)[:top_k].tolist()
-                else:
-                    adjacency_row_unsorted = [k for k in range(total_inter_num)]
-                adjacency_row_unsorted.remove(inter_id_to_index[i])
-                traffic_light_node_dict[i]["adjacency_row"] = [inter_id_to_index[i]]+adjacency_row_unsorted
-                traffic_light_node_dict[i]["total_inter_num"] = total_inter_num
-
-            for i in traffic_light_node_dict.keys():
-                traffic_light_node_dict[i]["total_inter_num"] = inter_id_to_index
-                traffic_light_node_dict[i]["neighbor_ENWS"] = []
-                for j in range(4):
-                    road_id = i.replace("intersection", "road")+"_"+str(j)
-                    if edge_id_dict[road_id]["to"] not in traffic_light_node_dict.keys():
-                        traffic_light_node_dict[i]["neighbor_ENWS"].append(None)
-                    else:
-                        traffic_light_node_dict[i]["neighbor_ENWS"].append(edge_id_dict[road_id]["to"])
-
-        return traffic_light_node_dict
+        return adjacency_extraction(file, self.dic_traffic_env_conf["TOP_K_ADJACENCY"])
 
-    @staticmethod
-    def _cal_distance(loc_dict1, loc_dict2):
-        a = np.array((loc_dict1["x"], loc_dict1["y"]))
-        b = np.array((loc_dict2["x"], loc_dict2["y"]))
-        return np.sqrt(np.sum((a-b)**2))
-
-    @staticmethod
-    def end_cityflow():
+    def end_cityflow(self):
+        self.signal_log_writer.flush()
         print("============== cityflow process end ===============")
 
     def get_lane_length(self):
@@ -76,6 +76,25 @@ dic_traffic_env_conf = {
     "NUM_LANES": [3, 3, 3, 3],
 
     "INTERVAL": 1,
+    # compute the features of all intersections at once with utils.feature_engine
+    "VECTORIZED_FEATURE": True,
+    # only compute the features used by LIST_STATE_FEATURE and DIC_REWARD_INFO, on demand
+    "LAZY_FEATURE": False,
+    # simulated seconds between two bulk writes of the signal_inter_*.txt logs
+    "SIGNAL_LOG_FLUSH_INTERVAL": 300,
+    # threads of the CityFlow engine, "auto" picks the fastest count up to ENGINE_MAX_THREAD_NUM (all cores
+    # by default) with a short benchmark at the first reset
+    "ENGINE_THREAD_NUM": 1,
+    "ENGINE_MAX_THREAD_NUM": None,
+    # restore an engine snapshot of the first reset instead of rebuilding the engine and the roadnet
+    "FAST_RESET": False,
+    # keep the replay memory of every intersection as memory mapped columns (utils.replay_store) instead of
+    # the pickled total_samples_inter_*.pkl
+    "COLUMNAR_REPLAY": False,
+    # attention of CoLight over the TOP_K_ADJACENCY neighbors, "dense" multiplies a one-hot
+    # [agents, neighbors, agents] adjacency with all agent features, "gather" picks the neighbors by index
+    # with the same outputs in O(agents * neighbors), for large roadnets
+    "COLIGHT_ATTENTION": "dense",
 
     "LIST_STATE_FEATURE": [
         "cur_phase",
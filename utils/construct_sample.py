@@ -2,6 +2,7 @@ import numpy as np
 import pickle
 import os
 import traceback
+from .replay_store import ReplayStore, SampleBatch
 
 
 def get_reward_from_features(rs):
@@ -25,7 +26,7 @@ def cal_reward(rs, rewards_components):
 
 class ConstructSample:
 
-    def __init__(self, path_to_samples, cnt_round, dic_traffic_env_conf):
+    def __init__(self, path_to_samples, cnt_round, dic_traffic_env_conf, max_memory_len=None):
         self.parent_dir = path_to_samples
         self.path_to_samples = path_to_samples + "/round_" + str(cnt_round)
         self.cnt_round = cnt_round
@@ -38,6 +39,7 @@ class ConstructSample:
 
         self.interval = self.dic_traffic_env_conf["MIN_ACTION_TIME"]
         self.measure_time = self.dic_traffic_env_conf["MEASURE_TIME"]
+        self.max_memory_len = max_memory_len
 
     def load_data(self, folder, i):
         try:
@@ -150,6 +152,9 @@ class ConstructSample:
         if folder == "":
             with open(os.path.join(self.parent_dir, "total_samples.pkl"), "ab+") as f:
                 pickle.dump(samples, f, -1)
+        elif "inter" in folder and self.dic_traffic_env_conf.get("COLUMNAR_REPLAY", False):
+            store = ReplayStore(os.path.join(self.parent_dir, "replay_{0}".format(folder)), self.max_memory_len)
+            store.append(SampleBatch.from_samples(samples or [], self.dic_traffic_env_conf["LIST_STATE_FEATURE"]))
         elif "inter" in folder:
             with open(os.path.join(self.parent_dir, "total_samples_{0}.pkl".format(folder)), "ab+") as f:
                 pickle.dump(samples, f, -1)
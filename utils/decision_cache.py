@@ -0,0 +1,94 @@
+import json
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+
+class DecisionCache:
+    """
+    LLM responses to signal prompts, keyed by the hash of the prompt, the model and the sampling parameters.
+    Lookups go to an in memory LRU first and then to a sqlite file, so the decisions of a run are reused by
+    the next ones. path=":memory:" keeps the cache for the process only.
+    Callers only put responses that gave a valid signal.
+    """
+    def __init__(self, path, capacity=100000, commit_interval=100):
+        self.path = path
+        self.capacity = capacity
+        self.commit_interval = commit_interval
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.num_uncommitted = 0
+        self.hits = 0
+        self.misses = 0
+
+        self.conn = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        self.conn.execute("CREATE TABLE IF NOT EXISTS decisions (key TEXT PRIMARY KEY, response TEXT)")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(prompt, model, sampling_kwargs):
+        """prompt: str, token ids or chat messages"""
+        payload = json.dumps([prompt, model, sampling_kwargs], sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _remember(self, key, response):
+        self.memory[key] = response
+        self.memory.move_to_end(key)
+        if len(self.memory) > self.capacity:
+            self.memory.popitem(last=False)
+
+    def get(self, key):
+        """return the cached response of key, or None"""
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits += 1
+                return self.memory[key]
+            row = self.conn.execute("SELECT response FROM decisions WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._remember(key, row[0])
+            self.hits += 1
+            return row[0]
+
+    def get_many(self, keys):
+        return [self.get(key) for key in keys]
+
+    def put(self, key, response):
+        with self.lock:
+            self._remember(key, response)
+            self.conn.execute("INSERT OR REPLACE INTO decisions (key, response) VALUES (?, ?)", (key, response))
+            self.num_uncommitted += 1
+            if self.num_uncommitted >= self.commit_interval:
+                self.conn.commit()
+                self.num_uncommitted = 0
+
+    def flush(self):
+        with self.lock:
+            self.conn.commit()
+            self.num_uncommitted = 0
+
+    def stats(self):
+        num_lookups = self.hits + self.misses
+        return {"decision_cache_hits": self.hits, "decision_cache_misses": self.misses,
+                "decision_cache_hit_rate": self.hits / num_lookups if num_lookups > 0 else 0.0}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+
+_decision_caches = {}
+_decision_caches_lock = threading.Lock()
+
+
+def get_decision_cache(path, capacity=100000):
+    """the DecisionCache of path shared by all agents of the process, None if path is None"""
+    if path is None:
+        return None
+    with _decision_caches_lock:
+        if path not in _decision_caches:
+            _decision_caches[path] = DecisionCache(path, capacity=capacity)
+        return _decision_caches[path]
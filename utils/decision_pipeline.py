@@ -0,0 +1,64 @@
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class FrozenStateView:
+    """
+    get_state_detail of an environment at one tick, for agents that decide while the environment steps on
+    """
+    def __init__(self, env, list_state_detail):
+        self.id_to_index = env.id_to_index
+        self.list_state_detail = list_state_detail
+
+    def get_state_detail(self, inter_name=None):
+        if inter_name is None:
+            return self.list_state_detail
+        return self.list_state_detail[self.id_to_index[inter_name]]
+
+
+class DecisionPipeline:
+    """
+    Overlaps the decision on the next state with the simulation of the current step.
+    decide(*args) runs in a worker thread on a state observed before env.step, so it must not touch the env.
+    lookahead=0 is the serial loop. With lookahead=k the decision applied at step t is the one on the state
+    of step t-k, the first k steps apply the decision on the first state. The signals still go through
+    env.step, so the yellow time of Intersection.set_signal is kept.
+    applied_step is the step, counted in actions() calls, whose state the decision applied now was taken on,
+    logs keep a decision with its own state and record the applied one apart.
+    """
+    def __init__(self, decide, lookahead=0):
+        self.decide = decide
+        self.lookahead = lookahead
+        self.pending = deque()
+        self.executor = ThreadPoolExecutor(max_workers=1) if lookahead > 0 else None
+        self.num_steps = 0
+        self.applied_step = None
+
+    def actions(self, *args):
+        """request the decision on the current state, return the decision to apply now"""
+        step = self.num_steps
+        self.num_steps += 1
+        if self.executor is None:
+            self.applied_step = step
+            return self.decide(*args)
+        self.pending.append((step, self.executor.submit(self.decide, *args)))
+        if len(self.pending) > self.lookahead:
+            self.applied_step, future = self.pending.popleft()
+        else:
+            self.applied_step, future = self.pending[0]
+        return future.result()
+
+    def close(self):
+        """
+        wait for the decisions still in flight, their logs are part of the run
+        return: [(step, decision)] of the decisions that were not applied
+        """
+        remaining = []
+        while self.pending:
+            step, future = self.pending.popleft()
+            decision = future.result()
+            if step > self.applied_step:
+                remaining.append((step, decision))
+        if self.executor is not None:
+            self.executor.shutdown()
+        return remaining
@@ -0,0 +1,88 @@
+import re
+
+
+class VLLMBackend:
+    """
+    One vllm.LLM engine. generate() hands every prompt to the engine at once and lets its scheduler
+    batch them continuously, max_batch_tokens bounds the tokens scheduled per engine iteration.
+    """
+    def __init__(self, llm_path, sampling_kwargs, max_batch_tokens=None, max_batch_seqs=256, dtype="bfloat16",
+                 enable_prefix_caching=False):
+        import vllm
+
+        engine_kwargs = {"max_num_seqs": max_batch_seqs, "enable_prefix_caching": enable_prefix_caching}
+        if max_batch_tokens is not None:
+            # budgets smaller than a full prompt need the prefill to be chunked
+            engine_kwargs["max_num_batched_tokens"] = max_batch_tokens
+            engine_kwargs["enable_chunked_prefill"] = True
+        self.llm = vllm.LLM(model=llm_path, tokenizer=llm_path, dtype=dtype, **engine_kwargs)
+        self.sampling_params = vllm.SamplingParams(**sampling_kwargs)
+        self.score_params = vllm.SamplingParams(max_tokens=1, prompt_logprobs=0)
+
+    def generate(self, prompts):
+        """prompts: List[str] or List[List[token_id]]"""
+        prompts = [prompt if isinstance(prompt, str) else {"prompt_token_ids": prompt} for prompt in prompts]
+        outputs = self.llm.generate(prompts=prompts, sampling_params=self.sampling_params, use_tqdm=False)
+        return [output.outputs[0].text for output in outputs]
+
+    def score(self, list_ids, starts):
+        """sum of the log-probabilities of the tokens of every token id sequence from its start"""
+        outputs = self.llm.generate(prompts=[{"prompt_token_ids": ids} for ids in list_ids],
+                                    sampling_params=self.score_params, use_tqdm=False)
+        return [sum(output.prompt_logprobs[t][ids[t]].logprob for t in range(start, len(ids)))
+                for output, ids, start in zip(outputs, list_ids, starts)]
+
+
+class LocalBackend:
+    """
+    Stand-in backend for testing without a GPU, answers every prompt with respond(prompt).
+    By default it answers the signal with the most early queued vehicles in the prompt.
+    """
+    def __init__(self, respond=None):
+        self.respond = respond if respond is not None else self.longest_queue
+        self.list_batch_size = []
+
+    @staticmethod
+    def longest_queue(prompt):
+        queues = {phase: int(queue_len) for phase, queue_len in
+                  re.findall(r"Signal: (\w+)\n.*\n- Early queued: .*, (\d+) \(Total\)", prompt)}
+        signal = max(queues, key=queues.get) if queues else "ETWT"
+        return f"<signal>{signal}</signal>"
+
+    def generate(self, prompts):
+        self.list_batch_size.append(len(prompts))
+        return [self.respond(prompt) for prompt in prompts]
+
+
+class DecisionServer:
+    """
+    Decides the signal prompts of a step, of one or several environments, with a single engine call.
+    max_batch_prompts splits the prompts into several calls, None keeps all of them in one.
+    """
+    def __init__(self, backend, max_batch_prompts=None):
+        self.backend = backend
+        self.max_batch_prompts = max_batch_prompts
+        self.num_calls = 0
+
+    def decide(self, prompts):
+        """return the responses to prompts, in order"""
+        if len(prompts) == 0:
+            return []
+        batch_size = self.max_batch_prompts or len(prompts)
+        responses = []
+        for start in range(0, len(prompts), batch_size):
+            responses += self.backend.generate(prompts[start: start + batch_size])
+            self.num_calls += 1
+        return responses
+
+    def decide_batches(self, list_prompts):
+        """
+        list_prompts: List[List[prompt]], the prompts of several environments
+        return: List[List[response]] in the same layout
+        """
+        responses = self.decide([prompt for prompts in list_prompts for prompt in prompts])
+        list_responses, start = [], 0
+        for prompts in list_prompts:
+            list_responses.append(responses[start: start + len(prompts)])
+            start += len(prompts)
+        return list_responses
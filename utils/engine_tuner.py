@@ -0,0 +1,60 @@
+import os
+import json
+import time
+import cityflow as engine
+
+# best thread_num per (roadnet, traffic file, interval), tuned once per process
+_tuned_thread_nums = {}
+
+
+def candidate_thread_nums(max_thread_num=None):
+    """1, 2, 4, ... up to the cores of the machine"""
+    if max_thread_num is None:
+        max_thread_num = os.cpu_count() or 1
+    thread_nums = [1]
+    while thread_nums[-1] * 2 <= max_thread_num:
+        thread_nums.append(thread_nums[-1] * 2)
+    if thread_nums[-1] != max_thread_num:
+        thread_nums.append(max_thread_num)
+    return thread_nums
+
+
+def benchmark_thread_num(config_file, thread_num, num_steps, archive=None):
+    """simulation steps per second of an engine with thread_num threads, from archive if given"""
+    eng = engine.Engine(config_file, thread_num=thread_num)
+    if archive is not None:
+        eng.load(archive)
+    start_time = time.time()
+    for _ in range(num_steps):
+        eng.next_step()
+    return num_steps / max(time.time() - start_time, 1e-9)
+
+
+def tune_thread_num(path_to_work_directory, cityflow_config, max_thread_num=None, warmup_steps=300, num_steps=100):
+    """
+    the thread_num with the highest next_step throughput on the roadnet and traffic of cityflow_config.
+    The candidates start from the same snapshot after warmup_steps, so they all simulate a loaded network.
+    """
+    key = (cityflow_config["dir"], cityflow_config["roadnetFile"], cityflow_config["flowFile"],
+           cityflow_config["interval"])
+    if key in _tuned_thread_nums:
+        return _tuned_thread_nums[key]
+
+    tune_config = dict(cityflow_config, saveReplay=False)
+    config_file = os.path.join(path_to_work_directory, "cityflow_tune.config")
+    with open(config_file, "w") as json_file:
+        json.dump(tune_config, json_file)
+
+    warmup_eng = engine.Engine(config_file, thread_num=max(candidate_thread_nums(max_thread_num)))
+    for _ in range(warmup_steps):
+        warmup_eng.next_step()
+    archive = warmup_eng.snapshot()
+    del warmup_eng
+
+    throughputs = {thread_num: benchmark_thread_num(config_file, thread_num, num_steps, archive)
+                   for thread_num in candidate_thread_nums(max_thread_num)}
+    best = max(throughputs, key=throughputs.get)
+    print("engine steps per second by thread_num:", {k: round(v, 1) for k, v in throughputs.items()},
+          "use", best)
+    _tuned_thread_nums[key] = best
+    return best
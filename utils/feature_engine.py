@@ -0,0 +1,208 @@
+import numpy as np
+from collections.abc import Mapping
+
+# approach (W, E, N, S) that each entering lane turns into, only for 3 x 4 lanes intersection
+TURN_APPROACH_INDEX = [3, 0, 2, 2, 1, 3, 0, 2, 1, 1, 3, 0]
+SEGMENT_OBS_LENGTH = 100
+
+
+class FeatureEngine:
+    """
+    Network-wide computation of Intersection.dic_feature.
+    The lanes of all intersections are mapped to integer indices once, every
+    feature is then computed for all intersections as [num_intersections, num_lanes] arrays.
+    """
+    def __init__(self, list_intersection, lane_index, lane_length, dic_traffic_env_conf):
+        self.list_intersection = list_intersection
+        self.obs_length = dic_traffic_env_conf["OBS_LENGTH"]
+        self.num_lanes = len(lane_index)
+
+        self.entering = np.array([[lane_index[lane] for lane in inter.list_entering_lanes]
+                                  for inter in list_intersection], dtype=np.int64)
+        self.exiting = np.array([[lane_index[lane] for lane in inter.list_exiting_lanes]
+                                 for inter in list_intersection], dtype=np.int64)
+        self.lane_length = np.zeros(self.num_lanes)
+        for lane, ind in lane_index.items():
+            self.lane_length[ind] = lane_length.get(lane, 0.0)
+        self.adjacency_matrix = [inter.adjacency_row for inter in list_intersection]
+
+        self.dic_feature_func = {
+            "cur_phase": self._get_cur_phase,
+            "time_this_phase": self._get_time_this_phase,
+            "lane_num_vehicle": self._get_lane_num_vehicle,
+            "lane_num_vehicle_downstream": self._get_lane_num_vehicle_downstream,
+            "delta_lane_num_vehicle": self._get_delta_lane_num_vehicle,
+            "lane_num_waiting_vehicle_in": self._get_lane_num_waiting_vehicle_in,
+            "lane_num_waiting_vehicle_out": self._get_lane_num_waiting_vehicle_out,
+            "traffic_movement_pressure_queue": self._get_traffic_movement_pressure_queue,
+            "traffic_movement_pressure_queue_efficient": self._get_traffic_movement_pressure_queue_efficient,
+            "traffic_movement_pressure_num": self._get_traffic_movement_pressure_num,
+            "lane_enter_running_part": self._get_lane_enter_running_part,
+            "pressure": self._get_pressure,
+            "adjacency_matrix": self._get_adjacency_matrix,
+            "num_in_seg_attend": self._get_num_in_seg_attend,
+        }
+        self.list_feature = list(self.dic_feature_func.keys())
+
+        self.snapshot = None
+        self._cache = {}
+
+    def update(self, snapshot):
+        """bind the snapshot of the current tick and drop the arrays of the previous one"""
+        self.snapshot = snapshot
+        self._cache = {}
+
+    def _memo(self, key, func):
+        if key not in self._cache:
+            self._cache[key] = func()
+        return self._cache[key]
+
+    def get_feature_array(self, feature_name):
+        return self._memo(feature_name, self.dic_feature_func[feature_name])
+
+    def get_feature_list(self, feature_name):
+        def _func():
+            values = self.get_feature_array(feature_name)
+            return values.tolist() if isinstance(values, np.ndarray) else values
+        return self._memo(("list", feature_name), _func)
+
+    def compute(self, list_feature=None):
+        """
+        return: List[Dict{feature_name: list}] in the order of list_intersection
+        """
+        if list_feature is None:
+            list_feature = self.list_feature
+        list_dic_feature = [{} for _ in self.list_intersection]
+        for feature_name in list_feature:
+            values = self.get_feature_list(feature_name)
+            for dic_feature, value in zip(list_dic_feature, values):
+                dic_feature[feature_name] = value
+        return list_dic_feature
+
+    # ================= lane level arrays ======================
+    def _lane_num_vehicle(self):
+        lane_vehicles = self.snapshot.lane_vehicles
+        return self._memo("_lane_num_vehicle", lambda: np.fromiter(
+            (len(lane_vehicles[lane]) for lane in self.snapshot.lane_ids), dtype=np.int64, count=self.num_lanes))
+
+    def _lane_num_waiting(self):
+        lane_waiting = self.snapshot.lane_waiting_vehicle_count
+        return self._memo("_lane_num_waiting", lambda: np.fromiter(
+            (lane_waiting[lane] for lane in self.snapshot.lane_ids), dtype=np.int64, count=self.num_lanes))
+
+    def _entry_state(self):
+        def _func():
+            snapshot = self.snapshot
+            return (snapshot.distance[snapshot.entry_vehicle], snapshot.speed[snapshot.entry_vehicle],
+                    self.lane_length[snapshot.entry_lane])
+        return self._memo("_entry_state", _func)
+
+    def _lane_count(self, mask):
+        return np.bincount(self.snapshot.entry_lane[mask], minlength=self.num_lanes)
+
+    def _last_part_counts(self):
+        """number of vehicles and queuing vehicles in the last obs_length of each lane"""
+        def _func():
+            distance, speed, length = self._entry_state()
+            last_part = distance >= length - self.obs_length
+            return self._lane_count(last_part), self._lane_count(last_part & (speed <= 0.1))
+        return self._memo("_last_part_counts", _func)
+
+    def _segment_counts(self):
+        """running vehicles in three segments of 100m from the end of each lane, without shadows"""
+        def _func():
+            distance, speed, length = self._entry_state()
+            running = ~self.snapshot.entry_shadow & (speed > 0.1)
+            part1 = running & (distance > length - SEGMENT_OBS_LENGTH)
+            part2 = running & (length - 2 * SEGMENT_OBS_LENGTH < distance) & (distance <= length - SEGMENT_OBS_LENGTH)
+            part3 = running & (length - 3 * SEGMENT_OBS_LENGTH < distance) & \
+                (distance <= length - 2 * SEGMENT_OBS_LENGTH)
+            return [self._lane_count(part).astype(np.float64) for part in (part1, part2, part3)]
+        return self._memo("_segment_counts", _func)
+
+    @staticmethod
+    def _movement_pressure(enterings, exitings, exiting_factor=1):
+        outs = exitings.reshape(exitings.shape[0], 4, -1).sum(axis=-1)[:, TURN_APPROACH_INDEX]
+        if exiting_factor != 1:
+            outs = outs / exiting_factor
+        return enterings - outs
+
+    # ================= features ======================
+    def _get_cur_phase(self):
+        return [[inter.current_phase_index] for inter in self.list_intersection]
+
+    def _get_time_this_phase(self):
+        return [[inter.current_phase_duration] for inter in self.list_intersection]
+
+    def _get_lane_num_vehicle(self):
+        return self._lane_num_vehicle()[self.entering]
+
+    def _get_lane_num_vehicle_downstream(self):
+        return self._lane_num_vehicle()[self.exiting]
+
+    def _get_delta_lane_num_vehicle(self):
+        return self.get_feature_array("lane_num_vehicle") - self.get_feature_array("lane_num_vehicle_downstream")
+
+    def _get_lane_num_waiting_vehicle_in(self):
+        return self._lane_num_waiting()[self.entering]
+
+    def _get_lane_num_waiting_vehicle_out(self):
+        return self._lane_num_waiting()[self.exiting]
+
+    def _get_traffic_movement_pressure_queue(self):
+        return self._movement_pressure(self.get_feature_array("lane_num_waiting_vehicle_in"),
+                                       self.get_feature_array("lane_num_waiting_vehicle_out"))
+
+    def _get_traffic_movement_pressure_queue_efficient(self):
+        return self._movement_pressure(self.get_feature_array("lane_num_waiting_vehicle_in"),
+                                       self.get_feature_array("lane_num_waiting_vehicle_out"), exiting_factor=3)
+
+    def _get_traffic_movement_pressure_num(self):
+        return self._movement_pressure(self.get_feature_array("lane_num_vehicle"),
+                                       self.get_feature_array("lane_num_vehicle_downstream"))
+
+    def _get_lane_enter_running_part(self):
+        last_num, last_queue = self._last_part_counts()
+        return last_num[self.entering] - last_queue[self.entering]
+
+    def _get_pressure(self):
+        return np.concatenate([self.get_feature_array("lane_num_waiting_vehicle_in"),
+                               -self.get_feature_array("lane_num_waiting_vehicle_out")], axis=1)
+
+    def _get_adjacency_matrix(self):
+        return self.adjacency_matrix
+
+    def _get_num_in_seg_attend(self):
+        parts = self._segment_counts()
+        num_inter = len(self.list_intersection)
+        total_in = np.stack([part[self.entering] for part in parts] +
+                            [self.get_feature_array("lane_num_waiting_vehicle_in")], axis=-1)
+        total_out = np.stack([part[self.exiting] for part in parts] +
+                             [self.get_feature_array("lane_num_waiting_vehicle_out")], axis=-1)
+        return np.concatenate([total_in.reshape(num_inter, -1), total_out.reshape(num_inter, -1)], axis=1)
+
+
+class LazyFeatureDict(Mapping):
+    """
+    dic_feature of one intersection in lazy mode.
+    A feature is computed for the whole network on first access and memoized for the tick,
+    materialize() returns the plain dict of the features the run actually needs.
+    """
+    def __init__(self, feature_engine, inter_ind, list_required_feature):
+        self.feature_engine = feature_engine
+        self.inter_ind = inter_ind
+        self.list_required_feature = list_required_feature
+
+    def __getitem__(self, feature_name):
+        if feature_name not in self.feature_engine.dic_feature_func:
+            raise KeyError(feature_name)
+        return self.feature_engine.get_feature_list(feature_name)[self.inter_ind]
+
+    def __iter__(self):
+        return iter(self.feature_engine.list_feature)
+
+    def __len__(self):
+        return len(self.feature_engine.list_feature)
+
+    def materialize(self):
+        return {feature_name: self[feature_name] for feature_name in self.list_required_feature}
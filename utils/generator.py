@@ -5,8 +5,7 @@ import os
 import copy
 import numpy as np
 import pickle
-from copy import deepcopy
-from utils.my_utils import get_state_detail, getPrompt, state2text, action2code, four_phase_list
+from utils.my_utils import getPrompt, state2text, action2code, four_phase_list
 import re
 from tqdm import tqdm
 
@@ -87,10 +86,7 @@ class Generator:
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
 
             state = next_state
         running_time = time.time() - running_start_time
@@ -160,7 +156,8 @@ class Generator_LLMLight:
             dic_path=dic_path
         )
 
-    def generate(self, logger, tokenizer, llm_model, generation_kwargs):
+    def generate(self, logger, tokenizer, llm_model, generation_kwargs, prefix_cache=None):
+        """prefix_cache: optional PromptPrefixCache of llm_model, only the state part of the prompts is prefilled"""
 
         reset_env_start_time = time.time()
         done = False
@@ -179,11 +176,10 @@ class Generator_LLMLight:
             current_states = []
             action_list = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 current_states.append(statistic_state)
 
             prompts = []
@@ -194,16 +190,19 @@ class Generator_LLMLight:
 
                 prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
                 prompts.append(prompt)
-            inputs = tokenizer(prompts, truncation=True, max_length=2048, padding=True, return_tensors='pt').to('cuda')
-
-            response_ids = llm_model.generate(input_ids=inputs["input_ids"], **generation_kwargs)
+            if prefix_cache is not None:
+                response_ids = prefix_cache.generate([state2text(s) for s in current_states], **generation_kwargs)
+            else:
+                inputs = tokenizer(prompts, truncation=True, max_length=2048, padding=True, return_tensors='pt').to('cuda')
+                response_ids = llm_model.generate(input_ids=inputs["input_ids"], **generation_kwargs)
+                # the generated ids after the prompt
+                response_ids = response_ids[:, inputs["input_ids"].shape[1]:]
             responses = tokenizer.batch_decode(response_ids, skip_special_tokens=True)
 
             fail_num = 0
             fail_flags = [False for _ in responses]
             vehicle_nums = self.get_vehicle_num(current_states)
             for i, res in enumerate(responses):
-                res = res[len(prompts[i]):]
                 signal_answer_pattern = r'<signal>(.*?)</signal>'
                 signals = re.findall(signal_answer_pattern, res)
                 signal_text = signals[-1] if len(signals) > 0 else "ETWT"
@@ -242,10 +241,7 @@ class Generator_LLMLight:
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
 
             state = next_state
             step_num += 1
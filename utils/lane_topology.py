@@ -0,0 +1,59 @@
+import numpy as np
+from .my_utils import location_dict_short
+
+
+def _read_only(values, dtype):
+    array = np.array(values, dtype=dtype)
+    array.flags.writeable = False
+    return array
+
+
+class LaneTopology:
+    """
+    Lane layout of one intersection for the LLM statistic state, compiled once from intersection_dict roads.
+    groups are the (is_incoming, key) entries of statistic_state / statistic_state_incoming, lanes are listed
+    in the order get_state_detail visits them with their group, road length and cell boundaries.
+    The arrays are read-only so the topology is shared by all consumers without copying.
+    """
+    def __init__(self, roads):
+        groups = {}
+        lanes = []      # [(lane_id, group, is_outgoing, road_length)]
+        for r in roads:
+            location = roads[r]["location"]
+            road_length = float(roads[r]["length"])
+            if roads[r]["type"] == "outgoing":
+                straight_lanes = [f"{r}_{idx}" for idx in roads[r]["lanes"]["go_straight"]]
+                left_lanes = [f"{r}_{idx}" for idx in roads[r]["lanes"]["turn_left"]]
+                straight_group = {"queue": straight_lanes, "wait": None}
+                left_group = {"queue": left_lanes, "wait": None}
+                if roads[r]["go_straight"] is not None:
+                    groups[(False, f"{location_dict_short[location]}T")] = straight_group
+                if roads[r]["turn_left"] is not None:
+                    groups[(False, f"{location_dict_short[location]}L")] = left_group
+                # a lane shared by both movements is visited twice and counted in the straight group
+                for lane in straight_lanes + left_lanes:
+                    group = straight_group if lane in straight_lanes else left_group
+                    group["wait"] = len(lanes)
+                    lanes.append((lane, group, True, road_length))
+            else:
+                group = {"queue": [f"{r}_{idx}" for idx in range(2)], "wait": None}
+                groups[(True, location_dict_short[location])] = group
+                for lane in group["queue"]:
+                    lanes.append((lane, group, False, road_length))
+
+        # a group re-created by a later road replaces the earlier one, whose lanes only count for the speed
+        group_index = {id(group): i for i, group in enumerate(groups.values())}
+        self.groups = tuple(groups.keys())
+        self.num_groups = len(self.groups)
+        self.lane_ids = tuple(lane for lane, _, _, _ in lanes)
+        self.lane_group = _read_only([group_index.get(id(group), -1) for _, group, _, _ in lanes], np.int64)
+        self.lane_outgoing = _read_only([is_outgoing for _, _, is_outgoing, _ in lanes], bool)
+        self.lane_length = _read_only([road_length for _, _, _, road_length in lanes], np.float64)
+        # lane_pos above the i-th bound falls in cell i + 1
+        self.segment_bounds = _read_only([[length / 10, length / 3, (length / 3) * 2] for length in self.lane_length],
+                                         np.float64).reshape(-1, 3)
+        self.queue_lane_ids = tuple(lane for group in groups.values() for lane in group["queue"])
+        self.queue_group = _read_only([i for i, group in enumerate(groups.values()) for _ in group["queue"]], np.int64)
+        # avg_wait_time of a group is the one of the last lane visited for it
+        self.wait_lane = _read_only([group["wait"] if group["wait"] is not None else -1 for group in groups.values()],
+                                    np.int64)
@@ -1,5 +1,110 @@
 import os
-from openai import OpenAI, AsyncOpenAI
+import re
+import random
+import asyncio
+import threading
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+
+# transient failures worth another attempt, the other errors (bad request, key, model) are raised at once
+RETRYABLE_ERRORS = (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError,
+                    openai.InternalServerError, httpx.TransportError)
+
+
+class LLMClientPool:
+    """
+    One AsyncOpenAI client per endpoint, driven by a long-lived event loop in a background thread.
+    Connections are kept alive across steps, at most max_concurrency requests are in flight, every
+    request has a timeout and requests failed by a RETRYABLE_ERRORS are retried with jittered exponential backoff.
+    Blocking callers (the agents' worker threads) use create(), submit() returns a concurrent Future.
+    stream_until() streams the completion and closes it as soon as the answer is in the text.
+    """
+    def __init__(self, base_url, api_key, max_concurrency=32, timeout=120.0, max_retries=3, backoff=1.0):
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+        self.client = AsyncOpenAI(
+            api_key=api_key,
+            base_url=base_url,
+            timeout=timeout,
+            max_retries=0,
+            http_client=DefaultAsyncHttpxClient(limits=httpx.Limits(max_connections=max_concurrency,
+                                                                    max_keepalive_connections=max_concurrency)),
+        )
+        self.semaphore = asyncio.run_coroutine_threadsafe(self._make_semaphore(), self.loop).result()
+
+    async def _make_semaphore(self):
+        # created inside the loop it is used from
+        return asyncio.Semaphore(self.max_concurrency)
+
+    async def _retry(self, request, **kwargs):
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.semaphore:
+                    return await asyncio.wait_for(request(**kwargs), self.timeout)
+            except RETRYABLE_ERRORS:
+                if attempt == self.max_retries:
+                    raise
+            await asyncio.sleep(self.backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    async def _read_until(self, stop_pattern, **kwargs):
+        stream = await self.client.chat.completions.create(stream=True, **kwargs)
+        text = ""
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    text += chunk.choices[0].delta.content
+                    if re.search(stop_pattern, text):
+                        break
+        finally:
+            # closing the stream aborts the rest of the generation on the server
+            await stream.close()
+        return text
+
+    def submit(self, **kwargs):
+        return asyncio.run_coroutine_threadsafe(self._retry(self.client.chat.completions.create, **kwargs), self.loop)
+
+    def create(self, **kwargs):
+        return self.submit(**kwargs).result()
+
+    def stream_until(self, stop_pattern, **kwargs):
+        """
+        the text of the completion up to the first match of the regex stop_pattern, or the whole text
+        """
+        return asyncio.run_coroutine_threadsafe(self._retry(self._read_until, stop_pattern=stop_pattern, **kwargs),
+                                                self.loop).result()
+
+    def close(self):
+        asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+
+
+_client_pools = {}
+_client_pools_lock = threading.Lock()
+
+
+def get_client_pool(base_url=None, api_key=None):
+    """the shared LLMClientPool of an endpoint, configured by the LLM_API_* environment variables"""
+    if base_url is None:
+        base_url = os.environ.get("TRAFFICR1_BASE_URL", "http://127.0.0.1:8000/v1")
+    if api_key is None:
+        api_key = "sk--"
+    with _client_pools_lock:
+        if (base_url, api_key) not in _client_pools:
+            _client_pools[(base_url, api_key)] = LLMClientPool(
+                base_url, api_key,
+                max_concurrency=int(os.environ.get("LLM_API_MAX_CONCURRENCY", 32)),
+                timeout=float(os.environ.get("LLM_API_TIMEOUT", 120)),
+                max_retries=int(os.environ.get("LLM_API_MAX_RETRIES", 3)),
+            )
+        return _client_pools[(base_url, api_key)]
 
 
 def create_chat_completion(
@@ -9,11 +114,7 @@ def create_chat_completion(
     max_tokens: int = 1000,
     **kwargs,
 ):
-    client = OpenAI(
-        api_key="sk--",
-        base_url=os.environ.get("TRAFFICR1_BASE_URL", "http://127.0.0.1:8000/v1"),
-    )
-    response = client.chat.completions.create(
+    return get_client_pool().create(
         model=model,
         messages=messages,
         temperature=temperature,
@@ -21,4 +122,21 @@ def create_chat_completion(
         stream=False,
         **kwargs,
     )
-    return response
+
+
+def stream_chat_completion(
+    model: str,
+    messages: list,
+    stop_pattern: str,
+    temperature: float = 0.7,
+    max_tokens: int = 1000,
+    **kwargs,
+) -> str:
+    return get_client_pool().stream_until(
+        stop_pattern,
+        model=model,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens,
+        **kwargs,
+    )
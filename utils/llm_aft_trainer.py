@@ -1,11 +1,17 @@
-from utils.my_utils import dump_json, get_state_detail, state2text, getPrompt, action2code, code2action, eight_phase_list, four_phase_list, torch_gc
-import vllm
+from utils.my_utils import dump_json, state2text, getPrompt, action2code, code2action, eight_phase_list, four_phase_list, torch_gc
 import os
 import time
 import numpy as np
 import wandb
 from utils.cityflow_env import CityFlowEnv
 import utils.config as config
+from utils.log_writer import JsonlLogWriter, to_jsonl_file
+from utils.decision_server import DecisionServer, VLLMBackend, LocalBackend
+from utils.prompt_cache import PromptPrefixCache
+from utils.decision_cache import get_decision_cache
+from utils.decision_pipeline import DecisionPipeline
+from utils.vector_env import VectorCityFlowEnv, make_vector_env_kwargs, queue_length, average_travel_time
+from utils.action_decoding import PhaseScorer, HFAnswerScorer
 from utils.aft_rank_loss_utils import *
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from peft import LoraConfig, get_peft_model
@@ -78,8 +84,9 @@ class LLM_CGPR_Collector:
         self.trainer_built = False
         self.trainer = None
         self.device = None
+        self.prefix_cache = None
         self.fail_log_file = f"./fails/{self.dic_agent_conf['LLM_MODEL']}-{self.dic_traffic_env_conf['TRAFFIC_FILE']}-{self.dic_traffic_env_conf['ROADNET_FILE']}.json"
-        self.fail_logs = []
+        self.fail_log_writer = JsonlLogWriter(to_jsonl_file(self.fail_log_file), legacy_file=self.fail_log_file)
         self.data_buffer = []
         self.initialize()
 
@@ -113,6 +120,8 @@ class LLM_CGPR_Collector:
             "num_beams": 4,
             "num_return_sequences": 4
         }
+        if self.dic_agent_conf.get("PREFIX_CACHING", True):
+            self.prefix_cache = PromptPrefixCache(self.tokenizer, llm_model=self.llm_model)
 
     def initialize_critic(self):
         round_num = 99
@@ -192,11 +201,10 @@ class LLM_CGPR_Collector:
             action_list = []
             current_states = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming,
                                             "approaching_speed": mean_speed})
                 current_states.append(statistic_state)
@@ -206,9 +214,14 @@ class LLM_CGPR_Collector:
                 prompt = getPrompt(state2text(s))
                 prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
                 prompts.append(prompt)
-            inputs = self.tokenizer(prompts, return_tensors="pt", padding="longest")['input_ids'].to('cuda')
-
-            response_ids = self.llm_model.generate(input_ids=inputs, **self.generation_kwargs)
+            if self.prefix_cache is not None:
+                response_ids = self.prefix_cache.generate([state2text(s) for s in current_states],
+                                                          **self.generation_kwargs)
+            else:
+                inputs = self.tokenizer(prompts, return_tensors="pt", padding="longest")['input_ids'].to('cuda')
+                response_ids = self.llm_model.generate(input_ids=inputs, **self.generation_kwargs)
+                # the generated ids after the prompt
+                response_ids = response_ids[:, inputs.shape[1]:]
             response_ids = response_ids.reshape(-1, 4, response_ids.size(1))
             responses = []
             for i in range(response_ids.size(0)):
@@ -221,7 +234,7 @@ class LLM_CGPR_Collector:
             fail_num = 0
             vehicle_nums = self.get_vehicle_num(current_states)
             for i, res in enumerate(responses):
-                action_response = responses[i][random.randint(0, 3)][len(prompts[i]):]
+                action_response = responses[i][random.randint(0, 3)]
                 signal_answer_pattern = r'<signal>(.*?)</signal>'
                 signals = re.findall(signal_answer_pattern, action_response)
                 signal_text = signals[-1] if len(signals) > 0 else "ETWT"
@@ -229,8 +242,7 @@ class LLM_CGPR_Collector:
                 if len(signals) == 0 or signal_text not in four_phase_list:
                     signal_text = "ETWT"
                     if vehicle_nums[i] != 0:
-                        self.fail_logs.append({"state": current_states[i], "response": action_response})
-                        dump_json(self.fail_logs, self.fail_log_file)
+                        self.fail_log_writer.append({"state": current_states[i], "response": action_response})
                         fail_num += 1
 
                 # critic agents
@@ -243,7 +255,7 @@ class LLM_CGPR_Collector:
                 prompt_responses = []
                 sampled_rewards = []
                 for res_i in range(4):
-                    sampled_response = res[res_i][len(prompts[i]):]
+                    sampled_response = res[res_i]
                     sampled_signals = re.findall(signal_answer_pattern, sampled_response)
                     sampled_signal_text = sampled_signals[-1] if len(sampled_signals) > 0 else "ETWT"
                     if len(sampled_signals) == 0 or sampled_signal_text not in four_phase_list:
@@ -287,10 +299,7 @@ class LLM_CGPR_Collector:
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
 
             if not os.path.exists("./data/cgpr"):
                 os.makedirs("./data/cgpr")
@@ -327,6 +336,7 @@ class LLM_CGPR_Collector:
 
         print("Collection time: ", time.time() - start_time)
         self.env.batch_log_2()
+        self.fail_log_writer.export_legacy()
 
         if not os.path.exists("./data/cgpr"):
             os.makedirs("./data/cgpr")
@@ -372,9 +382,10 @@ class LLM_CGPR_Trainer:
         self.training_args = None
         self.trainer_built = False
         self.trainer = None
+        self.early_stop_kwargs = {}
         self.device = None
         self.fail_log_file = f"./fails/{self.dic_agent_conf['LLM_MODEL']}-{self.dic_traffic_env_conf['TRAFFIC_FILE']}-{self.dic_traffic_env_conf['ROADNET_FILE']}.json"
-        self.fail_logs = []
+        self.fail_log_writer = JsonlLogWriter(to_jsonl_file(self.fail_log_file), legacy_file=self.fail_log_file)
         self.initialize()
 
     def initialize_llm(self):
@@ -434,6 +445,10 @@ class LLM_CGPR_Trainer:
             "pad_token_id": self.tokenizer.pad_token_id,
             "eos_token_id": self.tokenizer.eos_token_id
         }
+        # stop each sequence once its signal tag is closed, the rest of the response is not parsed
+        self.early_stop_kwargs = {}
+        if self.dic_agent_conf.get("EARLY_STOP", False):
+            self.early_stop_kwargs = {"stop_strings": ["</signal>"], "tokenizer": self.tokenizer}
 
     def initialize(self):
         path_check(self.dic_path)
@@ -487,11 +502,10 @@ class LLM_CGPR_Trainer:
             action_list = []
             current_states = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming,
                                             "approaching_speed": mean_speed})
                 current_states.append(statistic_state)
@@ -503,13 +517,15 @@ class LLM_CGPR_Trainer:
                 prompts.append(prompt)
             inputs = self.tokenizer(prompts, truncation=True, max_length=2048, padding=True, return_tensors='pt').to('cuda')
 
-            response_ids = self.llm_model.generate(input_ids=inputs["input_ids"], **self.test_generation_kwargs)
+            response_ids = self.llm_model.generate(input_ids=inputs["input_ids"], **self.test_generation_kwargs,
+                                                   **self.early_stop_kwargs)
+            # the generated ids after the prompt
+            response_ids = response_ids[:, inputs["input_ids"].shape[1]:]
             responses = self.tokenizer.batch_decode(response_ids, skip_special_tokens=True)
 
             fail_num = 0
             vehicle_nums = self.get_vehicle_num(current_states)
             for i, res in enumerate(responses):
-                res = res[len(prompts[i]):]
                 signal_answer_pattern = r'<signal>(.*?)</signal>'
                 signals = re.findall(signal_answer_pattern, res)
                 signal_text = signals[-1] if len(signals) > 0 else "ETWT"
@@ -517,8 +533,7 @@ class LLM_CGPR_Trainer:
                 if len(signals) == 0 or signal_text not in four_phase_list:
                     signal_text = "ETWT"
                     if vehicle_nums[i] != 0:
-                        self.fail_logs.append({"state": current_states[i], "response": res})
-                        dump_json(self.fail_logs, self.fail_log_file)
+                        self.fail_log_writer.append({"state": current_states[i], "response": res})
                         fail_num += 1
 
             next_state, rewards, done, _ = self.env.step(action_list)
@@ -539,10 +554,7 @@ class LLM_CGPR_Trainer:
             print("Fail Num:", fail_num, "Queuing Vehicles:", sum(queue_length_episode))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
 
         # wandb logger
         vehicle_travel_times = {}
@@ -575,6 +587,7 @@ class LLM_CGPR_Trainer:
         print("Testing time: ", time.time() - start_time)
 
         self.env.batch_log_2()
+        self.fail_log_writer.export_legacy()
 
         return results
 
@@ -657,11 +670,16 @@ class LLM_Inference:
         self.trainer_built = False
         self.trainer = None
         self.device = None
+        self.prefix_cache = None
+        self.early_stop_kwargs = {}
+        self.decoding_mode = "free"
+        self.phase_scorer = None
+        self.decision_cache = get_decision_cache(self.dic_agent_conf.get("DECISION_CACHE", None))
 
         if not os.path.exists("./fails"):
             os.mkdir("./fails")
         self.fail_log_file = f"./fails/{self.dic_agent_conf['LLM_MODEL']}-{self.dic_traffic_env_conf['TRAFFIC_FILE']}-{self.dic_traffic_env_conf['ROADNET_FILE']}.json"
-        self.fail_logs = []
+        self.fail_log_writer = JsonlLogWriter(to_jsonl_file(self.fail_log_file), legacy_file=self.fail_log_file)
         self.initialize()
 
     def initialize_llm(self):
@@ -693,6 +711,19 @@ class LLM_Inference:
             "pad_token_id": self.tokenizer.pad_token_id,
             "eos_token_id": self.tokenizer.eos_token_id
         }
+        # stop each sequence once its signal tag is closed, the rest of the response is not parsed
+        self.early_stop_kwargs = {}
+        if self.dic_agent_conf.get("EARLY_STOP", False):
+            self.early_stop_kwargs = {"stop_strings": ["</signal>"], "tokenizer": self.tokenizer}
+        self.decoding_mode = self.dic_agent_conf.get("DECODING_MODE", "free")
+        if self.decoding_mode != "free":
+            self.phase_scorer = PhaseScorer(self.tokenizer, four_phase_list,
+                                            HFAnswerScorer(self.llm_model, self.tokenizer.pad_token_id))
+        if self.decoding_mode == "constrained":
+            # the reasoning stops at the opening signal tag, the phase after it is picked by phase_scorer
+            self.early_stop_kwargs = {"stop_strings": ["<signal>"], "tokenizer": self.tokenizer}
+        if self.dic_agent_conf.get("PREFIX_CACHING", True):
+            self.prefix_cache = PromptPrefixCache(self.tokenizer, llm_model=self.llm_model)
 
     def initialize(self):
         path_check(self.dic_path)
@@ -724,54 +755,26 @@ class LLM_Inference:
         state_action_log = [[] for _ in range(len(state))]
 
         self.llm_model.eval()
+        pipeline = DecisionPipeline(self.decide, lookahead=self.dic_agent_conf.get("PIPELINE_LOOKAHEAD", 0))
         for step_num in tqdm(range(int(total_run_cnt / self.dic_traffic_env_conf['MIN_ACTION_TIME']))):
             if done or current_time >= total_run_cnt:
                 break
-            action_list = []
             current_states = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming,
                                             "approaching_speed": mean_speed})
                 current_states.append(statistic_state)
 
-            prompts = []
-            for s in current_states:
-                prompt = getPrompt(state2text(s))
-                prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
-                prompts.append(prompt)
-            inputs = self.tokenizer(prompts, truncation=True, max_length=2048, padding=True, return_tensors='pt').to('cuda')
-
-            responses = []
-            previous_flag = 0
-            for i in range(len(current_states)):
-                if (i + 1) % 16 == 0 or i + 1 >= len(current_states):
-                    response_ids = self.llm_model.generate(input_ids=inputs["input_ids"][previous_flag:i+1], **self.test_generation_kwargs)
-                    responses += self.tokenizer.batch_decode(response_ids, skip_special_tokens=True)
-                    previous_flag = i + 1
-
-            fail_num = 0
-            vehicle_nums = self.get_vehicle_num(current_states)
-            critic_actions = []
-            for i, res in enumerate(responses):
-                res = res[len(prompts[i]):]
-                signal_answer_pattern = r'<signal>(.*?)</signal>'
-                signals = re.findall(signal_answer_pattern, res)
-                signal_text = signals[-1] if len(signals) > 0 else "ETWT"
-                action_list.append(action2code(signal_text) if signal_text in four_phase_list else 0)
-                if len(signals) == 0 or signal_text not in four_phase_list:
-                    signal_text = "ETWT"
-                    if vehicle_nums[i] != 0:
-                        self.fail_logs.append({"state": current_states[i], "response": res})
-                        dump_json(self.fail_logs, self.fail_log_file)
-                        fail_num += 1
-
-                state_action_log[i][-1]["response"] = res
-                state_action_log[i][-1]["action"] = eight_phase_list[action_list[i]]
+            action_list, fail_num = pipeline.actions(current_states, [log[-1] for log in state_action_log])
+            for i in range(len(state)):
+                # decide() logged the action with its response, with PIPELINE_LOOKAHEAD the one applied now
+                # was decided on the state of an earlier step
+                state_action_log[i][-1]["applied_action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_decision_step"] = pipeline.applied_step
 
             next_state, _, done, _ = self.env.step(action_list)
             rewards = self.get_norm_reward(next_state)  # my reward
@@ -788,10 +791,9 @@ class LLM_Inference:
             print("Fail Num:", fail_num, "Queuing Vehicles:", sum(queue_length_episode))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
+
+        pipeline.close()
 
         # wandb logger
         vehicle_travel_times = {}
@@ -818,12 +820,16 @@ class LLM_Inference:
             "test_avg_waiting_time_over": np.mean(waiting_time_episode) if len(queue_length_episode) > 0 else 0,
             "test_avg_travel_time_over": total_travel_time}
         logger.log(results)
+        if self.decision_cache is not None:
+            self.decision_cache.flush()
+            logger.log(self.decision_cache.stats())
         print("Test Round:", test_round, results)
         f_state_action = os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"], "state_action.json")
         dump_json(state_action_log, f_state_action)
         print("Testing time: ", time.time() - start_time)
 
         self.env.batch_log_2()
+        self.fail_log_writer.export_legacy()
 
         return results
 
@@ -839,6 +845,76 @@ class LLM_Inference:
         self.test(logger, 0)
         wandb.finish()
 
+    def decide(self, current_states, log_entries):
+        """
+        the actions on current_states, the responses and actions are written to log_entries
+        runs in the DecisionPipeline worker when PIPELINE_LOOKAHEAD > 0, so it must not touch the env
+        return: action_list, fail_num
+        """
+        action_list = []
+        prompts = []
+        state_txts = []
+        for s in current_states:
+            state_txts.append(state2text(s))
+            prompt = getPrompt(state_txts[-1])
+            prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
+            prompts.append(prompt)
+        # only the prompts missing from the decision cache go to the model
+        if self.decision_cache is not None:
+            cache_keys = [self.decision_cache.make_key(prompt, self.dic_agent_conf["LLM_PATH"],
+                                                       [self.test_generation_kwargs, self.decoding_mode])
+                          for prompt in prompts]
+            responses = self.decision_cache.get_many(cache_keys)
+        else:
+            responses = [None] * len(prompts)
+        generated = [i for i, res in enumerate(responses) if res is None]
+        if self.prefix_cache is None and len(generated) > 0 and self.decoding_mode != "logprob":
+            inputs = self.tokenizer([prompts[i] for i in generated], truncation=True, max_length=2048, padding=True,
+                                    return_tensors='pt').to('cuda')
+
+        for start in range(0, len(generated), 16):
+            batch = generated[start:start+16]
+            if self.decoding_mode == "logprob":
+                texts = [""] * len(batch)
+            else:
+                if self.prefix_cache is not None:
+                    response_ids = self.prefix_cache.generate([state_txts[i] for i in batch],
+                                                              **self.test_generation_kwargs, **self.early_stop_kwargs)
+                else:
+                    response_ids = self.llm_model.generate(input_ids=inputs["input_ids"][start:start+16],
+                                                           **self.test_generation_kwargs, **self.early_stop_kwargs)
+                    # the generated ids after the prompt
+                    response_ids = response_ids[:, inputs["input_ids"].shape[1]:]
+                texts = self.tokenizer.batch_decode(response_ids, skip_special_tokens=True)
+            if self.decoding_mode != "free":
+                # the answer after the reasoning can only be one of the phases
+                texts = [text.split("<signal>")[0] for text in texts]
+                answers = self.phase_scorer.answers([prompts[i] + text for i, text in zip(batch, texts)])
+                texts = [text + answer for text, answer in zip(texts, answers)]
+            for i, text in zip(batch, texts):
+                responses[i] = text
+
+        fail_num = 0
+        vehicle_nums = self.get_vehicle_num(current_states)
+        critic_actions = []
+        for i, res in enumerate(responses):
+            signal_answer_pattern = r'<signal>(.*?)</signal>'
+            signals = re.findall(signal_answer_pattern, res)
+            signal_text = signals[-1] if len(signals) > 0 else "ETWT"
+            action_list.append(action2code(signal_text) if signal_text in four_phase_list else 0)
+            if len(signals) == 0 or signal_text not in four_phase_list:
+                signal_text = "ETWT"
+                if vehicle_nums[i] != 0:
+                    self.fail_log_writer.append({"state": current_states[i], "response": res})
+                    fail_num += 1
+            elif self.decision_cache is not None:
+                self.decision_cache.put(cache_keys[i], res)
+
+            log_entries[i]["response"] = res
+            log_entries[i]["action"] = eight_phase_list[action_list[i]]
+
+        return action_list, fail_num
+
     '''
     ======================= Class Utils =======================
     '''
@@ -860,13 +936,12 @@ class LLM_Inference:
     def get_norm_reward(self, state):
         rewards = []
 
+        list_state_detail = self.env.get_state_detail()
         for i in range(len(state)):
             vehicle_num = 0
             queue_length = 0
 
-            intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-            roads = deepcopy(intersection["roads"])
-            statistic_state, _, _ = get_state_detail(roads, self.env)
+            statistic_state, _, _ = list_state_detail[i]
             for lane in statistic_state:
                 queue_length += statistic_state[lane]['queue_len']
 
@@ -900,25 +975,24 @@ class LLM_Inference_VLLM:
         self.trainer_built = False
         self.trainer = None
         self.device = None
+        self.decision_server = None
+        self.prefix_cache = None
+        self.decoding_mode = "free"
+        self.phase_scorer = None
+        self.vector_env = None
+        self.decision_cache = get_decision_cache(self.dic_agent_conf.get("DECISION_CACHE", None))
 
         if not os.path.exists("./fails"):
             os.mkdir("./fails")
         self.fail_log_file = f"./fails/{self.dic_agent_conf['LLM_MODEL']}-{self.dic_traffic_env_conf['TRAFFIC_FILE']}-{self.dic_traffic_env_conf['ROADNET_FILE']}.json"
-        self.fail_logs = []
+        self.fail_log_writer = JsonlLogWriter(to_jsonl_file(self.fail_log_file), legacy_file=self.fail_log_file)
         self.initialize()
 
     def initialize_llm(self):
         device_map = "auto"
 
-        # init LLM
-        llm_path = self.dic_agent_conf["LLM_PATH"]
-        self.llm_model = vllm.LLM(
-            model=llm_path,
-            tokenizer=llm_path,
-            dtype=torch.bfloat16
-        )
-
         # init tokenizer
+        llm_path = self.dic_agent_conf["LLM_PATH"]
         self.tokenizer = AutoTokenizer.from_pretrained(
             llm_path,
             padding_side="left",
@@ -932,11 +1006,48 @@ class LLM_Inference_VLLM:
             "temperature": 0.1,
             "max_tokens": 2048 + self.dic_agent_conf["NEW_MAX_TOKENS"]
         }
-        self.generation_kwargs = vllm.SamplingParams(**test_generation_kwargs)
+        if self.dic_agent_conf.get("EARLY_STOP", False):
+            # the engine ends each sequence at its closing signal tag, kept in the text for the parser
+            test_generation_kwargs["stop"] = ["</signal>"]
+            test_generation_kwargs["include_stop_str_in_output"] = True
+        self.decoding_mode = self.dic_agent_conf.get("DECODING_MODE", "free")
+        if self.dic_agent_conf.get("LLM_BACKEND", "vllm") == "local" and self.decoding_mode != "free":
+            print("the local backend has no scores, decoding mode falls back to free")
+            self.decoding_mode = "free"
+        if self.decoding_mode == "constrained":
+            # the reasoning stops at the opening signal tag, the phase after it is picked by phase_scorer
+            test_generation_kwargs["stop"] = ["<signal>"]
+            test_generation_kwargs["include_stop_str_in_output"] = False
+        self.generation_kwargs = test_generation_kwargs
+
+        # init LLM, the decision server mode decides all intersections of a step with one engine call
+        if self.dic_agent_conf.get("LLM_BACKEND", "vllm") == "local":
+            backend = LocalBackend()
+        else:
+            prefix_caching = self.dic_agent_conf.get("PREFIX_CACHING", True)
+            backend = VLLMBackend(llm_path, test_generation_kwargs,
+                                  max_batch_tokens=self.dic_agent_conf.get("MAX_BATCH_TOKENS", None),
+                                  max_batch_seqs=self.dic_agent_conf.get("MAX_BATCH_SEQS", 256),
+                                  enable_prefix_caching=prefix_caching)
+            self.llm_model = backend.llm
+            if prefix_caching:
+                # the engine reuses the KV blocks of the shared prefix, prompts are handed over as token ids
+                self.prefix_cache = PromptPrefixCache(self.tokenizer)
+            if self.decoding_mode != "free":
+                self.phase_scorer = PhaseScorer(self.tokenizer, four_phase_list, backend.score)
+        max_batch_prompts = None if self.dic_agent_conf.get("DECISION_SERVER", False) else 16
+        self.decision_server = DecisionServer(backend, max_batch_prompts=max_batch_prompts)
 
     def initialize(self):
         path_check(self.dic_path)
         copy_conf_file(self.dic_path, self.dic_agent_conf, self.dic_traffic_env_conf)
+        num_envs = self.dic_traffic_env_conf.get("NUM_ENVS", 1)
+        if num_envs > 1:
+            # the env workers are forked before the engine takes the GPU
+            self.vector_env = VectorCityFlowEnv(make_vector_env_kwargs(self.dic_path, self.dic_traffic_env_conf,
+                                                                       num_envs))
+            self.initialize_llm()
+            return
         copy_cityflow_file(self.dic_path, self.dic_traffic_env_conf)
 
         self.env = CityFlowEnv(
@@ -963,53 +1074,26 @@ class LLM_Inference_VLLM:
         start_time = time.time()
         state_action_log = [[] for _ in range(len(state))]
 
-        self.llm_model.eval()
+        pipeline = DecisionPipeline(self.decide, lookahead=self.dic_agent_conf.get("PIPELINE_LOOKAHEAD", 0))
         for step_num in tqdm(range(int(total_run_cnt / self.dic_traffic_env_conf['MIN_ACTION_TIME']))):
             if done or current_time >= total_run_cnt:
                 break
-            action_list = []
             current_states = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming,
                                             "approaching_speed": mean_speed})
                 current_states.append(statistic_state)
 
-            prompts = []
-            for s in current_states:
-                prompt = getPrompt(state2text(s))
-                prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
-                prompts.append(prompt)
-
-            responses = []
-            previous_flag = 0
-            for i in range(len(current_states)):
-                if (i + 1) % 16 == 0 or i + 1 >= len(current_states):
-                    responses_meta = self.llm_model.generate(prompts=prompts[previous_flag:i+1], sampling_params=self.generation_kwargs)
-                    responses += [res.outputs[0].text for res in responses_meta]
-                    previous_flag = i + 1
-
-            fail_num = 0
-            vehicle_nums = self.get_vehicle_num(current_states)
-            for i, res in enumerate(responses):
-                res = res[len(prompts[i]):]
-                signal_answer_pattern = r'<signal>(.*?)</signal>'
-                signals = re.findall(signal_answer_pattern, res)
-                signal_text = signals[-1] if len(signals) > 0 else "ETWT"
-                action_list.append(action2code(signal_text) if signal_text in four_phase_list else 0)
-                if len(signals) == 0 or signal_text not in four_phase_list:
-                    signal_text = "ETWT"
-                    if vehicle_nums[i] != 0:
-                        self.fail_logs.append({"state": current_states[i], "response": res})
-                        dump_json(self.fail_logs, self.fail_log_file)
-                        fail_num += 1
-
-                state_action_log[i][-1]["response"] = res
-                state_action_log[i][-1]["action"] = eight_phase_list[action_list[i]]
+            action_list, fail_num = pipeline.actions(current_states, [log[-1] for log in state_action_log])
+            for i in range(len(state)):
+                # decide() logged the action with its response, with PIPELINE_LOOKAHEAD the one applied now
+                # was decided on the state of an earlier step
+                state_action_log[i][-1]["applied_action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_decision_step"] = pipeline.applied_step
 
             next_state, _, done, _ = self.env.step(action_list)
             rewards = self.get_norm_reward(next_state)  # my reward
@@ -1026,10 +1110,9 @@ class LLM_Inference_VLLM:
             print("Fail Num:", fail_num, "Queuing Vehicles:", sum(queue_length_episode))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
+
+        pipeline.close()
 
         # wandb logger
         vehicle_travel_times = {}
@@ -1056,12 +1139,16 @@ class LLM_Inference_VLLM:
             "test_avg_waiting_time_over": np.mean(waiting_time_episode) if len(queue_length_episode) > 0 else 0,
             "test_avg_travel_time_over": total_travel_time}
         logger.log(results)
+        if self.decision_cache is not None:
+            self.decision_cache.flush()
+            logger.log(self.decision_cache.stats())
         print("Test Round:", test_round, results)
         f_state_action = os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"], "state_action.json")
         dump_json(state_action_log, f_state_action)
         print("Testing time: ", time.time() - start_time)
 
         self.env.batch_log_2()
+        self.fail_log_writer.export_legacy()
 
         return results
 
@@ -1074,9 +1161,145 @@ class LLM_Inference_VLLM:
             config=all_config,
         )
 
-        self.test(logger, 0)
+        if self.vector_env is not None:
+            self.test_vector(logger, 0)
+        else:
+            self.test(logger, 0)
         wandb.finish()
 
+    def test_vector(self, logger, test_round):
+        """
+        test on the NUM_ENVS environments of the vector env, the intersections of all environments are decided
+        together by one decide() call per step, the results are averaged over the environments
+        """
+        print("================ Start Vector Test ================")
+        total_run_cnt = self.dic_traffic_env_conf["RUN_COUNTS"]
+        num_envs = self.vector_env.num_envs
+        self.vector_env.reset()
+        num_inters = self.vector_env.num_intersections
+        total_reward = np.zeros(num_envs)
+        queue_length_episode = []
+        waiting_time_episode = []
+
+        start_time = time.time()
+        state_action_logs = [[[] for _ in range(num_inters)] for _ in range(num_envs)]
+
+        pipeline = DecisionPipeline(self.decide, lookahead=self.dic_agent_conf.get("PIPELINE_LOOKAHEAD", 0))
+        list_env_state_detail = self.vector_env.call("get_state_detail")
+        for step_num in tqdm(range(int(total_run_cnt / self.dic_traffic_env_conf['MIN_ACTION_TIME']))):
+            current_states = []
+            log_entries = []
+            for k, list_state_detail in enumerate(list_env_state_detail):
+                for i in range(num_inters):
+                    statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
+                    state_action_logs[k][i].append({"state": statistic_state,
+                                                    "state_incoming": statistic_state_incoming,
+                                                    "approaching_speed": mean_speed})
+                    current_states.append(statistic_state)
+                    log_entries.append(state_action_logs[k][i][-1])
+
+            action_list, fail_num = pipeline.actions(current_states, log_entries)
+            for entry, action in zip(log_entries, action_list):
+                # decide() logged the action with its response, the one applied now may be of an earlier step
+                entry["applied_action"] = eight_phase_list[action]
+                entry["applied_decision_step"] = pipeline.applied_step
+
+            _, _, dones, _ = self.vector_env.step(np.reshape(action_list, (num_envs, num_inters)))
+            list_env_state_detail = self.vector_env.call("get_state_detail")
+            for k, list_state_detail in enumerate(list_env_state_detail):
+                total_reward[k] += sum(self.get_norm_reward(list_state_detail, list_state_detail))
+
+            # calculate logger results, [step][env]
+            queue_length_episode.append(self.vector_env.call(queue_length))
+            print("Fail Num:", fail_num, "Queuing Vehicles:", np.sum(queue_length_episode))
+            waiting_time_episode.append(self.vector_env.call("get_mean_waiting_time"))
+            if dones.all() or min(self.vector_env.call("get_current_time")) >= total_run_cnt:
+                break
+
+        pipeline.close()
+
+        # wandb logger
+        queue_length_episode = np.array(queue_length_episode).reshape(-1, num_envs)
+        waiting_time_episode = np.array(waiting_time_episode).reshape(-1, num_envs)
+        has_steps = len(queue_length_episode) > 0
+        results = {
+            "test_reward_over": np.mean(total_reward),
+            "test_avg_queue_len_over": np.mean(queue_length_episode) if has_steps else 0,
+            "test_queuing_vehicle_num_over": np.sum(queue_length_episode) / num_envs if has_steps else 0,
+            "test_avg_waiting_time_over": np.mean(waiting_time_episode) if has_steps else 0,
+            "test_avg_travel_time_over": np.mean(self.vector_env.call(average_travel_time))}
+        logger.log(results)
+        if self.decision_cache is not None:
+            self.decision_cache.flush()
+            logger.log(self.decision_cache.stats())
+        print("Test Round:", test_round, results)
+        for env_kwargs, state_action_log in zip(self.vector_env.list_env_kwargs, state_action_logs):
+            dump_json(state_action_log, os.path.join(env_kwargs["path_to_work_directory"], "state_action.json"))
+        print("Testing time: ", time.time() - start_time)
+
+        self.vector_env.call("batch_log_2")
+        self.vector_env.close()
+        self.fail_log_writer.export_legacy()
+
+        return results
+
+    def decide(self, current_states, log_entries):
+        """
+        the actions on current_states, the responses and actions are written to log_entries
+        runs in the DecisionPipeline worker when PIPELINE_LOOKAHEAD > 0, so it must not touch the env
+        return: action_list, fail_num
+        """
+        action_list = []
+        prompts = []
+        for s in current_states:
+            prompt = getPrompt(state2text(s))
+            prompt = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
+            prompts.append(prompt)
+
+        # only the prompts missing from the decision cache go to the engine
+        if self.decision_cache is not None:
+            cache_keys = [self.decision_cache.make_key(prompt, self.dic_agent_conf["LLM_PATH"],
+                                                       [self.generation_kwargs, self.decoding_mode])
+                          for prompt in prompts]
+            responses = self.decision_cache.get_many(cache_keys)
+        else:
+            responses = [None] * len(prompts)
+        generated = [i for i, res in enumerate(responses) if res is None]
+        if self.decoding_mode == "logprob":
+            generated_responses = [""] * len(generated)
+        elif self.prefix_cache is not None:
+            generated_responses = self.decision_server.decide(
+                self.prefix_cache.token_ids([state2text(current_states[i]) for i in generated]))
+        else:
+            generated_responses = self.decision_server.decide([prompts[i] for i in generated])
+        if self.decoding_mode != "free":
+            # the answer after the reasoning can only be one of the phases
+            generated_responses = [res.split("<signal>")[0] for res in generated_responses]
+            answers = self.phase_scorer.answers([prompts[i] + res for i, res in zip(generated, generated_responses)])
+            generated_responses = [res + answer for res, answer in zip(generated_responses, answers)]
+        for i, res in zip(generated, generated_responses):
+            responses[i] = res
+
+        fail_num = 0
+        vehicle_nums = self.get_vehicle_num(current_states)
+        for i, res in enumerate(responses):
+            signal_answer_pattern = r'<signal>(.*?)</signal>'
+            signals = re.findall(signal_answer_pattern, res)
+            signal_text = signals[-1] if len(signals) > 0 else "ETWT"
+            action_list.append(action2code(signal_text) if signal_text in four_phase_list else 0)
+            if len(signals) == 0 or signal_text not in four_phase_list:
+                signal_text = "ETWT"
+                if vehicle_nums[i] != 0:
+                    self.fail_log_writer.append({"state": current_states[i], "response": res})
+                    fail_num += 1
+            elif self.decision_cache is not None:
+                self.decision_cache.put(cache_keys[i], res)
+
+            log_entries[i]["response"] = res
+            log_entries[i]["action"] = eight_phase_list[action_list[i]]
+
+        return action_list, fail_num
+
     '''
     ======================= Class Utils =======================
     '''
@@ -1095,16 +1318,16 @@ class LLM_Inference_VLLM:
 
         return veh_nums
 
-    def get_norm_reward(self, state):
+    def get_norm_reward(self, state, list_state_detail=None):
         rewards = []
 
+        if list_state_detail is None:
+            list_state_detail = self.env.get_state_detail()
         for i in range(len(state)):
             vehicle_num = 0
             queue_length = 0
 
-            intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-            roads = deepcopy(intersection["roads"])
-            statistic_state, _, _ = get_state_detail(roads, self.env)
+            statistic_state, _, _ = list_state_detail[i]
             for lane in statistic_state:
                 queue_length += statistic_state[lane]['queue_len']
 
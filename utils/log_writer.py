@@ -0,0 +1,90 @@
+import os
+import json
+
+
+class SignalLogWriter:
+    """
+    Buffered writer of the signal_inter_*.txt logs.
+    Phase changes are kept in memory and appended to the files in bulk every
+    flush_interval simulated seconds and at the end of the episode.
+    """
+    def __init__(self, path_to_log, flush_interval=300):
+        self.path_to_log = path_to_log
+        self.flush_interval = flush_interval
+        self.last_flush_time = 0
+        self.buffer = {}
+
+    def reset(self):
+        self.flush()
+        self.last_flush_time = 0
+
+    def log(self, inter_name, cur_time, phase_index):
+        # same row format as the one-row DataFrame.to_csv it replaces
+        self.buffer.setdefault(inter_name, []).append("{0},{1}\n".format(float(cur_time), float(phase_index)))
+
+    def maybe_flush(self, cur_time):
+        if self.flush_interval is not None and cur_time - self.last_flush_time >= self.flush_interval:
+            self.flush()
+            self.last_flush_time = cur_time
+
+    def flush(self):
+        for inter_name, lines in self.buffer.items():
+            path_to_log_file = os.path.join(self.path_to_log, "signal_inter_{0}.txt".format(inter_name))
+            with open(path_to_log_file, "a") as f:
+                f.writelines(lines)
+        self.buffer = {}
+
+
+def to_jsonl_file(json_file):
+    return os.path.splitext(json_file)[0] + ".jsonl"
+
+
+def jsonl2json(jsonl_file, json_file, indent=None):
+    """convert a JSON lines log into the legacy JSON array file"""
+    records = []
+    if os.path.exists(jsonl_file):
+        with open(jsonl_file, "r") as f:
+            records = [json.loads(line) for line in f if line.strip()]
+    with open(json_file, "w") as f:
+        json.dump(records, f, indent=indent)
+    return records
+
+
+class JsonlLogWriter:
+    """
+    Append-only JSON lines log, one record per line.
+    Every record is flushed to the OS and the file is fsynced every fsync_interval records,
+    export_legacy() writes the records as the JSON array legacy_file used to hold.
+    """
+    def __init__(self, file, legacy_file=None, fsync_interval=100):
+        self.file = file
+        self.legacy_file = legacy_file
+        self.fsync_interval = fsync_interval
+        self.num_unsynced = 0
+        self.f = None
+
+    def append(self, record):
+        if self.f is None:
+            self.f = open(self.file, "w")
+        self.f.write(json.dumps(record) + "\n")
+        self.f.flush()
+        self.num_unsynced += 1
+        if self.num_unsynced >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        if self.f is not None and self.num_unsynced > 0:
+            self.f.flush()
+            os.fsync(self.f.fileno())
+            self.num_unsynced = 0
+
+    def export_legacy(self):
+        self.sync()
+        if self.legacy_file is not None and self.f is not None:
+            jsonl2json(self.file, self.legacy_file)
+
+    def close(self):
+        self.export_legacy()
+        if self.f is not None:
+            self.f.close()
+            self.f = None
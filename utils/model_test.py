@@ -1,7 +1,7 @@
 from .config import DIC_AGENTS
 from copy import deepcopy
 from .cityflow_env import CityFlowEnv
-from .my_utils import get_state, get_state_detail, eight_phase_list
+from .my_utils import get_state, eight_phase_list
 import json
 import os
 import numpy as np
@@ -73,11 +73,10 @@ def test(model_dir, data_dir, cnt_round, run_cnt, _dic_traffic_env_conf, logger)
                     action_list.append(action)
 
             # log statistic state & action
+            list_state_detail = env.get_state_detail()
             for i in range(dic_traffic_env_conf['NUM_INTERSECTIONS']):
                 # log
-                intersection = env.intersection_dict[env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming,
                                             "approaching_speed": mean_speed, "action": eight_phase_list[action_list[i]]})
 
@@ -93,10 +92,7 @@ def test(model_dir, data_dir, cnt_round, run_cnt, _dic_traffic_env_conf, logger)
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in env.waiting_vehicle_list:
-                waiting_times.append(env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(env.get_mean_waiting_time())
 
         # wandb logger
         vehicle_travel_times = {}
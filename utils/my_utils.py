@@ -55,8 +55,8 @@ def get_state(roads, env):
     """
     Retrieve the state of the intersection from sumo, in the form of cell occupancy
     """
-    lane_queues = env.eng.get_lane_waiting_vehicle_count()
-    lane_vehicles = env.eng.get_lane_vehicles()
+    lane_queues = env.vehicle_snapshot.lane_waiting_vehicle_count
+    lane_vehicles = env.vehicle_snapshot.lane_vehicles
 
     # init statistic info & get queue info
     statistic_state = {}
@@ -116,8 +116,8 @@ def get_state(roads, env):
 
                 # collect lane cell info
                 for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
+                    veh_speed, veh_distance = env.vehicle_snapshot.get_vehicle_state(veh)
+                    lane_pos = road_length - veh_distance
 
                     # update statistic state
                     if lane_pos <= road_length / 10:
@@ -128,7 +128,7 @@ def get_state(roads, env):
                         gpt_lane_cell = 2
 
                     # speed > 0.1 m/s are approaching vehicles
-                    if float(veh_info["speed"]) > 0.1:
+                    if veh_speed > 0.1:
                         statistic_state[location_direction_dict[lane_group]]["cells"][gpt_lane_cell] += 1
 
         # incoming lanes
@@ -156,8 +156,8 @@ def get_state(roads, env):
 
                 # collect lane cell info
                 for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
+                    veh_speed, veh_distance = env.vehicle_snapshot.get_vehicle_state(veh)
+                    lane_pos = road_length - veh_distance
 
                     # update statistic state
                     if lane_pos <= road_length / 10:
@@ -168,158 +168,17 @@ def get_state(roads, env):
                         gpt_lane_cell = 2
 
                     # speed > 0.1 m/s are approaching vehicles
-                    if float(veh_info["speed"]) > 0.1:
+                    if veh_speed > 0.1:
                         statistic_state_incoming[location_incoming_dict[lane_group]]["cells"][gpt_lane_cell] += 1
 
     return statistic_state, statistic_state_incoming
 
-def get_state_detail(roads, env):
-    """
-    Retrieve the state of the intersection from sumo, in the form of cell occupancy
-    """
-    lane_queues = env.eng.get_lane_waiting_vehicle_count()
-    lane_vehicles = env.eng.get_lane_vehicles()
-
-    # init statistic info & get queue info
-    statistic_state = {}
-    statistic_state_incoming = {}
-    outgoing_lane_speeds = []
-    for r in roads:
-        # road info
-        location = roads[r]["location"]
-        road_length = float(roads[r]["length"])
-
-        # get queue info
-        if roads[r]["type"] == "outgoing":
-            if roads[r]["go_straight"] is not None:
-                queue_len = 0.0
-                for lane in roads[r]["lanes"]["go_straight"]:
-                    queue_len += lane_queues[f"{r}_{lane}"]
-                statistic_state[f"{location_dict_short[roads[r]['location']]}T"] = {"cells": [0 for _ in range(4)],
-                                                                                    "queue_len": queue_len,
-                                                                                    "avg_wait_time": 0.0}
-
-            if roads[r]["turn_left"] is not None:
-                queue_len = 0.0
-                for lane in roads[r]["lanes"]["turn_left"]:
-                    queue_len += lane_queues[f"{r}_{lane}"]
-                statistic_state[f"{location_dict_short[roads[r]['location']]}L"] = {"cells": [0 for _ in range(4)],
-                                                                                    "queue_len": queue_len,
-                                                                                    "avg_wait_time": 0.0}
-
-            # get vehicle position info
-            straight_lanes = [f"{r}_{idx}" for idx in roads[r]["lanes"]["go_straight"]]
-            left_lanes = [f"{r}_{idx}" for idx in roads[r]["lanes"]["turn_left"]]
-            lanes = straight_lanes + left_lanes
-
-            for lane in lanes:
-                waiting_times = []
-                vehicles = lane_vehicles[lane]
-
-                # collect lane group info
-                if location == "North":
-                    if lane in straight_lanes:
-                        lane_group = 0
-                    elif lane in left_lanes:
-                        lane_group = 1
-                elif location == "South":
-                    if lane in straight_lanes:
-                        lane_group = 2
-                    elif lane in left_lanes:
-                        lane_group = 3
-                elif location == "East":
-                    if lane in straight_lanes:
-                        lane_group = 4
-                    elif lane in left_lanes:
-                        lane_group = 5
-                elif location == "West":
-                    if lane in straight_lanes:
-                        lane_group = 6
-                    elif lane in left_lanes:
-                        lane_group = 7
-                else:
-                    lane_group = -1
-
-                # collect lane cell info
-                for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
-
-                    # update statistic state
-                    if lane_pos <= road_length / 10:
-                        gpt_lane_cell = 0
-                    elif road_length / 10 < lane_pos <= road_length / 3:
-                        gpt_lane_cell = 1
-                    elif road_length / 3 < lane_pos <= (road_length / 3) * 2:
-                        gpt_lane_cell = 2
-                    else:
-                        gpt_lane_cell = 3
-
-                    # speed > 0.1 m/s are approaching vehicles
-                    speed = float(veh_info["speed"])
-                    if speed > 0.1:
-                        statistic_state[location_direction_dict[lane_group]]["cells"][gpt_lane_cell] += 1
-                        outgoing_lane_speeds.append(speed)
-                    else:
-                        veh_waiting_time = env.waiting_vehicle_list[veh]['time'] if veh in env.waiting_vehicle_list else 0.0
-                        waiting_times.append(veh_waiting_time)
-                avg_wait_time = np.mean(waiting_times) if len(waiting_times) > 0 else 0.0
-                statistic_state[location_direction_dict[lane_group]]["avg_wait_time"] = avg_wait_time
-
-
-        # incoming lanes
-        else:
-            queue_len = 0.0
-            for lane in range(2):
-                queue_len += lane_queues[f"{r}_{lane}"]
-            statistic_state_incoming[location_dict_short[roads[r]['location']]] = {"cells": [0 for _ in range(4)],
-                                                                                   "queue_len": queue_len}
-            incoming_lanes = [f"{r}_{idx}" for idx in range(2)]
-
-            for lane in incoming_lanes:
-                vehicles = lane_vehicles[lane]
-
-                # collect lane group info
-                if location == "North":
-                    lane_group = 0
-                elif location == "South":
-                    lane_group = 1
-                elif location == "East":
-                    lane_group = 2
-                elif location == "West":
-                    lane_group = 3
-                else:
-                    lane_group = -1
-
-                # collect lane cell info
-                for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
-
-                    # update statistic state
-                    if lane_pos <= road_length / 10:
-                        gpt_lane_cell = 0
-                    elif road_length / 10 < lane_pos <= road_length / 3:
-                        gpt_lane_cell = 1
-                    elif road_length / 3 < lane_pos <= (road_length / 3) * 2:
-                        gpt_lane_cell = 2
-                    else:
-                        gpt_lane_cell = 3
-
-                    # speed > 0.1 m/s are approaching vehicles
-                    if float(veh_info["speed"]) > 0.1:
-                        statistic_state_incoming[location_incoming_dict[lane_group]]["cells"][gpt_lane_cell] += 1
-
-    mean_speed = np.mean(outgoing_lane_speeds) if len(outgoing_lane_speeds) > 0 else 0.0
-
-    return statistic_state, statistic_state_incoming, mean_speed
-
 def get_state_three_segment(roads, env):
     """
     Retrieve the state of the intersection from sumo, in the form of cell occupancy
     """
-    lane_queues = env.eng.get_lane_waiting_vehicle_count()
-    lane_vehicles = env.eng.get_lane_vehicles()
+    lane_queues = env.vehicle_snapshot.lane_waiting_vehicle_count
+    lane_vehicles = env.vehicle_snapshot.lane_vehicles
 
     # init statistic info & get queue info
     statistic_state = {}
@@ -354,7 +213,6 @@ def get_state_three_segment(roads, env):
             lanes = straight_lanes + left_lanes
 
             for lane in lanes:
-                waiting_times = []
                 vehicles = lane_vehicles[lane]
 
                 # collect lane group info
@@ -383,8 +241,8 @@ def get_state_three_segment(roads, env):
 
                 # collect lane cell info
                 for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
+                    veh_speed, veh_distance = env.vehicle_snapshot.get_vehicle_state(veh)
+                    lane_pos = road_length - veh_distance
 
                     # update statistic state
                     if lane_pos <= road_length / 10:
@@ -395,15 +253,12 @@ def get_state_three_segment(roads, env):
                         gpt_lane_cell = 2
 
                     # speed > 0.1 m/s are approaching vehicles
-                    speed = float(veh_info["speed"])
+                    speed = veh_speed
                     if speed > 0.1:
                         statistic_state[location_direction_dict[lane_group]]["cells"][gpt_lane_cell] += 1
                         outgoing_lane_speeds.append(speed)
-                    else:
-                        veh_waiting_time = env.waiting_vehicle_list[veh]['time'] if veh in env.waiting_vehicle_list else 0.0
-                        waiting_times.append(veh_waiting_time)
-                avg_wait_time = np.mean(waiting_times) if len(waiting_times) > 0 else 0.0
-                statistic_state[location_direction_dict[lane_group]]["avg_wait_time"] = avg_wait_time
+                statistic_state[location_direction_dict[lane_group]]["avg_wait_time"] = \
+                    env.waiting_tracker.lane_mean_waiting_time(lane)
 
 
         # incoming lanes
@@ -432,8 +287,8 @@ def get_state_three_segment(roads, env):
 
                 # collect lane cell info
                 for veh in vehicles:
-                    veh_info = env.eng.get_vehicle_info(veh)
-                    lane_pos = road_length - float(veh_info["distance"])
+                    veh_speed, veh_distance = env.vehicle_snapshot.get_vehicle_state(veh)
+                    lane_pos = road_length - veh_distance
 
                     # update statistic state
                     if lane_pos <= road_length / 10:
@@ -444,7 +299,7 @@ def get_state_three_segment(roads, env):
                         gpt_lane_cell = 2
 
                     # speed > 0.1 m/s are approaching vehicles
-                    if float(veh_info["speed"]) > 0.1:
+                    if veh_speed > 0.1:
                         statistic_state_incoming[location_incoming_dict[lane_group]]["cells"][gpt_lane_cell] += 1
 
     mean_speed = np.mean(outgoing_lane_speeds) if len(outgoing_lane_speeds) > 0 else 0.0
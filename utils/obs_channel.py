@@ -0,0 +1,93 @@
+import numpy as np
+from multiprocessing.shared_memory import SharedMemory
+
+
+def feature_dim(feature, dic_traffic_env_conf):
+    """size of the per intersection vector of a state feature"""
+    num_lanes = sum(dic_traffic_env_conf["NUM_LANES"])
+    if feature in ["cur_phase", "time_this_phase"]:
+        return 1
+    if feature in ["lane_num_vehicle", "lane_num_vehicle_downstream", "delta_lane_num_vehicle",
+                   "lane_num_waiting_vehicle_in", "lane_num_waiting_vehicle_out",
+                   "traffic_movement_pressure_queue", "traffic_movement_pressure_queue_efficient",
+                   "traffic_movement_pressure_num", "lane_enter_running_part"]:
+        return num_lanes
+    if feature == "pressure":
+        return 2 * num_lanes
+    if feature == "adjacency_matrix":
+        return min(dic_traffic_env_conf["TOP_K_ADJACENCY"], dic_traffic_env_conf["NUM_INTERSECTIONS"])
+    if feature == "num_in_seg_attend":
+        # three running segments and the queue of every entering and exiting lane
+        return 2 * 4 * num_lanes
+    raise ValueError(f"no observation size for the state feature {feature}")
+
+
+def observation_schema(dic_traffic_env_conf, list_state_feature=None):
+    """[(feature, feature_dim)] of LIST_STATE_FEATURE"""
+    if list_state_feature is None:
+        list_state_feature = dic_traffic_env_conf["LIST_STATE_FEATURE"]
+    return [(feature, feature_dim(feature, dic_traffic_env_conf)) for feature in list_state_feature]
+
+
+class ObservationChannel:
+    """
+    Observations of num_envs environments in shared memory, one [num_envs, N, feature_dim] block per feature
+    of the schema. The process that creates the channel owns and unlinks the blocks, the env workers it starts
+    afterwards attach() to them with spec() and write their states, the owner reads them through numpy views
+    without any serialization.
+    """
+    def __init__(self, schema, num_intersections, num_envs=1, dtype=np.float32, names=None):
+        self.schema = list(schema)
+        self.num_intersections = num_intersections
+        self.num_envs = num_envs
+        self.dtype = np.dtype(dtype)
+        self.owner = names is None
+        self.blocks = []
+        self.arrays = {}
+        for ind, (feature, dim) in enumerate(self.schema):
+            shape = (num_envs, num_intersections, dim)
+            if self.owner:
+                block = SharedMemory(create=True, size=max(int(np.prod(shape)) * self.dtype.itemsize, 1))
+            else:
+                # workers started by the owner share its resource tracker, attaching registers nothing new
+                block = SharedMemory(name=names[ind])
+            self.blocks.append(block)
+            self.arrays[feature] = np.ndarray(shape, dtype=self.dtype, buffer=block.buf)
+
+    @classmethod
+    def from_conf(cls, dic_traffic_env_conf, num_envs=1, dtype=np.float32):
+        return cls(observation_schema(dic_traffic_env_conf), dic_traffic_env_conf["NUM_INTERSECTIONS"],
+                   num_envs=num_envs, dtype=dtype)
+
+    def spec(self):
+        """picklable arguments of attach()"""
+        return {"schema": self.schema, "num_intersections": self.num_intersections, "num_envs": self.num_envs,
+                "dtype": self.dtype.str, "names": [block.name for block in self.blocks]}
+
+    @classmethod
+    def attach(cls, spec):
+        return cls(**spec)
+
+    def write(self, env_index, state):
+        """state: List[Dict{feature: list}], the per intersection states of CityFlowEnv.get_state"""
+        for feature, array in self.arrays.items():
+            array[env_index] = np.asarray([dic_state[feature] for dic_state in state],
+                                          dtype=self.dtype).reshape(array.shape[1:])
+
+    def write_features(self, env_index, get_feature_array):
+        """get_feature_array(feature) -> [N, feature_dim], e.g. FeatureEngine.get_feature_array"""
+        for feature, array in self.arrays.items():
+            array[env_index] = get_feature_array(feature)
+
+    def read(self, env_index=0):
+        """the per intersection state dicts of one environment, as views on the shared memory"""
+        return [{feature: array[env_index, i] for feature, array in self.arrays.items()}
+                for i in range(self.num_intersections)]
+
+    def close(self):
+        self.arrays = {}
+        for block in self.blocks:
+            block.close()
+            if self.owner:
+                block.unlink()
+        self.blocks = []
@@ -1,6 +1,7 @@
 from .config import DIC_AGENTS
-from .my_utils import merge, get_state, get_state_detail, eight_phase_list, dump_json
-from copy import deepcopy
+from .decision_cache import get_decision_cache
+from .decision_pipeline import DecisionPipeline, FrozenStateView
+from .my_utils import merge, get_state, eight_phase_list, dump_json
 from .cityflow_env import CityFlowEnv
 from .pipeline import path_check, copy_cityflow_file, copy_conf_file
 import os
@@ -9,6 +10,7 @@ import numpy as np
 import wandb
 from tqdm import tqdm
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 class OneLine:
 
@@ -37,6 +39,7 @@ class OneLine:
         self.env.reset()
 
         agent_name = self.dic_traffic_env_conf["MODEL_NAME"]
+        self.decision_cache = get_decision_cache(self.dic_agent_conf.get("DECISION_CACHE", None))
         for i in range(self.dic_traffic_env_conf['NUM_INTERSECTIONS']):
             if "ChatGPT" in agent_name:
                 agent = DIC_AGENTS[agent_name.split("-")[0]](
@@ -45,7 +48,10 @@ class OneLine:
                     inter_name=self.env.list_intersection[i].inter_name,
                     phase_num=len(self.env.list_intersection[i].list_phases),
                     log_dir=self.dic_agent_conf["LOG_DIR"],
-                    dataset=f"{self.roadnet}-{self.trafficflow}"
+                    dataset=f"{self.roadnet}-{self.trafficflow}",
+                    decision_cache=self.decision_cache,
+                    early_stop=self.dic_agent_conf.get("EARLY_STOP", False),
+                    decoding_mode=self.dic_agent_conf.get("DECODING_MODE", "free")
                 )
             elif "open_llm" in agent_name:
                 agent = DIC_AGENTS[agent_name.split("-")[0]](
@@ -91,60 +97,27 @@ class OneLine:
 
         start_time = time.time()
         state_action_log = [[] for _ in range(len(state))]
+        self.executor = None
+        if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"]:
+            # one executor for the whole round, the agents share the pooled client of utils.llm
+            self.executor = ThreadPoolExecutor(max_workers=len(self.agents))
+        pipeline = DecisionPipeline(self.decide, lookahead=self.dic_agent_conf.get("PIPELINE_LOOKAHEAD", 0))
         while not done and current_time < total_run_cnt:
-            action_list = []
-            threads = []
-
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[self.env.list_intersection[i].inter_name]
-                roads = deepcopy(intersection["roads"])
-                statistic_state, statistic_state_incoming, mean_speed = get_state_detail(roads, self.env)
+                statistic_state, statistic_state_incoming, mean_speed = list_state_detail[i]
                 state_action_log[i].append({"state": statistic_state, "state_incoming": statistic_state_incoming, "approaching_speed": mean_speed})
 
-                one_state = state[i]
-                count = step_num
-                if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"] or "open_llm" in self.dic_traffic_env_conf["MODEL_NAME"]:
-                    thread = threading.Thread(target=self.agents[i].choose_action, args=(self.env,))
-                    threads.append(thread)
-                else:
-                    action = self.agents[i].choose_action(count, one_state)
-                    action_list.append(action)
-
-            # multi-thread
-            if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"]:
-                for thread in threads:
-                    thread.start()
-
-                for thread in tqdm(threads):
-                    thread.join()
-
-                for i in range(len(state)):
-                    action = self.agents[i].temp_action_logger
-                    action_list.append(action)
-
-            # multi-thread
-            if "open_llm" in self.dic_traffic_env_conf["MODEL_NAME"]:
-                started_thread_id = []
-                thread_num = self.dic_traffic_env_conf["LLM_API_THREAD_NUM"] if not self.dic_agent_conf["WITH_EXTERNAL_API"] else 2
-                for i, thread in enumerate(tqdm(threads)):
-                    thread.start()
-                    started_thread_id.append(i)
-
-                    if (i + 1) % thread_num == 0:
-                        for t_id in started_thread_id:
-                            threads[t_id].join()
-                        started_thread_id = []
-
-                for i in range(len(state)):
-                    action = self.agents[i].temp_action_logger
-                    action_list.append(action)
+            action_list = pipeline.actions(step_num, state, FrozenStateView(self.env, list_state_detail))
 
             next_state, reward, done, _ = self.env.step(action_list)
 
-            # log action
+            # log action, with PIPELINE_LOOKAHEAD the one applied now was decided on the state of an earlier step
             for i in range(len(state)):
-                state_action_log[i][-1]["action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][pipeline.applied_step]["action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_decision_step"] = pipeline.applied_step
 
             f_memory = open(file_name_memory, "a")
             # output to std out and file
@@ -166,10 +139,15 @@ class OneLine:
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]['time'])
-            waiting_time_episode.append(np.mean(waiting_times) if len(waiting_times) > 0 else 0.0)
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
+        for decided_step, action_list in pipeline.close():
+            for i in range(len(state)):
+                state_action_log[i][decided_step]["action"] = eight_phase_list[action_list[i]]
+        if self.executor is not None:
+            self.executor.shutdown()
+        if self.decision_cache is not None:
+            self.decision_cache.flush()
+            print(self.decision_cache.stats())
 
         # wandb logger
         vehicle_travel_times = {}
@@ -206,5 +184,53 @@ class OneLine:
         print("Training time: ", time.time()-start_time)
 
         self.env.batch_log_2()
+        if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"] or "open_llm" in self.dic_traffic_env_conf["MODEL_NAME"]:
+            for agent in self.agents:
+                agent.close()
 
         return results
+
+    def decide(self, step_num, state, state_view):
+        """the actions of all intersections, the LLM agents read their state from state_view"""
+        action_list = []
+        threads = []
+        for i in range(len(state)):
+            one_state = state[i]
+            count = step_num
+            if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"]:
+                continue
+            elif "open_llm" in self.dic_traffic_env_conf["MODEL_NAME"]:
+                thread = threading.Thread(target=self.agents[i].choose_action, args=(state_view,))
+                threads.append(thread)
+            else:
+                action = self.agents[i].choose_action(count, one_state)
+                action_list.append(action)
+
+        # multi-thread
+        if "ChatGPT" in self.dic_traffic_env_conf["MODEL_NAME"]:
+            futures = [self.executor.submit(self.agents[i].choose_action, state_view) for i in range(len(state))]
+            for future in tqdm(futures):
+                future.result()
+
+            for i in range(len(state)):
+                action = self.agents[i].temp_action_logger
+                action_list.append(action)
+
+        # multi-thread
+        if "open_llm" in self.dic_traffic_env_conf["MODEL_NAME"]:
+            started_thread_id = []
+            thread_num = self.dic_traffic_env_conf["LLM_API_THREAD_NUM"] if not self.dic_agent_conf["WITH_EXTERNAL_API"] else 2
+            for i, thread in enumerate(tqdm(threads)):
+                thread.start()
+                started_thread_id.append(i)
+
+                if (i + 1) % thread_num == 0:
+                    for t_id in started_thread_id:
+                        threads[t_id].join()
+                    started_thread_id = []
+
+            for i in range(len(state)):
+                action = self.agents[i].temp_action_logger
+                action_list.append(action)
+
+        return action_list
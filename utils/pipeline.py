@@ -2,7 +2,7 @@ from .generator import Generator, Generator_LLMLight
 from .construct_sample import ConstructSample
 from .updater import Updater
 from . import model_test
-from .my_utils import dump_json, get_state_detail, state2text, getPrompt, action2code, eight_phase_list, four_phase_list
+from .my_utils import dump_json, state2text, getPrompt, action2code, eight_phase_list, four_phase_list
 import json
 import shutil
 import os
@@ -168,7 +168,8 @@ class Pipeline:
             if not os.path.exists(train_round):
                 os.makedirs(train_round)
             cs = ConstructSample(path_to_samples=train_round, cnt_round=cnt_round,
-                                 dic_traffic_env_conf=self.dic_traffic_env_conf)
+                                 dic_traffic_env_conf=self.dic_traffic_env_conf,
+                                 max_memory_len=self.dic_agent_conf["MAX_MEMORY_LEN"])
             cs.make_reward_for_system()
             making_samples_end_time = time.time()
             making_samples_total_time = making_samples_end_time - making_samples_start_time
@@ -0,0 +1,100 @@
+import torch
+from transformers import DynamicCache
+from .my_utils import getPrompt
+
+STATE_PLACEHOLDER = "<<STATE_TXT>>"
+
+
+class PromptTemplate:
+    """
+    The alpaca style prompt of getPrompt split around the state block.
+    Everything before the state text is identical for all intersections and steps.
+    """
+    def __init__(self, prompt_func=getPrompt):
+        prompt = prompt_func(STATE_PLACEHOLDER)
+        full = prompt[0]['content'] + "\n\n### Instruction:\n" + prompt[1]['content'] + "\n\n### Response:\n"
+        self.prefix, self.suffix_tail = full.split(STATE_PLACEHOLDER)
+
+    def render(self, state_txt):
+        return self.prefix + state_txt + self.suffix_tail
+
+    def suffix(self, state_txt):
+        return state_txt + self.suffix_tail
+
+
+class PromptPrefixCache:
+    """
+    Tokenizes the static prefix of PromptTemplate once, and for HF models prefills its KV cache once,
+    so a decision step only tokenizes and prefills the per-intersection suffix.
+    The prompts are laid out as [prefix][padding][suffix] so the prefix cache lines up for the whole batch.
+    """
+    def __init__(self, tokenizer, template=None, llm_model=None):
+        self.tokenizer = tokenizer
+        self.template = template if template is not None else PromptTemplate()
+        self.llm_model = llm_model
+        self.prefix_ids = tokenizer(self.template.prefix)["input_ids"]
+        # the suffix is tokenized after the last prefix character so the tokens at the boundary stay the same
+        self.anchor = self.template.prefix[-1]
+        self.anchor_ids = tokenizer(self.anchor, add_special_tokens=False)["input_ids"]
+        self.checked = False
+        self.enabled = True
+        self.prefix_past_key_values = None
+
+    def _suffix_ids(self, state_txt):
+        ids = self.tokenizer(self.anchor + self.template.suffix(state_txt), add_special_tokens=False)["input_ids"]
+        return ids[len(self.anchor_ids):]
+
+    def _check(self, state_txt):
+        """fall back to full prompts if the tokenizer merges tokens across the prefix boundary"""
+        full_ids = self.tokenizer(self.template.render(state_txt))["input_ids"]
+        self.enabled = self.prefix_ids + self._suffix_ids(state_txt) == full_ids
+        self.checked = True
+        if not self.enabled:
+            print("prompt prefix cache disabled: the prefix is not a token prefix of the prompt")
+
+    def token_ids(self, state_txts):
+        """token ids of the full prompts, built from the cached prefix ids"""
+        if not self.checked and len(state_txts) > 0:
+            self._check(state_txts[0])
+        if not self.enabled:
+            return [self.tokenizer(self.template.render(state_txt))["input_ids"] for state_txt in state_txts]
+        return [self.prefix_ids + self._suffix_ids(state_txt) for state_txt in state_txts]
+
+    def encode(self, state_txts, device="cuda"):
+        """
+        return: input_ids, attention_mask of the batch as [prefix][padding][suffix]
+        """
+        list_ids = self.token_ids(state_txts)
+        num_prefix = len(self.prefix_ids) if self.enabled else 0
+        max_len = max(len(ids) for ids in list_ids)
+        input_ids, attention_mask = [], []
+        for ids in list_ids:
+            num_pad = max_len - len(ids)
+            input_ids.append(ids[:num_prefix] + [self.tokenizer.pad_token_id] * num_pad + ids[num_prefix:])
+            attention_mask.append([1] * num_prefix + [0] * num_pad + [1] * (len(ids) - num_prefix))
+        return torch.tensor(input_ids, device=device), torch.tensor(attention_mask, device=device)
+
+    def _prefix_cache(self, batch_size):
+        if self.prefix_past_key_values is None:
+            prefix_ids = torch.tensor([self.prefix_ids], device=self.llm_model.device)
+            with torch.no_grad():
+                past_key_values = self.llm_model(input_ids=prefix_ids, use_cache=True).past_key_values
+            if hasattr(past_key_values, "to_legacy_cache"):
+                past_key_values = past_key_values.to_legacy_cache()
+            self.prefix_past_key_values = past_key_values
+        return DynamicCache.from_legacy_cache(tuple(
+            (key.expand(batch_size, -1, -1, -1).contiguous(), value.expand(batch_size, -1, -1, -1).contiguous())
+            for key, value in self.prefix_past_key_values))
+
+    def generate(self, state_txts, **generation_kwargs):
+        """
+        HF generate on the prompts of state_txts, reusing the prefilled prefix when the search keeps one beam
+        and one sequence per prompt, generate expands the input ids of the other searches but not a passed cache
+        return: the generated ids after the prompt
+        """
+        input_ids, attention_mask = self.encode(state_txts, device=self.llm_model.device)
+        if self.enabled and generation_kwargs.get("num_beams", 1) == 1 and \
+                generation_kwargs.get("num_return_sequences", 1) == 1:
+            generation_kwargs = dict(generation_kwargs, past_key_values=self._prefix_cache(input_ids.size(0)))
+        response_ids = self.llm_model.generate(input_ids=input_ids, attention_mask=attention_mask, **generation_kwargs)
+        return response_ids[:, input_ids.size(1):]
@@ -0,0 +1,151 @@
+import os
+import json
+import numpy as np
+from collections.abc import Sequence
+
+# columns of every sample besides the state features
+SCALAR_COLUMNS = {"action": np.int64, "reward_average": np.float64, "reward_instant": np.float64, "time": np.int64}
+
+
+class SampleBatch(Sequence):
+    """
+    Samples as columns: state and next_state are {feature: [n, feature_dim]} arrays, action, reward_average,
+    reward_instant and time are [n] arrays. Indexing gives the
+    [state, action, next_state, reward_average, reward_instant, time, tag] rows of ConstructSample and slicing
+    gives a SampleBatch, so the agents that loop over the samples keep working.
+    """
+    def __init__(self, state, action, next_state, reward_average, reward_instant, time):
+        self.state = state
+        self.action = action
+        self.next_state = next_state
+        self.reward_average = reward_average
+        self.reward_instant = reward_instant
+        self.time = time
+
+    @classmethod
+    def from_samples(cls, samples, list_feature):
+        """samples: the rows of ConstructSample.make_reward"""
+        state = {feature: np.array([sample[0][feature] for sample in samples], dtype=np.float32)
+                 for feature in list_feature}
+        next_state = {feature: np.array([sample[2][feature] for sample in samples], dtype=np.float32)
+                      for feature in list_feature}
+        columns = [np.array([sample[ind] for sample in samples], dtype=dtype)
+                   for ind, dtype in zip([1, 3, 4, 5], SCALAR_COLUMNS.values())]
+        return cls(state, columns[0], next_state, *columns[1:])
+
+    @classmethod
+    def concatenate(cls, batches):
+        """one SampleBatch of the non empty batches, [] if there is none"""
+        batches = [batch for batch in batches if len(batch) > 0]
+        if len(batches) == 0:
+            return []
+        return cls({feature: np.concatenate([batch.state[feature] for batch in batches])
+                    for feature in batches[0].state},
+                   np.concatenate([batch.action for batch in batches]),
+                   {feature: np.concatenate([batch.next_state[feature] for batch in batches])
+                    for feature in batches[0].next_state},
+                   np.concatenate([batch.reward_average for batch in batches]),
+                   np.concatenate([batch.reward_instant for batch in batches]),
+                   np.concatenate([batch.time for batch in batches]))
+
+    def take(self, indexes):
+        return SampleBatch({feature: array[indexes] for feature, array in self.state.items()},
+                           self.action[indexes],
+                           {feature: array[indexes] for feature, array in self.next_state.items()},
+                           self.reward_average[indexes], self.reward_instant[indexes], self.time[indexes])
+
+    def __len__(self):
+        return len(self.action)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return self.take(np.arange(len(self))[index])
+        return [{feature: array[index].tolist() for feature, array in self.state.items()},
+                int(self.action[index]),
+                {feature: array[index].tolist() for feature, array in self.next_state.items()},
+                float(self.reward_average[index]), float(self.reward_instant[index]), int(self.time[index]), ""]
+
+
+class ReplayStore:
+    """
+    Replay memory of one intersection, one memory mapped .npy file per column in the directory path.
+    It is a circular buffer of capacity samples, the newest samples overwrite the oldest ones, which is the
+    MAX_MEMORY_LEN forgetting of the pickled memory. Sampling reads only the requested rows.
+    """
+    def __init__(self, path, capacity):
+        self.path = path
+        self.meta_file = os.path.join(path, "meta.json")
+        if os.path.exists(self.meta_file):
+            with open(self.meta_file) as f:
+                self.meta = json.load(f)
+        else:
+            self.meta = {"capacity": capacity, "size": 0, "head": 0, "schema": None}
+        self.capacity = self.meta["capacity"]
+
+    def __len__(self):
+        return self.meta["size"]
+
+    def _column_file(self, column):
+        return os.path.join(self.path, column + ".npy")
+
+    def _columns(self):
+        """{column: (dtype, shape)}"""
+        columns = {}
+        for feature, dim in self.meta["schema"].items():
+            columns["state_" + feature] = (np.float32, (self.capacity, dim))
+            columns["next_state_" + feature] = (np.float32, (self.capacity, dim))
+        for column, dtype in SCALAR_COLUMNS.items():
+            columns[column] = (dtype, (self.capacity,))
+        return columns
+
+    def _open(self, mode):
+        return {column: np.lib.format.open_memmap(self._column_file(column), mode=mode, dtype=dtype, shape=shape)
+                if mode == "w+" else np.load(self._column_file(column), mmap_mode=mode)
+                for column, (dtype, shape) in self._columns().items()}
+
+    def append(self, batch):
+        if len(batch) == 0:
+            return
+        if len(batch) > self.capacity:
+            batch = batch[len(batch) - self.capacity:]
+        if self.meta["schema"] is None:
+            os.makedirs(self.path, exist_ok=True)
+            self.meta["schema"] = {feature: int(array.shape[1]) for feature, array in batch.state.items()}
+            columns = self._open("w+")
+        else:
+            columns = self._open("r+")
+
+        positions = (self.meta["head"] + np.arange(len(batch))) % self.capacity
+        for feature in self.meta["schema"]:
+            columns["state_" + feature][positions] = batch.state[feature]
+            columns["next_state_" + feature][positions] = batch.next_state[feature]
+        for column in SCALAR_COLUMNS:
+            columns[column][positions] = getattr(batch, column)
+        for array in columns.values():
+            array.flush()
+
+        self.meta["head"] = int((self.meta["head"] + len(batch)) % self.capacity)
+        self.meta["size"] = int(min(self.meta["size"] + len(batch), self.capacity))
+        with open(self.meta_file, "w") as f:
+            json.dump(self.meta, f)
+
+    def sample(self, indexes=None):
+        """
+        indexes: positions in the memory from the oldest sample, all of them by default
+        return: SampleBatch of the samples at indexes, in that order
+        """
+        if indexes is None:
+            indexes = np.arange(len(self))
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if indexes.size > 0 and (indexes.min() < 0 or indexes.max() >= len(self)):
+            raise IndexError(f"sample indexes out of range of a replay memory of {len(self)} samples")
+        positions = (self.meta["head"] - len(self) + indexes) % self.capacity
+        columns = self._open("r")
+        return SampleBatch({feature: np.asarray(columns["state_" + feature][positions])
+                            for feature in self.meta["schema"]},
+                           np.asarray(columns["action"][positions]),
+                           {feature: np.asarray(columns["next_state_" + feature][positions])
+                            for feature in self.meta["schema"]},
+                           np.asarray(columns["reward_average"][positions]),
+                           np.asarray(columns["reward_instant"][positions]),
+                           np.asarray(columns["time"][positions]))
@@ -0,0 +1,71 @@
+import json
+import numpy as np
+
+
+def _cal_distance(loc_dict1, loc_dict2):
+    a = np.array((loc_dict1["x"], loc_dict1["y"]))
+    b = np.array((loc_dict2["x"], loc_dict2["y"]))
+    return np.sqrt(np.sum((a-b)**2))
+
+
+def adjacency_extraction(roadnet_file, top_k):
+    """
+    {intersection id: location, adjacency_row and neighbor_ENWS} of the signalized intersections of a roadnet,
+    adjacency_row is the intersection itself then its top_k - 1 nearest intersections, by index
+    """
+    traffic_light_node_dict = {}
+    with open(roadnet_file) as json_data:
+        net = json.load(json_data)
+        for inter in net["intersections"]:
+            if not inter["virtual"]:
+                traffic_light_node_dict[inter["id"]] = {"location": {"x": float(inter["point"]["x"]),
+                                                                     "y": float(inter["point"]["y"])},
+                                                        "total_inter_num": None, "adjacency_row": None,
+                                                        "inter_id_to_index": None,
+                                                        "neighbor_ENWS": None}
+
+        total_inter_num = len(traffic_light_node_dict.keys())
+        inter_id_to_index = {}
+
+        edge_id_dict = {}
+        for road in net["roads"]:
+            if road["id"] not in edge_id_dict.keys():
+                edge_id_dict[road["id"]] = {}
+            edge_id_dict[road["id"]]["from"] = road["startIntersection"]
+            edge_id_dict[road["id"]]["to"] = road["endIntersection"]
+
+        index = 0
+        for i in traffic_light_node_dict.keys():
+            inter_id_to_index[i] = index
+            index += 1
+
+        for i in traffic_light_node_dict.keys():
+            location_1 = traffic_light_node_dict[i]["location"]
+
+            row = np.array([0]*total_inter_num)
+            # row = np.zeros((self.dic_traffic_env_conf["NUM_ROW"],self.dic_traffic_env_conf["NUM_col"]))
+            for j in traffic_light_node_dict.keys():
+                location_2 = traffic_light_node_dict[j]["location"]
+                dist = _cal_distance(location_1, location_2)
+                row[inter_id_to_index[j]] = dist
+            if len(row) == top_k:
+                adjacency_row_unsorted = np.argpartition(row, -1)[:top_k].tolist()
+            elif len(row) > top_k:
+                adjacency_row_unsorted = np.argpartition(row, top_k)[:top_k].tolist()
+            else:
+                adjacency_row_unsorted = [k for k in range(total_inter_num)]
+            adjacency_row_unsorted.remove(inter_id_to_index[i])
+            traffic_light_node_dict[i]["adjacency_row"] = [inter_id_to_index[i]]+adjacency_row_unsorted
+            traffic_light_node_dict[i]["total_inter_num"] = total_inter_num
+
+        for i in traffic_light_node_dict.keys():
+            traffic_light_node_dict[i]["total_inter_num"] = inter_id_to_index
+            traffic_light_node_dict[i]["neighbor_ENWS"] = []
+            for j in range(4):
+                road_id = i.replace("intersection", "road")+"_"+str(j)
+                if edge_id_dict[road_id]["to"] not in traffic_light_node_dict.keys():
+                    traffic_light_node_dict[i]["neighbor_ENWS"].append(None)
+                else:
+                    traffic_light_node_dict[i]["neighbor_ENWS"].append(edge_id_dict[road_id]["to"])
+
+    return traffic_light_node_dict
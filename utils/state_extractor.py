@@ -0,0 +1,92 @@
+import numpy as np
+
+
+class StateExtractor:
+    """
+    Network-wide get_state_detail.
+    The LaneTopology of every intersection is mapped to network lane indices once, the cell occupancy,
+    queue length and approaching speed of all intersections are then computed from one snapshot.
+    """
+    def __init__(self, list_intersection, intersection_dict, vehicle_snapshot, waiting_tracker):
+        self.vehicle_snapshot = vehicle_snapshot
+        self.waiting_tracker = waiting_tracker
+        self.num_intersections = len(list_intersection)
+        lane_index = vehicle_snapshot.lane_index
+        self.num_lanes = len(lane_index)
+
+        self.list_groups = []        # [(inter_ind, is_incoming, key)]
+        self.lane_road_length = np.full(self.num_lanes, np.nan)
+        self.segment_bounds = np.full((self.num_lanes, 3), np.nan)
+        cell_group, cell_lane, queue_group, queue_lane = [], [], [], []
+        speed_inter, speed_lane, wait_lane = [], [], []
+        for inter_ind, inter in enumerate(list_intersection):
+            topology = intersection_dict[inter.inter_name]["topology"]
+            group_offset = len(self.list_groups)
+            lanes = np.array([lane_index[lane] for lane in topology.lane_ids], dtype=np.int64)
+            self.list_groups += [(inter_ind, is_incoming, key) for is_incoming, key in topology.groups]
+            self.lane_road_length[lanes] = topology.lane_length
+            self.segment_bounds[lanes] = topology.segment_bounds
+
+            counted = topology.lane_group >= 0
+            cell_group.append(topology.lane_group[counted] + group_offset)
+            cell_lane.append(lanes[counted])
+            queue_group.append(topology.queue_group + group_offset)
+            queue_lane.append(np.array([lane_index[lane] for lane in topology.queue_lane_ids], dtype=np.int64))
+            speed_lane.append(lanes[topology.lane_outgoing])
+            speed_inter.append(np.full(len(speed_lane[-1]), inter_ind, dtype=np.int64))
+            wait_lane.append(np.where(topology.wait_lane >= 0, lanes[topology.wait_lane], -1))
+
+        self.num_groups = len(self.list_groups)
+        self.cell_group, self.cell_lane = self._concat(cell_group), self._concat(cell_lane)
+        self.queue_group, self.queue_lane = self._concat(queue_group), self._concat(queue_lane)
+        self.speed_inter, self.speed_lane = self._concat(speed_inter), self._concat(speed_lane)
+        self.wait_lane = self._concat(wait_lane)
+
+    @staticmethod
+    def _concat(arrays):
+        return np.concatenate(arrays).astype(np.int64) if arrays else np.zeros(0, dtype=np.int64)
+
+    def _lane_stats(self):
+        """cell counts and speeds of approaching vehicles (speed > 0.1 m/s) of every lane"""
+        snapshot = self.vehicle_snapshot
+        speed = snapshot.speed[snapshot.entry_vehicle]
+        lane_pos = self.lane_road_length[snapshot.entry_lane] - snapshot.distance[snapshot.entry_vehicle]
+        cell = (lane_pos[:, None] > self.segment_bounds[snapshot.entry_lane]).sum(axis=1)
+        approaching = speed > 0.1
+        lane_cells = np.bincount(snapshot.entry_lane[approaching] * 4 + cell[approaching],
+                                 minlength=self.num_lanes * 4).reshape(self.num_lanes, 4)
+        lane_speed_sum = np.bincount(snapshot.entry_lane, weights=np.where(approaching, speed, 0.0),
+                                     minlength=self.num_lanes)
+        lane_speed_num = np.bincount(snapshot.entry_lane[approaching], minlength=self.num_lanes)
+        return lane_cells, lane_speed_sum, lane_speed_num
+
+    def extract(self):
+        """
+        return: List[(statistic_state, statistic_state_incoming, mean_speed)] in the order of list_intersection
+        """
+        lane_cells, lane_speed_sum, lane_speed_num = self._lane_stats()
+        lane_waiting_vehicle_count = self.vehicle_snapshot.lane_waiting_vehicle_count
+        lane_queue = np.fromiter((lane_waiting_vehicle_count[lane] for lane in self.vehicle_snapshot.lane_ids),
+                                 dtype=np.float64, count=self.num_lanes)
+
+        group_cells = np.zeros((self.num_groups, 4), dtype=np.int64)
+        np.add.at(group_cells, self.cell_group, lane_cells[self.cell_lane])
+        group_queue = np.bincount(self.queue_group, weights=lane_queue[self.queue_lane], minlength=self.num_groups)
+        lane_wait_time = self.waiting_tracker.lane_mean_waiting_times(self.num_lanes)
+        group_wait_time = np.where(self.wait_lane >= 0, lane_wait_time[self.wait_lane], 0.0)
+        inter_speed_sum = np.bincount(self.speed_inter, weights=lane_speed_sum[self.speed_lane],
+                                      minlength=self.num_intersections)
+        inter_speed_num = np.bincount(self.speed_inter, weights=lane_speed_num[self.speed_lane],
+                                      minlength=self.num_intersections)
+
+        group_cells, group_queue, group_wait_time = group_cells.tolist(), group_queue.tolist(), group_wait_time.tolist()
+        list_state_detail = [({}, {}, float(inter_speed_sum[i] / inter_speed_num[i]) if inter_speed_num[i] > 0 else 0.0)
+                             for i in range(self.num_intersections)]
+        for group_ind, (inter_ind, is_incoming, key) in enumerate(self.list_groups):
+            statistic_state, statistic_state_incoming, _ = list_state_detail[inter_ind]
+            if is_incoming:
+                statistic_state_incoming[key] = {"cells": group_cells[group_ind], "queue_len": group_queue[group_ind]}
+            else:
+                statistic_state[key] = {"cells": group_cells[group_ind], "queue_len": group_queue[group_ind],
+                                        "avg_wait_time": group_wait_time[group_ind]}
+        return list_state_detail
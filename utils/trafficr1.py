@@ -8,8 +8,9 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 
 from .config import DIC_AGENTS
-from .my_utils import merge, get_state_detail, eight_phase_list, dump_json
-from copy import deepcopy
+from .decision_cache import get_decision_cache
+from .decision_pipeline import DecisionPipeline, FrozenStateView
+from .my_utils import merge, eight_phase_list, dump_json
 from .cityflow_env import CityFlowEnv
 from .pipeline import path_check, copy_cityflow_file, copy_conf_file
 
@@ -51,6 +52,7 @@ class TrafficR1:
         self.env.reset()
 
         agent_class = DIC_AGENTS[self.dic_agent_conf.get("AGENT_TYPE", "LLMTrafficR1")]
+        self.decision_cache = get_decision_cache(self.dic_agent_conf.get("DECISION_CACHE", None))
         print(
             "Using Agent type:", self.dic_agent_conf.get("AGENT_TYPE", "LLMTrafficR1")
         )
@@ -64,6 +66,9 @@ class TrafficR1:
                 phase_num=len(self.env.list_intersection[i].list_phases),
                 log_dir=self.dic_agent_conf["LOG_DIR"],
                 dataset=f"{self.roadnet}-{self.trafficflow}",
+                decision_cache=self.decision_cache,
+                early_stop=self.dic_agent_conf.get("EARLY_STOP", False),
+                decoding_mode=self.dic_agent_conf.get("DECODING_MODE", "free"),
             )
 
             self.agents.append(agent)
@@ -96,19 +101,21 @@ class TrafficR1:
 
         start_time = time.time()
         state_action_log = [[] for _ in range(len(state))]
+        # one executor for the whole round, the agents share the pooled client of utils.llm
+        self.executor = ThreadPoolExecutor(max_workers=len(self.agents))
+        pipeline = DecisionPipeline(
+            self.decide, lookahead=self.dic_agent_conf.get("PIPELINE_LOOKAHEAD", 0)
+        )
         while not done and current_time < total_run_cnt:
             action_list = []
             # threads = []
             features = []
 
+            list_state_detail = self.env.get_state_detail()
             for i in range(len(state)):
                 # log statistic state
-                intersection = self.env.intersection_dict[
-                    self.env.list_intersection[i].inter_name
-                ]
-                roads = deepcopy(intersection["roads"])
                 statistic_state, statistic_state_incoming, mean_speed = (
-                    get_state_detail(roads, self.env)
+                    list_state_detail[i]
                 )
                 state_action_log[i].append(
                     {
@@ -122,18 +129,17 @@ class TrafficR1:
 
             # action_list = await asyncio.gather(*features)
 
-            with ThreadPoolExecutor(max_workers=len(self.agents)) as executor:
-                features = [
-                    executor.submit(self.agents[i].choose_action, self.env)
-                    for i in range(len(state))
-                ]
-                action_list = [future.result() for future in features]
+            action_list = pipeline.actions(
+                FrozenStateView(self.env, list_state_detail)
+            )
 
             next_state, reward, done, _ = self.env.step(action_list)
 
-            # log action
+            # log action, with PIPELINE_LOOKAHEAD the one applied now was decided on the state of an earlier step
             for i in range(len(state)):
-                state_action_log[i][-1]["action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][pipeline.applied_step]["action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_action"] = eight_phase_list[action_list[i]]
+                state_action_log[i][-1]["applied_decision_step"] = pipeline.applied_step
 
             f_memory = open(file_name_memory, "a")
             # output to std out and file
@@ -162,12 +168,14 @@ class TrafficR1:
             queue_length_episode.append(sum(queue_length_inter))
 
             # waiting time
-            waiting_times = []
-            for veh in self.env.waiting_vehicle_list:
-                waiting_times.append(self.env.waiting_vehicle_list[veh]["time"])
-            waiting_time_episode.append(
-                np.mean(waiting_times) if len(waiting_times) > 0 else 0.0
-            )
+            waiting_time_episode.append(self.env.get_mean_waiting_time())
+        for decided_step, action_list in pipeline.close():
+            for i in range(len(state)):
+                state_action_log[i][decided_step]["action"] = eight_phase_list[action_list[i]]
+        self.executor.shutdown()
+        if self.decision_cache is not None:
+            self.decision_cache.flush()
+            print(self.decision_cache.stats())
 
         # wandb logger
         vehicle_travel_times = {}
@@ -231,5 +239,14 @@ class TrafficR1:
         print("Training time: ", time.time() - start_time)
 
         self.env.batch_log_2()
+        for agent in self.agents:
+            agent.close()
 
         return results
+
+    def decide(self, state_view):
+        features = [
+            self.executor.submit(agent.choose_action, state_view)
+            for agent in self.agents
+        ]
+        return [future.result() for future in features]
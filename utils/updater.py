@@ -1,4 +1,5 @@
 from .config import DIC_AGENTS
+from .replay_store import ReplayStore, SampleBatch
 import pickle
 import os
 import time
@@ -27,7 +28,40 @@ class Updater:
                 self.dic_path, self.cnt_round, intersection_id=str(i))
             self.agents.append(agent)
 
+    def _log_load_error(self, i):
+        error_dir = os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"]).replace("records", "errors")
+        if not os.path.exists(error_dir):
+            os.makedirs(error_dir)
+        f = open(os.path.join(error_dir, "error_info_inter_{0}.txt".format(i)), "a")
+        f.write("Fail to load samples for inter {0}\n".format(i))
+        f.write('traceback.format_exc():\n%s\n' % traceback.format_exc())
+        f.close()
+        print('traceback.format_exc():\n%s' % traceback.format_exc())
+
+    def load_columnar_sample(self, i):
+        """
+        the samples of inter i from its ReplayStore, the store already forgot all but the last MAX_MEMORY_LEN
+        samples, so only the sampled rows are read
+        """
+        sample_set = []
+        try:
+            store = ReplayStore(os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"], "train_round",
+                                             "replay_inter_{0}".format(i)), self.dic_agent_conf["MAX_MEMORY_LEN"])
+            print("==== memory size after forget ====:", len(store))
+            sample_size = min(self.dic_agent_conf["SAMPLE_SIZE"], len(store))
+            if self.sample_indexes is None:
+                self.sample_indexes = random.sample(range(len(store)), sample_size)
+            sample_set = store.sample(self.sample_indexes)
+            print("==== memory samples number =====:", sample_size)
+        except:
+            self._log_load_error(i)
+        if i % 100 == 0:
+            print("load_sample for inter {0}".format(i))
+        return sample_set
+
     def load_sample_with_forget(self, i):
+        if self.dic_traffic_env_conf.get("COLUMNAR_REPLAY", False):
+            return self.load_columnar_sample(i)
         sample_set = []
         try:
             sample_file = open(os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"], "train_round",
@@ -57,15 +91,7 @@ class Updater:
             print("==== memory samples number =====:", sample_size)
 
         except:
-            error_dir = os.path.join(self.dic_path["PATH_TO_WORK_DIRECTORY"]).replace("records", "errors")
-            if not os.path.exists(error_dir):
-                os.makedirs(error_dir)
-            f = open(os.path.join(error_dir, "error_info_inter_{0}.txt".format(i)), "a")
-            f.write("Fail to load samples for inter {0}\n".format(i))
-            f.write('traceback.format_exc():\n%s\n' % traceback.format_exc())
-            f.close()
-            print('traceback.format_exc():\n%s' % traceback.format_exc())
-            pass
+            self._log_load_error(i)
         if i % 100 == 0:
             print("load_sample for inter {0}".format(i))
         return sample_set
@@ -75,10 +101,12 @@ class Updater:
         print("Start load samples at", start_time)
         if self.dic_traffic_env_conf['MODEL_NAME'] in ["EfficientPressLight",  "EfficientMPLight",
                                                        "AdvancedMPLight", "AdvancedDQN", "Attend"]:
-            sample_set_all = []
-            for i in range(self.dic_traffic_env_conf['NUM_INTERSECTIONS']):
-                sample_set = self.load_sample_with_forget(i)
-                sample_set_all.extend(sample_set)
+            sample_sets = [self.load_sample_with_forget(i) for i in range(self.dic_traffic_env_conf['NUM_INTERSECTIONS'])]
+            if self.dic_traffic_env_conf.get("COLUMNAR_REPLAY", False):
+                # keep the columns, the agent reads the feature arrays directly
+                sample_set_all = SampleBatch.concatenate(sample_sets)
+            else:
+                sample_set_all = [sample for sample_set in sample_sets for sample in sample_set]
             self.agents[0].prepare_Xs_Y(sample_set_all)
         elif self.dic_traffic_env_conf['MODEL_NAME'] in ["PressLight"]:
             for i in range(self.dic_traffic_env_conf['NUM_INTERSECTIONS']):
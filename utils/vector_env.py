@@ -0,0 +1,174 @@
+import os
+import shutil
+import traceback
+import numpy as np
+from copy import deepcopy
+from multiprocessing import Process, Pipe
+from .cityflow_env import CityFlowEnv
+from .obs_channel import ObservationChannel
+
+
+def _write_observation(channel, env_index, env, state):
+    if env.feature_engine is not None:
+        # straight from the network wide arrays, without the per intersection lists
+        channel.write_features(env_index, env.feature_engine.get_feature_array)
+    else:
+        channel.write(env_index, state)
+
+
+def _env_worker(conn, env_kwargs, seed, env_index, channel_spec):
+    # CityFlowEnv.reset draws the engine seed from numpy, the forked workers would all draw the same one
+    np.random.seed(seed)
+    env = CityFlowEnv(**env_kwargs)
+    channel = ObservationChannel.attach(channel_spec)
+    try:
+        while True:
+            cmd, data = conn.recv()
+            if cmd == "close":
+                break
+            try:
+                if cmd == "reset":
+                    state = env.reset()
+                    _write_observation(channel, env_index, env, state)
+                    reply = None
+                elif cmd == "step":
+                    state, reward, done, average_reward = env.step(data)
+                    _write_observation(channel, env_index, env, state)
+                    reply = (reward, done, average_reward)
+                elif cmd == "call":
+                    method, args = data
+                    reply = method(env, *args) if callable(method) else getattr(env, method)(*args)
+                else:
+                    raise ValueError(f"unknown command {cmd}")
+                conn.send((True, reply))
+            except Exception:
+                conn.send((False, traceback.format_exc()))
+    finally:
+        channel.close()
+        conn.close()
+
+
+def queue_length(env):
+    """vehicles waiting on the entering lanes of all intersections"""
+    return sum(sum(inter.dic_feature['lane_num_waiting_vehicle_in']) for inter in env.list_intersection)
+
+
+def average_travel_time(env):
+    """mean travel time of the vehicles of the episode, the ones still on the road leave at RUN_COUNTS"""
+    vehicle_travel_times = {}
+    for inter in env.list_intersection:
+        arrive_left_times = inter.dic_vehicle_arrive_leave_time
+        for veh in arrive_left_times:
+            if "shadow" in veh:
+                continue
+            enter_time = arrive_left_times[veh]["enter_time"]
+            leave_time = arrive_left_times[veh]["leave_time"]
+            if not np.isnan(enter_time):
+                leave_time = leave_time if not np.isnan(leave_time) else env.dic_traffic_env_conf["RUN_COUNTS"]
+                vehicle_travel_times.setdefault(veh, []).append(leave_time - enter_time)
+    return np.mean([sum(vehicle_travel_times[veh]) for veh in vehicle_travel_times])
+
+
+def make_vector_env_kwargs(dic_path, dic_traffic_env_conf, num_envs, list_traffic_files=None):
+    """
+    CityFlowEnv arguments of num_envs environments, each one logs to its own env_{k} directory in the work
+    directory. list_traffic_files gives every environment its own traffic file, by default they share one.
+    """
+    if list_traffic_files is None:
+        list_traffic_files = [dic_traffic_env_conf["TRAFFIC_FILE"]] * num_envs
+    list_env_kwargs = []
+    for k, traffic_file in enumerate(list_traffic_files):
+        path = os.path.join(dic_path["PATH_TO_WORK_DIRECTORY"], f"env_{k}")
+        os.makedirs(path, exist_ok=True)
+        env_conf = deepcopy(dic_traffic_env_conf)
+        env_conf["TRAFFIC_FILE"] = traffic_file
+        shutil.copy(os.path.join(dic_path["PATH_TO_DATA"], traffic_file), os.path.join(path, traffic_file))
+        shutil.copy(os.path.join(dic_path["PATH_TO_DATA"], env_conf["ROADNET_FILE"]),
+                    os.path.join(path, env_conf["ROADNET_FILE"]))
+        list_env_kwargs.append({"path_to_log": path, "path_to_work_directory": path,
+                                "dic_traffic_env_conf": env_conf, "dic_path": dic_path})
+    return list_env_kwargs
+
+
+class VectorCityFlowEnv:
+    """
+    K CityFlowEnv in worker processes, stepped together with step(actions[K, N]).
+    The workers write the LIST_STATE_FEATURE observations into an ObservationChannel, one [K, N, feature_dim]
+    float32 array per feature, so only actions, rewards and done flags go through the pipes. The arrays returned
+    by reset() and step() are views on the shared memory, they are overwritten by the next step.
+    All environments must have the same roadnet and state features, the seeds default to 0..K-1.
+    """
+    def __init__(self, list_env_kwargs, seeds=None, dtype=np.float32):
+        self.num_envs = len(list_env_kwargs)
+        self.list_env_kwargs = list_env_kwargs
+        self.channel = ObservationChannel.from_conf(list_env_kwargs[0]["dic_traffic_env_conf"],
+                                                    num_envs=self.num_envs, dtype=dtype)
+        self.num_intersections = self.channel.num_intersections
+        self.obs = self.channel.arrays
+        if seeds is None:
+            seeds = list(range(self.num_envs))
+
+        self.conns = []
+        self.processes = []
+        for k, (env_kwargs, seed) in enumerate(zip(list_env_kwargs, seeds)):
+            parent_conn, child_conn = Pipe()
+            p = Process(target=_env_worker, args=(child_conn, env_kwargs, seed, k, self.channel.spec()), daemon=True)
+            p.start()
+            child_conn.close()
+            self.conns.append(parent_conn)
+            self.processes.append(p)
+
+    def _send(self, cmd, list_data=None):
+        if list_data is None:
+            list_data = [None] * self.num_envs
+        for conn, data in zip(self.conns, list_data):
+            conn.send((cmd, data))
+
+    def _recv(self):
+        # every worker replies to every command, a failure is raised only once all replies are read so the
+        # pipes stay in step with the commands
+        results = [conn.recv() for conn in self.conns]
+        errors = [f"environment {k} failed:\n{reply}" for k, (ok, reply) in enumerate(results) if not ok]
+        if errors:
+            raise RuntimeError("\n".join(errors))
+        return [reply for _, reply in results]
+
+    def reset(self):
+        """return: {feature: [K, N, feature_dim]}"""
+        self._send("reset")
+        self._recv()
+        return self.obs
+
+    def step(self, actions):
+        """
+        actions: [K, N] phase indices
+        return: {feature: [K, N, feature_dim]}, rewards [K, N], dones [K], average rewards over the action [K, N]
+        """
+        self._send("step", [list(map(int, env_actions)) for env_actions in actions])
+        replies = self._recv()
+        rewards = np.array([reply[0] for reply in replies])
+        dones = np.array([reply[1] for reply in replies])
+        average_rewards = np.array([reply[2] for reply in replies])
+        return self.obs, rewards, dones, average_rewards
+
+    def call(self, method, *args):
+        """
+        the result of every environment, method is the name of a CityFlowEnv method or a module level
+        function that takes the environment as its first argument
+        """
+        self._send("call", [(method, args)] * self.num_envs)
+        return self._recv()
+
+    def get_state(self, env_index):
+        """the observation of one environment as the per intersection state dicts of CityFlowEnv.get_state"""
+        return self.channel.read(env_index)
+
+    def close(self):
+        for conn, p in zip(self.conns, self.processes):
+            if p.is_alive():
+                conn.send(("close", None))
+        for conn, p in zip(self.conns, self.processes):
+            p.join()
+            conn.close()
+        self.obs = None
+        self.channel.close()
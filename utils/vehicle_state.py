@@ -0,0 +1,200 @@
+import numpy as np
+
+
+class VehicleSnapshot:
+    """
+    Bulk view of the engine state at one tick.
+    Every field is read from the engine with a single call per tick and the
+    per-vehicle values are kept in arrays indexed by vehicle position.
+    """
+    def __init__(self, eng):
+        self.eng = eng
+        self.lane_index = {}     # lane_id -> stable integer index
+        self.lane_ids = []
+        self.tick = -1
+        self.clear()
+
+    def clear(self):
+        self.lane_vehicles = {}
+        self.lane_waiting_vehicle_count = {}
+        self.vehicle_speed = {}
+        self.vehicle_distance = {}
+        self.vehicle_ids = []
+        self.vehicle_index = {}
+        self.speed = np.zeros(0)
+        self.distance = np.zeros(0)
+        self.drivable = np.zeros(0, dtype=np.int64)
+        self.entry_lane = np.zeros(0, dtype=np.int64)
+        self.entry_vehicle = np.zeros(0, dtype=np.int64)
+        self.entry_shadow = np.zeros(0, dtype=bool)
+
+    def update(self):
+        """pull every field from the engine once"""
+        self.tick += 1
+        self.lane_vehicles = self.eng.get_lane_vehicles()
+        self.lane_waiting_vehicle_count = self.eng.get_lane_waiting_vehicle_count()
+        self.vehicle_speed = self.eng.get_vehicle_speed()
+        self.vehicle_distance = self.eng.get_vehicle_distance()
+
+        if not self.lane_index:
+            self.lane_ids = list(self.lane_vehicles.keys())
+            self.lane_index = {lane: i for i, lane in enumerate(self.lane_ids)}
+
+        self.vehicle_ids = list(self.vehicle_speed.keys())
+        self.vehicle_index = {v_id: i for i, v_id in enumerate(self.vehicle_ids)}
+        num_vehicles = len(self.vehicle_ids)
+        self.speed = np.fromiter(self.vehicle_speed.values(), dtype=np.float64, count=num_vehicles)
+        self.distance = np.fromiter((self.vehicle_distance[v_id] for v_id in self.vehicle_ids),
+                                    dtype=np.float64, count=num_vehicles)
+
+        # -1 means the vehicle is not on a lane (i.e. inside an intersection)
+        # entries are the (lane, vehicle) pairs of lane_vehicles, shadows point to the real vehicle
+        self.drivable = np.full(num_vehicles, -1, dtype=np.int64)
+        entry_lane, entry_vehicle, entry_shadow = [], [], []
+        for lane, vehicles in self.lane_vehicles.items():
+            lane_ind = self.lane_index[lane]
+            for v_id in vehicles:
+                if "shadow" in v_id:
+                    ind = self.vehicle_index.get(v_id[:-7])
+                    shadow = True
+                else:
+                    ind = self.vehicle_index.get(v_id)
+                    shadow = False
+                    if ind is not None:
+                        self.drivable[ind] = lane_ind
+                if ind is not None:
+                    entry_lane.append(lane_ind)
+                    entry_vehicle.append(ind)
+                    entry_shadow.append(shadow)
+        self.entry_lane = np.array(entry_lane, dtype=np.int64)
+        self.entry_vehicle = np.array(entry_vehicle, dtype=np.int64)
+        self.entry_shadow = np.array(entry_shadow, dtype=bool)
+
+    @property
+    def system_states(self):
+        return {"get_lane_vehicles": self.lane_vehicles,
+                "get_lane_waiting_vehicle_count": self.lane_waiting_vehicle_count,
+                "get_vehicle_speed": self.vehicle_speed,
+                "get_vehicle_distance": self.vehicle_distance}
+
+    def get_drivable(self, ind):
+        lane_ind = self.drivable[ind]
+        return self.lane_ids[lane_ind] if lane_ind >= 0 else None
+
+    def get_vehicle_state(self, v_id):
+        """
+        return (speed, distance) of a vehicle, shadow vehicles share the state of the real one
+        """
+        ind = self.vehicle_index.get(v_id)
+        if ind is None and "shadow" in v_id:
+            ind = self.vehicle_index.get(v_id[:-7])
+        if ind is None:
+            v_info = self.eng.get_vehicle_info(v_id)
+            return float(v_info["speed"]), float(v_info["distance"])
+        return self.speed[ind], self.distance[ind]
+
+
+class WaitingTimeTracker:
+    """
+    Waiting time of queuing vehicles (speed < 0.1 m/s on the same drivable).
+    Vehicles are mapped to stable slots of contiguous arrays, the slots of
+    vehicles that leave the network are recycled.
+    """
+    def __init__(self, interval, capacity=1024):
+        self.interval = interval
+        self.slot_index = {}
+        self.slot_vehicle = [None] * capacity
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.waiting_time = np.zeros(capacity)
+        self.link = np.full(capacity, -1, dtype=np.int64)
+        self.waiting = np.zeros(capacity, dtype=bool)
+        self.last_tick = np.full(capacity, -1, dtype=np.int64)
+
+        self.total_waiting_time = 0.0
+        self.num_waiting = 0
+        self.lane_waiting_time_sum = np.zeros(0)
+        self.lane_num_waiting = np.zeros(0)
+        self.lane_index = {}
+
+    def _grow(self):
+        capacity = len(self.slot_vehicle)
+        self.slot_vehicle += [None] * capacity
+        self.free_slots += list(range(2 * capacity - 1, capacity - 1, -1))
+        self.waiting_time = np.concatenate([self.waiting_time, np.zeros(capacity)])
+        self.link = np.concatenate([self.link, np.full(capacity, -1, dtype=np.int64)])
+        self.waiting = np.concatenate([self.waiting, np.zeros(capacity, dtype=bool)])
+        self.last_tick = np.concatenate([self.last_tick, np.full(capacity, -1, dtype=np.int64)])
+
+    def _allocate(self, v_id):
+        if not self.free_slots:
+            self._grow()
+        slot = self.free_slots.pop()
+        self.slot_index[v_id] = slot
+        self.slot_vehicle[slot] = v_id
+        self.waiting[slot] = False
+        self.waiting_time[slot] = 0.0
+        return slot
+
+    def _release(self, slots):
+        for slot in slots:
+            del self.slot_index[self.slot_vehicle[slot]]
+            self.slot_vehicle[slot] = None
+            self.free_slots.append(slot)
+        self.waiting[slots] = False
+        self.waiting_time[slots] = 0.0
+        self.last_tick[slots] = -1
+
+    def update(self, snapshot):
+        slots = np.empty(len(snapshot.vehicle_ids), dtype=np.int64)
+        for ind, v_id in enumerate(snapshot.vehicle_ids):
+            slot = self.slot_index.get(v_id)
+            slots[ind] = slot if slot is not None else self._allocate(v_id)
+
+        # waiting vehicles keep counting while they stay on the same drivable
+        is_waiting = snapshot.speed < 0.1
+        same_link = self.waiting[slots] & (self.link[slots] == snapshot.drivable)
+        self.waiting_time[slots] = np.where(is_waiting,
+                                            np.where(same_link, self.waiting_time[slots] + self.interval,
+                                                     self.interval),
+                                            0.0)
+        self.waiting[slots] = is_waiting
+        self.link[slots] = snapshot.drivable
+        self.last_tick[slots] = snapshot.tick
+
+        # recycle vehicles that left the network
+        left = np.flatnonzero((self.last_tick >= 0) & (self.last_tick != snapshot.tick))
+        if len(left) > 0:
+            self._release(left.tolist())
+
+        # aggregate once, queries are then O(1)
+        active = np.flatnonzero(self.waiting)
+        self.total_waiting_time = float(self.waiting_time[active].sum())
+        self.num_waiting = len(active)
+        lanes = self.link[active]
+        on_lane = lanes >= 0
+        self.lane_index = snapshot.lane_index
+        self.lane_waiting_time_sum = np.bincount(lanes[on_lane], weights=self.waiting_time[active][on_lane],
+                                                 minlength=len(snapshot.lane_ids))
+        self.lane_num_waiting = np.bincount(lanes[on_lane], minlength=len(snapshot.lane_ids))
+
+    def get_waiting_time(self, v_id):
+        slot = self.slot_index.get(v_id)
+        if slot is None or not self.waiting[slot]:
+            return 0.0
+        return float(self.waiting_time[slot])
+
+    def mean_waiting_time(self):
+        return self.total_waiting_time / self.num_waiting if self.num_waiting > 0 else 0.0
+
+    def lane_mean_waiting_time(self, lane):
+        lane_ind = self.lane_index.get(lane)
+        if lane_ind is None or self.lane_num_waiting[lane_ind] == 0:
+            return 0.0
+        return float(self.lane_waiting_time_sum[lane_ind] / self.lane_num_waiting[lane_ind])
+
+    def lane_mean_waiting_times(self, num_lanes):
+        """lane_mean_waiting_time of every lane, in the order of lane_index"""
+        if len(self.lane_num_waiting) == 0:
+            return np.zeros(num_lanes)
+        return np.divide(self.lane_waiting_time_sum, self.lane_num_waiting,
+                         out=np.zeros(num_lanes), where=self.lane_num_waiting > 0)